@@ -1,3 +1,4 @@
+import numpy
 import pandas
 
 from . import amino_acid
@@ -54,19 +55,28 @@ class AlleleEncoding(object):
                 index=[None] + all_alleles)
             self.sequences = unpadded.str.pad(
                 unpadded.str.len().max(), fillchar="X")
+            # Categories for mapping alleles to indices: the allele with
+            # category code i has index i + 1.
+            self.allele_categories = pandas.Index(all_alleles)
+            self.index_to_allele = numpy.array(
+                [None] + all_alleles, dtype=object)
         else:
             assert allele_to_sequence is None
             self.allele_to_index = borrow_from.allele_to_index
             self.sequences = borrow_from.sequences
             self.allele_to_sequence = borrow_from.allele_to_sequence
+            self.allele_categories = borrow_from.allele_categories
+            self.index_to_allele = borrow_from.index_to_allele
 
         if alleles is not None:
-            assert all(
-                allele in self.allele_to_index for allele in alleles),\
-                "Missing alleles: " + " ".join(set(
-                    a for a in alleles if a not in self.allele_to_index))
-            self.indices = alleles.map(self.allele_to_index)
-            assert not self.indices.isnull().any()
+            codes = pandas.Categorical(
+                alleles, categories=self.allele_categories).codes
+            missing = (codes == -1) & alleles.notnull().values
+            assert not missing.any(),\
+                "Missing alleles: " + " ".join(set(alleles[missing]))
+            # Code -1 (None) becomes index 0.
+            self.indices = pandas.Series(
+                codes.astype("int32") + 1, index=alleles.index)
             self.alleles = alleles
         else:
             self.indices = None
@@ -74,6 +84,28 @@ class AlleleEncoding(object):
 
         self.encoding_cache = {}
 
+    @classmethod
+    def from_indices(klass, indices, borrow_from):
+        """
+        Create an AlleleEncoding from allele indices (as in `indices`) instead
+        of allele names.
+
+        Parameters
+        ----------
+        indices : numpy.array of int
+            Indices into the allele universe of `borrow_from`
+        borrow_from : AlleleEncoding
+
+        Returns
+        -------
+        AlleleEncoding
+        """
+        result = klass(borrow_from=borrow_from)
+        indices = numpy.asarray(indices, dtype="int32")
+        result.indices = pandas.Series(indices)
+        result.alleles = pandas.Series(borrow_from.index_to_allele[indices])
+        return result
+
     def compact(self):
         """
         Return a new AlleleEncoding in which the universe of supported alleles
@@ -90,7 +122,7 @@ class AlleleEncoding(object):
                 for allele in self.alleles.unique()
                 if allele is not None))
 
-    def allele_representations(self, encoding_name):
+    def allele_representations(self, encoding_name, dtype=None):
         """
         Encode the universe of supported allele sequences to a matrix.
 
@@ -99,6 +131,9 @@ class AlleleEncoding(object):
         encoding_name : string
             How to represent amino acids. Valid names are "BLOSUM62" or
             "one-hot". See `amino_acid.ENCODING_DATA_FRAMES`.
+        dtype : numpy dtype, optional
+            Type of the result, e.g. "float32". If not specified, the type
+            of the values in the encoding is used.
 
         Returns
         -------
@@ -107,22 +142,70 @@ class AlleleEncoding(object):
         where vector size is usually 21 (20 amino acids + X character)
         """
         if self.borrow_from is not None:
-            return self.borrow_from.allele_representations(encoding_name)
+            return self.borrow_from.allele_representations(
+                encoding_name, dtype=dtype)
 
         cache_key = (
             "allele_representations",
-            encoding_name)
+            encoding_name,
+            dtype)
         if cache_key not in self.encoding_cache:
             index_encoded_matrix = amino_acid.index_encoding(
                 self.sequences.values,
                 amino_acid.AMINO_ACID_INDEX)
             vector_encoded = amino_acid.fixed_vectors_encoding(
                 index_encoded_matrix,
-                amino_acid.ENCODING_DATA_FRAMES[encoding_name])
+                amino_acid.ENCODING_DATA_FRAMES[encoding_name],
+                dtype=dtype)
             self.encoding_cache[cache_key] = vector_encoded
         return self.encoding_cache[cache_key]
 
-    def fixed_length_vector_encoded_sequences(self, encoding_name):
+    def save_allele_representations(self, filename, encoding_name, dtype=None):
+        """
+        Write the allele representations (see `allele_representations`) to a
+        .npy file, so they can later be loaded instead of recomputed.
+
+        Parameters
+        ----------
+        filename : string
+        encoding_name : string
+        dtype : numpy dtype, optional
+        """
+        numpy.save(
+            filename,
+            self.allele_representations(encoding_name, dtype=dtype))
+
+    def load_allele_representations(self, filename, encoding_name, dtype=None):
+        """
+        Use allele representations written by `save_allele_representations`
+        instead of computing them.
+
+        The file must have been written by an AlleleEncoding with the same
+        allele sequences; only the number of alleles is checked.
+
+        Parameters
+        ----------
+        filename : string
+        encoding_name : string
+        dtype : numpy dtype, optional
+        """
+        if self.borrow_from is not None:
+            return self.borrow_from.load_allele_representations(
+                filename, encoding_name, dtype=dtype)
+        representations = numpy.load(filename)
+        if len(representations) != len(self.allele_to_index):
+            raise ValueError(
+                "Expected representations for %d alleles but %s has %d" % (
+                    len(self.allele_to_index), filename, len(representations)))
+        if dtype is not None:
+            representations = representations.astype(dtype, copy=False)
+        cache_key = (
+            "allele_representations",
+            encoding_name,
+            dtype)
+        self.encoding_cache[cache_key] = representations
+
+    def fixed_length_vector_encoded_sequences(self, encoding_name, dtype=None):
         """
         Encode allele sequences (not the universe of alleles) to a matrix.
 
@@ -131,6 +214,8 @@ class AlleleEncoding(object):
         encoding_name : string
             How to represent amino acids. Valid names are "BLOSUM62" or
             "one-hot". See `amino_acid.ENCODING_DATA_FRAMES`.
+        dtype : numpy dtype, optional
+            Type of the result, e.g. "float32".
 
         Returns
         -------
@@ -140,9 +225,11 @@ class AlleleEncoding(object):
         """
         cache_key = (
             "fixed_length_vector_encoding",
-            encoding_name)
+            encoding_name,
+            dtype)
         if cache_key not in self.encoding_cache:
-            vector_encoded = self.allele_representations(encoding_name)
+            vector_encoded = self.allele_representations(
+                encoding_name, dtype=dtype)
             result = vector_encoded[self.indices]
             self.encoding_cache[cache_key] = result
         return self.encoding_cache[cache_key]
@@ -1,3 +1,6 @@
+import numpy
+import pandas
+
 from .allele_encoding import AlleleEncoding
 
 
@@ -7,22 +10,132 @@ class AlleleEncodingPair(object):
             alpha_allele_encoding,
             beta_allele_encoding):
         """
+        Alpha and beta chain allele encodings for a sequence of class II
+        alleles.
+
+        The alpha and beta allele indices (see `AlleleEncoding.indices`) are
+        the primary representation; lists of (alpha, beta) name pairs are only
+        built when `allele_pairs` is accessed.
+
+        Parameters
+        ----------
+        alpha_allele_encoding : AlleleEncoding
+        beta_allele_encoding : AlleleEncoding
         """
 
         self.alpha_allele_encoding = alpha_allele_encoding
         self.beta_allele_encoding = beta_allele_encoding
 
+        # Memo of (alpha allele, beta allele) -> (alpha index, beta index),
+        # shared with the instances returned by from_pairs.
+        self.pair_to_indices = {}
+
+    @property
+    def alpha_indices(self):
+        """
+        numpy.array of int32
+        """
+        return numpy.asarray(self.alpha_allele_encoding.indices)
+
+    @property
+    def beta_indices(self):
+        """
+        numpy.array of int32
+        """
+        return numpy.asarray(self.beta_allele_encoding.indices)
+
+    @property
+    def pair_codes(self):
+        """
+        numpy.array of int64 identifying the (alpha, beta) allele pair of each
+        element by its indices. See `from_pair_codes`.
+        """
+        num_beta_indices = len(self.beta_allele_encoding.index_to_allele)
+        return (
+            self.alpha_indices.astype(numpy.int64) * num_beta_indices +
+            self.beta_indices)
+
+    def from_pair_codes(self, pair_codes):
+        """
+        Create an AlleleEncodingPair for allele pairs given as `pair_codes`,
+        using the same allele universes as this instance.
+
+        Parameters
+        ----------
+        pair_codes : numpy.array of int
+
+        Returns
+        -------
+        AlleleEncodingPair
+        """
+        num_beta_indices = len(self.beta_allele_encoding.index_to_allele)
+        pair_codes = numpy.asarray(pair_codes, dtype=numpy.int64)
+        result = AlleleEncodingPair(
+            AlleleEncoding.from_indices(
+                pair_codes // num_beta_indices,
+                borrow_from=self.alpha_allele_encoding),
+            AlleleEncoding.from_indices(
+                pair_codes % num_beta_indices,
+                borrow_from=self.beta_allele_encoding))
+        result.pair_to_indices = self.pair_to_indices
+        return result
+
+    def __len__(self):
+        return len(self.alpha_allele_encoding.indices)
+
     def from_pairs(self, allele_pairs):
-        alpha_alleles = [a for (a, b) in allele_pairs]
-        beta_alleles = [b for (a, b) in allele_pairs]
-        return AlleleEncodingPair(
-            AlleleEncoding(
-                alpha_alleles,
+        """
+        Create an AlleleEncodingPair for the given (alpha, beta) allele pairs,
+        using the same allele universes as this instance.
+
+        Each distinct pair is resolved to indices once; repeated pairs, both
+        within and across calls, are looked up in a memo.
+
+        Parameters
+        ----------
+        allele_pairs : list of (string, string) tuples
+
+        Returns
+        -------
+        AlleleEncodingPair
+        """
+        (codes, unique_pairs) = pandas.factorize(
+            pandas.Series(list(allele_pairs), dtype=object))
+        unique_indices = numpy.zeros((len(unique_pairs), 2), dtype="int32")
+        for (i, pair) in enumerate(unique_pairs):
+            indices = self.pair_to_indices.get(pair)
+            if indices is None:
+                indices = self.resolve_pair(pair)
+                self.pair_to_indices[pair] = indices
+            unique_indices[i] = indices
+        pair_indices = unique_indices[codes]
+
+        result = AlleleEncodingPair(
+            AlleleEncoding.from_indices(
+                pair_indices[:, 0],
                 borrow_from=self.alpha_allele_encoding),
-            AlleleEncoding(
-                beta_alleles,
-                borrow_from=self.beta_allele_encoding),
-        )
+            AlleleEncoding.from_indices(
+                pair_indices[:, 1],
+                borrow_from=self.beta_allele_encoding))
+        result.pair_to_indices = self.pair_to_indices
+        return result
+
+    def resolve_pair(self, pair):
+        """
+        Return the (alpha index, beta index) for an (alpha, beta) allele pair.
+        """
+        (alpha, beta) = pair
+        missing = [
+            allele for (allele, encoding) in [
+                (alpha, self.alpha_allele_encoding),
+                (beta, self.beta_allele_encoding),
+            ]
+            if allele not in encoding.allele_to_index
+        ]
+        assert not missing, "Missing alleles: " + " ".join(missing)
+        return (
+            self.alpha_allele_encoding.allele_to_index[alpha],
+            self.beta_allele_encoding.allele_to_index[beta])
 
     @property
     def allele_encodings(self):
@@ -33,10 +146,6 @@ class AlleleEncodingPair(object):
 
     @property
     def allele_pairs(self):
-        return [
-            (a, b)
-            for (a, b)
-            in zip(
-                self.alpha_allele_encoding.alleles,
-                self.beta_allele_encoding.alleles)
-        ]
+        return list(zip(
+            self.alpha_allele_encoding.alleles,
+            self.beta_allele_encoding.alleles))
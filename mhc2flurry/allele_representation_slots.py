@@ -0,0 +1,86 @@
+"""
+Least-recently-used assignment of alleles to a fixed number of rows ("slots")
+of an allele representation embedding.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import collections
+
+import numpy
+
+
+class AlleleRepresentationSlots(object):
+    """
+    Tracks which allele occupies each row of a fixed-capacity allele
+    representation table, so that a network can serve varying sets of alleles
+    without changing the shape of its embedding layer.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of slots
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.allele_to_slot = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.allele_to_slot)
+
+    def clear(self):
+        """
+        Forget all slot assignments. Counters are kept.
+        """
+        self.allele_to_slot.clear()
+
+    def assign(self, alleles):
+        """
+        Assign slots to the given alleles, evicting the least recently used
+        alleles not in `alleles` if needed.
+
+        Parameters
+        ----------
+        alleles : list
+            Distinct allele keys (e.g. names)
+
+        Returns
+        -------
+        (numpy.array of int, numpy.array of int) tuple
+
+        The slot of each allele, and the positions in `alleles` of the alleles
+        that were newly assigned (whose representations must be written to
+        their slots).
+        """
+        if len(alleles) > self.capacity:
+            raise ValueError(
+                "Cannot assign %d alleles to %d slots" % (
+                    len(alleles), self.capacity))
+
+        # Mark resident alleles as recently used first, so they are not
+        # evicted to make room for the others.
+        for allele in alleles:
+            if allele in self.allele_to_slot:
+                self.allele_to_slot.move_to_end(allele)
+
+        slots = numpy.zeros(len(alleles), dtype="int32")
+        assigned = []
+        for (i, allele) in enumerate(alleles):
+            slot = self.allele_to_slot.get(allele)
+            if slot is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if len(self.allele_to_slot) < self.capacity:
+                    slot = len(self.allele_to_slot)
+                else:
+                    (_, slot) = self.allele_to_slot.popitem(last=False)
+                self.allele_to_slot[allele] = slot
+                assigned.append(i)
+            slots[i] = slot
+        return (slots, numpy.array(assigned, dtype="int32"))
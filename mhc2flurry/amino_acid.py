@@ -11,6 +11,7 @@ from __future__ import (
 import collections
 from copy import copy
 
+import numpy
 import pandas
 from six import StringIO
 
@@ -48,6 +49,28 @@ for (letter, i) in list(AMINO_ACID_INDEX.items()):
 
 AMINO_ACIDS = list(COMMON_AMINO_ACIDS_WITH_UNKNOWN.keys())
 
+
+def index_lookup_table(letter_to_index_dict, fill_value=-1):
+    """
+    Return a 256-element array mapping byte values (i.e. ASCII codes) to
+    integer indices, for vectorized encoding of sequences stored as bytes.
+
+    Parameters
+    ----------
+    letter_to_index_dict : dict : string -> int
+    fill_value : int
+        Value for bytes that are not in `letter_to_index_dict`. The default of
+        -1 marks them as unsupported.
+
+    Returns
+    -------
+    numpy.array of int8 with shape (256,)
+    """
+    result = numpy.full(256, fill_value, dtype="int8")
+    for (letter, index) in letter_to_index_dict.items():
+        result[ord(letter)] = index
+    return result
+
 BLOSUM62_MATRIX = pandas.read_csv(StringIO("""
    A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  X
 A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0  0
@@ -128,12 +151,35 @@ def index_encoding(sequences, letter_to_index_dict):
     -------
     numpy.array of integers with shape (`k`, `n`)
     """
-    df = pandas.DataFrame(iter(s) for s in sequences)
-    result = df.replace(letter_to_index_dict)
-    return result.values
+    sequences = numpy.asarray(sequences)
+    if len(sequences) == 0:
+        return numpy.zeros((0, 0), dtype=numpy.int32)
+    if sequences.dtype.kind == "O":
+        sequences = sequences.astype(numpy.str_)
+    if sequences.dtype.kind == "U":
+        codes = sequences.view(numpy.uint32).reshape((len(sequences), -1))
+    elif sequences.dtype.kind == "S":
+        codes = sequences.view(numpy.uint8).reshape((len(sequences), -1))
+    else:
+        raise ValueError("Sequence of strings is required")
+
+    # Characters outside the table (including the zeros numpy uses to pad
+    # shorter strings) map to -1.
+    lookup_table = index_lookup_table(letter_to_index_dict).astype(numpy.int32)
+    result = lookup_table[numpy.minimum(codes, 255)]
+    result[codes > 255] = -1
+    if (result < 0).any():
+        (row, column) = numpy.argwhere(result < 0)[0]
+        if codes[row, column] == 0:
+            raise ValueError("Sequences must all have the same length")
+        raise KeyError(
+            chr(codes[row, column]) if sequences.dtype.kind == "U"
+            else bytes(codes[row, column:column + 1]).decode())
+    return result
 
 
-def fixed_vectors_encoding(index_encoded_sequences, letter_to_vector_df):
+def fixed_vectors_encoding(
+        index_encoded_sequences, letter_to_vector_df, dtype=None):
     """
     Given a `n` x `k` matrix of integers such as that returned by `index_encoding()` and
     a dataframe mapping each index to an arbitrary vector, return a `n * k * m`
@@ -148,15 +194,21 @@ def fixed_vectors_encoding(index_encoded_sequences, letter_to_vector_df):
 
     letter_to_vector_df : pandas.DataFrame of shape (`alphabet size`, `m`)
 
+    dtype : numpy dtype, optional
+        Type of the result. If not specified, the type of the values in
+        `letter_to_vector_df` is used.
+
     Returns
     -------
-    numpy.array of integers with shape (`n`, `k`, `m`)
+    numpy.array of shape (`n`, `k`, `m`)
     """
     (num_sequences, sequence_length) = index_encoded_sequences.shape
+    vectors = letter_to_vector_df.values
+    if dtype is not None:
+        vectors = vectors.astype(dtype)
     target_shape = (
-        num_sequences, sequence_length, letter_to_vector_df.shape[0])
-    result = letter_to_vector_df.iloc[
-        index_encoded_sequences.reshape((-1,))  # reshape() avoids copy
-    ].values.reshape(target_shape)
+        num_sequences, sequence_length, vectors.shape[1])
+    result = vectors.take(
+        index_encoded_sequences.reshape((-1,)),  # reshape() avoids copy
+        axis=0).reshape(target_shape)
     return result
-
@@ -0,0 +1,224 @@
+"""
+Compare reduced-precision predictions (see
+`Class2AffinityPredictor.with_inference_precision`) against the float32
+reference on a held-out set of peptide / allele pairs.
+
+Reports the max and median absolute deviation in log10 nM affinity, and in
+percentile rank if the predictor has percentile rank calibrations, along with
+the prediction throughput of each setting and its speedup over float32. On
+CPU, reduced precision is often slower than float32, and simulated int8
+weights (which are still stored and computed as float32) are not faster.
+
+Example:
+
+    $ mhc2flurry-audit-precision \
+        --models-dir /path/to/models \
+        --data held_out.csv \
+        --precision float16 bfloat16 \
+        --simulate-int8-weights \
+        --max-log10-ic50-deviation 0.05
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+import argparse
+import itertools
+import logging
+import sys
+import time
+
+import numpy
+import pandas
+
+from .common import random_peptides
+from .reduced_precision import INFERENCE_PRECISIONS
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument(
+    "--models-dir",
+    metavar="DIR",
+    required=True,
+    help="Directory to read models")
+parser.add_argument(
+    "--data",
+    metavar="FILE.csv",
+    help="Held-out peptides, with columns 'peptide' and 'allele'. If not "
+    "specified, random peptides are used for each supported allele.")
+parser.add_argument(
+    "--num-random-peptides",
+    type=int,
+    default=1000,
+    metavar="N",
+    help="Random peptides per allele if --data is not specified. Default: "
+    "%(default)s")
+parser.add_argument(
+    "--random-peptide-length",
+    type=int,
+    default=15,
+    metavar="L",
+    help="Length of random peptides. Default: %(default)s")
+parser.add_argument(
+    "--precision",
+    nargs="+",
+    choices=sorted(INFERENCE_PRECISIONS),
+    default=["float16", "bfloat16"],
+    help="Precisions to audit. Default: %(default)s")
+parser.add_argument(
+    "--simulate-int8-weights",
+    action="store_true",
+    default=False,
+    help="Also audit each precision with weights rounded to int8 values. "
+    "This shows the accuracy of int8 quantization only: the weights are still "
+    "stored and computed as float32.")
+parser.add_argument(
+    "--max-models",
+    type=int,
+    metavar="N",
+    help="Use at most N models")
+parser.add_argument(
+    "--max-log10-ic50-deviation",
+    type=float,
+    metavar="X",
+    help="Exit with an error if any setting has a larger max deviation")
+parser.add_argument(
+    "--out",
+    metavar="FILE.csv",
+    help="Write results to the given file")
+
+
+def timed_predict(predictor, peptides, alleles, num_warmup=100):
+    """
+    Predict and measure throughput. A prediction of the first num_warmup
+    peptides is made first, so one-time costs (e.g. building networks) are
+    not included.
+
+    Parameters
+    ----------
+    predictor : Class2AffinityPredictor
+    peptides : list of string
+    alleles : list of string
+    num_warmup : int
+
+    Returns
+    -------
+    (numpy.array of nM affinity predictions, float rows per second) tuple
+    """
+    predictor.predict(
+        peptides[:num_warmup], alleles=alleles[:num_warmup], throw=False)
+    start = time.time()
+    predictions = predictor.predict(peptides, alleles=alleles, throw=False)
+    elapsed = time.time() - start
+    return (predictions, len(peptides) / max(elapsed, 1e-9))
+
+
+def audit(reference_predictor, predictor, peptides, alleles):
+    """
+    Compare the predictions and throughput of two predictors.
+
+    Parameters
+    ----------
+    reference_predictor : Class2AffinityPredictor
+    predictor : Class2AffinityPredictor
+    peptides : list of string
+    alleles : list of string
+
+    Returns
+    -------
+    dict of string -> float
+    """
+    (reference, reference_rows_per_second) = timed_predict(
+        reference_predictor, peptides, alleles)
+    (predictions, rows_per_second) = timed_predict(
+        predictor, peptides, alleles)
+    deviations = numpy.abs(numpy.log10(predictions) - numpy.log10(reference))
+    result = {
+        "rows_per_second": rows_per_second,
+        "speedup": rows_per_second / reference_rows_per_second,
+        "num_predictions": int(numpy.isfinite(deviations).sum()),
+        "max_log10_ic50_deviation": numpy.nanmax(deviations),
+        "median_log10_ic50_deviation": numpy.nanmedian(deviations),
+        "max_percentile_rank_shift": numpy.nan,
+        "median_percentile_rank_shift": numpy.nan,
+    }
+    if reference_predictor.allele_to_percent_rank_transform:
+        shifts = numpy.abs(
+            predictor.percentile_ranks(predictions, alleles=alleles, throw=False)
+            - reference_predictor.percentile_ranks(
+                reference, alleles=alleles, throw=False))
+        result["max_percentile_rank_shift"] = numpy.nanmax(shifts)
+        result["median_percentile_rank_shift"] = numpy.nanmedian(shifts)
+    return result
+
+
+def run(argv=sys.argv[1:]):
+    args = parser.parse_args(argv)
+    logging.basicConfig(level="INFO")
+
+    from .class2_affinity_predictor import Class2AffinityPredictor
+
+    predictor = Class2AffinityPredictor.load(
+        args.models_dir,
+        max_models=args.max_models,
+        optimization_level=0)
+
+    if args.data:
+        df = pandas.read_csv(args.data)
+        print("Read %d peptides from %s" % (len(df), args.data))
+    else:
+        alleles = predictor.supported_alleles
+        df = pandas.DataFrame({
+            "peptide": random_peptides(
+                args.num_random_peptides * len(alleles),
+                length=args.random_peptide_length),
+            "allele": numpy.repeat(alleles, args.num_random_peptides),
+        })
+        print("Using %d random peptides for %d alleles" % (
+            len(df), len(alleles)))
+
+    settings = list(itertools.product(
+        args.precision,
+        [False, True] if args.simulate_int8_weights else [False]))
+    results = []
+    for (precision, simulate_int8_weights) in settings:
+        reduced_predictor = predictor.with_inference_precision(
+            precision, simulate_int8_weights=simulate_int8_weights)
+        result = {
+            "precision": precision,
+            "simulate_int8_weights": simulate_int8_weights,
+        }
+        result.update(audit(
+            predictor,
+            reduced_predictor,
+            df.peptide.values,
+            df.allele.values))
+        results.append(result)
+    results_df = pandas.DataFrame(results)
+
+    print(results_df.to_string(index=False))
+    if args.out:
+        results_df.to_csv(args.out, index=False)
+        print("Wrote: %s" % args.out)
+
+    if args.max_log10_ic50_deviation is not None:
+        failed = results_df.loc[
+            results_df.max_log10_ic50_deviation > args.max_log10_ic50_deviation
+        ]
+        if len(failed) > 0:
+            print("Max log10 IC50 deviation exceeds %f for: %s" % (
+                args.max_log10_ic50_deviation,
+                ", ".join(
+                    "%s%s" % (
+                        row.precision,
+                        " (simulated int8 weights)"
+                        if row.simulate_int8_weights else "")
+                    for row in failed.itertuples())))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
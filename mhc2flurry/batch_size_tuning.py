@@ -0,0 +1,231 @@
+"""
+Selection of prediction batch sizes by measuring throughput, with results
+cached on disk per network architecture and host.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from os import environ
+from os.path import dirname, exists, join
+
+import numpy
+from appdirs import user_cache_dir
+
+DEFAULT_CANDIDATE_BATCH_SIZES = (256, 512, 1024, 2048, 4096, 8192, 16384)
+
+DEFAULT_MEMORY_CEILING_BYTES = int(environ.get(
+    "MHC2FLURRY_PREDICT_MEMORY_CEILING_BYTES", 2 ** 30))
+
+AUTOTUNE_PREDICT_BATCH_SIZE = environ.get(
+    "MHC2FLURRY_AUTOTUNE_PREDICT_BATCH_SIZE", "") not in ("", "0")
+
+
+def default_cache_path():
+    """
+    Path of the batch size cache file: the MHC2FLURRY_BATCH_SIZE_CACHE
+    environment variable if set (an empty value disables the disk cache), or
+    a file in the user cache directory.
+
+    Returns
+    -------
+    string or None
+    """
+    path = environ.get("MHC2FLURRY_BATCH_SIZE_CACHE")
+    if path is None:
+        path = join(
+            user_cache_dir("mhc2flurry", version="1"),
+            "predict_batch_sizes.json")
+    return path or None
+
+
+def host_key():
+    """
+    Identifier for the current host, used to key cached batch sizes.
+
+    Returns
+    -------
+    string
+    """
+    return "%s/%d" % (socket.gethostname(), os.cpu_count() or 1)
+
+
+def network_bytes_per_row(network):
+    """
+    Upper bound on the bytes of input and activations per input row of a
+    Keras network during prediction, assuming all layer outputs are live at
+    once.
+
+    Parameters
+    ----------
+    network : keras.Model
+
+    Returns
+    -------
+    int
+    """
+    total = 0
+    for layer in network.layers:
+        shapes = layer.output_shape
+        if not isinstance(shapes, list):
+            shapes = [shapes]
+        for shape in shapes:
+            total += int(numpy.prod([d or 1 for d in shape[1:]])) * 4
+    return max(total, 1)
+
+
+class BatchSizeTuner(object):
+    """
+    Chooses the prediction batch size with the highest measured throughput
+    among candidates that fit a memory ceiling.
+
+    Results are kept in memory and, if cache_path is given, in a JSON file
+    keyed by "<architecture hash>@<host>", so later processes on the same host
+    reuse them without measuring. The file is read once, on the first lookup.
+
+    Parameters
+    ----------
+    cache_path : string, optional
+        JSON file for tuned batch sizes
+    candidate_batch_sizes : list of int
+    memory_ceiling_bytes : int
+        Candidates whose estimated activation memory (see
+        `network_bytes_per_row`) exceeds this are not considered
+    """
+    def __init__(
+            self,
+            cache_path=None,
+            candidate_batch_sizes=DEFAULT_CANDIDATE_BATCH_SIZES,
+            memory_ceiling_bytes=DEFAULT_MEMORY_CEILING_BYTES):
+        self.cache_path = cache_path
+        self.candidate_batch_sizes = sorted(candidate_batch_sizes)
+        self.memory_ceiling_bytes = memory_ceiling_bytes
+        self.results = None
+        self.lock = threading.Lock()
+
+    def key(self, architecture_hash):
+        return "%s@%s" % (architecture_hash, host_key())
+
+    def read_cache(self):
+        """
+        Return the contents of the cache file, or an empty dict.
+        """
+        if not self.cache_path or not exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as fd:
+                return json.load(fd)
+        except (IOError, ValueError) as e:
+            logging.warning(
+                "Ignoring unreadable batch size cache %s: %s",
+                self.cache_path, e)
+            return {}
+
+    def write_cache(self, key, result):
+        """
+        Add a result to the cache file. The file is replaced atomically.
+        """
+        if not self.cache_path:
+            return
+        contents = self.read_cache()
+        contents[key] = result
+        directory = dirname(self.cache_path) or "."
+        if not exists(directory):
+            os.makedirs(directory)
+        (fd, temp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as fd:
+            json.dump(contents, fd, indent=1, sort_keys=True)
+        os.replace(temp_path, self.cache_path)
+
+    def lookup(self, architecture_hash):
+        """
+        Return the tuned batch size for an architecture on this host, if one
+        was tuned under the current memory ceiling.
+
+        Parameters
+        ----------
+        architecture_hash : string
+
+        Returns
+        -------
+        int or None
+        """
+        with self.lock:
+            if self.results is None:
+                self.results = self.read_cache()
+            result = self.results.get(self.key(architecture_hash))
+        if result is None or result.get(
+                "memory_ceiling_bytes") != self.memory_ceiling_bytes:
+            return None
+        return result["batch_size"]
+
+    def tune(self, architecture_hash, bytes_per_row, measure, num_rows=None):
+        """
+        Measure throughput for each candidate batch size and record the best.
+
+        Parameters
+        ----------
+        architecture_hash : string
+        bytes_per_row : int
+            See `network_bytes_per_row`
+        measure : function of (batch size, num rows) -> None
+            Runs a prediction of num_rows rows at the given batch size
+        num_rows : int, optional
+            Rows to predict per measurement. Defaults to twice the largest
+            candidate batch size.
+
+        Returns
+        -------
+        int : best batch size
+        """
+        candidates = [
+            batch_size for batch_size in self.candidate_batch_sizes
+            if batch_size * bytes_per_row <= self.memory_ceiling_bytes
+        ] or self.candidate_batch_sizes[:1]
+        if num_rows is None:
+            num_rows = 2 * max(candidates)
+
+        rows_per_second = {}
+        for batch_size in candidates:
+            # The first run includes one-time costs, e.g. tracing.
+            timings = []
+            for _ in range(3):
+                start = time.time()
+                measure(batch_size, num_rows)
+                timings.append(time.time() - start)
+            rows_per_second[batch_size] = num_rows / max(min(timings[1:]), 1e-9)
+
+        best = max(candidates, key=rows_per_second.get)
+        result = {
+            "batch_size": best,
+            "memory_ceiling_bytes": self.memory_ceiling_bytes,
+            "rows_per_second": dict(
+                (str(batch_size), value)
+                for (batch_size, value) in rows_per_second.items()),
+        }
+        key = self.key(architecture_hash)
+        with self.lock:
+            if self.results is None:
+                self.results = {}
+            self.results[key] = result
+            try:
+                self.write_cache(key, result)
+            except (IOError, OSError) as e:
+                logging.warning(
+                    "Could not write batch size cache %s: %s",
+                    self.cache_path, e)
+        logging.info(
+            "Tuned predict batch size for %s: %d (%s)",
+            key, best, ", ".join(
+                "%d: %0.0f rows/sec" % item
+                for item in sorted(rows_per_second.items())))
+        return best
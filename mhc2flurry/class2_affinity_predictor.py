@@ -15,18 +15,24 @@ import numpy
 from numpy.testing import assert_equal
 import pandas
 
-import mhcnames
-
+from .batch_size_tuning import AUTOTUNE_PREDICT_BATCH_SIZE
 from .class2_neural_network import Class2NeuralNetwork
 from .common import random_peptides, positional_frequency_matrix
-from .downloads import get_default_class1_models_dir
+from .downloads import get_default_class2_models_dir
 from .encodable_sequences import EncodableSequences
 from .percent_rank_transform import PercentRankTransform
 from .regression_target import to_ic50
 from .version import __version__
 from .ensemble_centrality import CENTRALITY_MEASURES
 from .allele_encoding import AlleleEncoding
+from .allele_encoding_pair import AlleleEncodingPair
 from .common import save_weights, load_weights
+from .common import (
+    allele_pair_name,
+    normalize_allele_name,
+    normalize_allele_names,
+    split_allele_pair,
+)
 
 
 # Default function for combining predictions across models in an ensemble.
@@ -182,6 +188,20 @@ class Class2AffinityPredictor(object):
         result.extend(self.class1_pan_allele_models)
         return result
 
+    @property
+    def num_pan_allele_models(self):
+        """
+        Number of pan-allele models in the ensemble, counting each member of
+        merged models (see `optimize`).
+
+        Returns
+        -------
+        int
+        """
+        if self.optimization_info.get("pan_models_merged", False):
+            return self.optimization_info["num_pan_models_merged"]
+        return len(self.class1_pan_allele_models)
+
     @classmethod
     def merge(cls, predictors):
         """
@@ -420,6 +440,15 @@ class Class2AffinityPredictor(object):
                 join(models_dir, "allele_sequences.csv"), index=False)
             logging.info("Wrote: %s", join(models_dir, "allele_sequences.csv"))
 
+            # Save the encoded allele sequences so loading can skip encoding.
+            for encoding_name in self.allele_amino_acid_encodings:
+                representations_path = self.allele_representations_path(
+                    models_dir, encoding_name)
+                if not exists(representations_path):
+                    self.master_allele_encoding.save_allele_representations(
+                        representations_path, encoding_name, dtype="float32")
+                    logging.info("Wrote: %s", representations_path)
+
         if self.allele_to_percent_rank_transform:
             percent_ranks_df = None
             for (allele, transform) in self.allele_to_percent_rank_transform.items():
@@ -460,18 +489,7 @@ class Class2AffinityPredictor(object):
         `Class2AffinityPredictor` instance
         """
         if models_dir is None:
-            try:
-                models_dir = get_default_class1_models_dir()
-            except RuntimeError as e:
-                # Fall back to the affinity predictor included in presentation
-                # predictor if possible.
-                from mhcflurry.class1_presentation_predictor import (
-                    Class1PresentationPredictor)
-                try:
-                    presentation_predictor = Class1PresentationPredictor.load()
-                    return presentation_predictor.affinity_predictor
-                except RuntimeError:
-                    raise e
+            models_dir = get_default_class2_models_dir()
 
         if optimization_level is None:
             optimization_level = OPTIMIZATION_LEVEL
@@ -488,7 +506,7 @@ class Class2AffinityPredictor(object):
             config = json.loads(row.config_json)
 
             # We will lazy-load weights when the network is used.
-            model = Class1NeuralNetwork.from_config(
+            model = Class2NeuralNetwork.from_config(
                 config,
                 weights_loader=partial(load_weights, abspath(weights_filename)))
             if row.allele == "pan-class1":
@@ -545,6 +563,15 @@ class Class2AffinityPredictor(object):
             allele_to_percent_rank_transform=allele_to_percent_rank_transform,
             provenance_string=provenance_string
         )
+        if allele_to_sequence is not None:
+            for encoding_name in result.allele_amino_acid_encodings:
+                representations_path = (
+                    Class2AffinityPredictor.allele_representations_path(
+                        models_dir, encoding_name))
+                if exists(representations_path):
+                    result.master_allele_encoding.load_allele_representations(
+                        representations_path, encoding_name, dtype="float32")
+
         if optimization_level >= 1:
             optimized = result.optimize()
             logging.info(
@@ -591,7 +618,7 @@ class Class2AffinityPredictor(object):
             provenance_string = self.provenance_string
             try:
                 self.class1_pan_allele_models = [
-                    Class1NeuralNetwork.merge(
+                    Class2NeuralNetwork.merge(
                         self.class1_pan_allele_models,
                         merge_method="concatenate")
                 ]
@@ -609,6 +636,81 @@ class Class2AffinityPredictor(object):
             return False
         return True
 
+    def autotune_predict_batch_sizes(self, force=False):
+        """
+        Tune the prediction batch size of each distinct network architecture
+        in this predictor (see `Class2NeuralNetwork.autotune_predict_batch_size`).
+
+        Tuned batch sizes are cached on disk per architecture and host, and
+        used by default by `Class2NeuralNetwork.predict`.
+
+        Parameters
+        ----------
+        force : boolean
+            If True, architectures with a cached batch size are tuned again
+
+        Returns
+        -------
+        dict of string -> int : batch size for each architecture hash
+        """
+        result = {}
+        for model in self.neural_networks:
+            architecture_hash = model.architecture_hash()
+            if architecture_hash in result:
+                continue
+            batch_size = None
+            if not force:
+                batch_size = model.BATCH_SIZE_TUNER.lookup(architecture_hash)
+            if batch_size is None:
+                batch_size = model.autotune_predict_batch_size()
+            result[architecture_hash] = batch_size
+        return result
+
+    def with_inference_precision(
+            self, precision, simulate_int8_weights=False):
+        """
+        Return a new predictor whose models compute at reduced precision. See
+        `Class2NeuralNetwork.with_inference_precision`.
+
+        Percentile rank calibrations are shared with this predictor, so
+        percentile ranks are computed against the float32 reference
+        distributions.
+
+        Parameters
+        ----------
+        precision : string
+            One of "float32", "float16", or "bfloat16"
+        simulate_int8_weights : boolean
+            Whether to round the Conv1D and Dense kernels to int8 values, to
+            check the accuracy of int8 quantization
+
+        Returns
+        -------
+        Class2AffinityPredictor
+        """
+        def convert(model):
+            return model.with_inference_precision(
+                precision, simulate_int8_weights=simulate_int8_weights)
+
+        result = Class2AffinityPredictor(
+            allele_to_allele_specific_models=dict(
+                (allele, [convert(model) for model in models])
+                for (allele, models)
+                in self.allele_to_allele_specific_models.items()),
+            class1_pan_allele_models=[
+                convert(model) for model in self.class1_pan_allele_models
+            ],
+            allele_to_sequence=self.allele_to_sequence,
+            allele_to_percent_rank_transform=(
+                self.allele_to_percent_rank_transform),
+            metadata_dataframes=self.metadata_dataframes,
+            provenance_string=self.provenance_string)
+        result.optimization_info = dict(self.optimization_info)
+        result.optimization_info["inference_precision"] = precision
+        result.optimization_info["simulate_int8_weights"] = (
+            simulate_int8_weights)
+        return result
+
     @staticmethod
     def model_name(allele, num):
         """
@@ -631,6 +733,43 @@ class Class2AffinityPredictor(object):
             num,
             random_string)
 
+    @staticmethod
+    def allele_representations_path(models_dir, encoding_name):
+        """
+        Generate the path to the file of encoded allele sequences for the
+        given amino acid encoding. The filename includes a hash of
+        allele_sequences.csv, so a stale file is never used.
+
+        Parameters
+        ----------
+        models_dir : string
+        encoding_name : string
+
+        Returns
+        -------
+        string
+        """
+        with open(join(models_dir, "allele_sequences.csv"), "rb") as fd:
+            allele_sequences_hash = hashlib.sha1(fd.read()).hexdigest()[:16]
+        return join(
+            models_dir,
+            "allele_representations_%s_%s.npy" % (
+                encoding_name, allele_sequences_hash))
+
+    @property
+    def allele_amino_acid_encodings(self):
+        """
+        Amino acid encodings used by the pan-allele models to represent
+        alleles.
+
+        Returns
+        -------
+        list of string
+        """
+        return sorted(set(
+            model.hyperparameters['allele_amino_acid_encoding']
+            for model in self.class1_pan_allele_models))
+
     @staticmethod
     def weights_path(models_dir, model_name):
         """
@@ -724,7 +863,7 @@ class Class2AffinityPredictor(object):
         list of `Class2NeuralNetwork`
         """
 
-        allele = mhcnames.normalize_allele_name(allele)
+        allele = normalize_allele_name(allele, raise_on_error=True)
         if allele not in self.allele_to_allele_specific_models:
             self.allele_to_allele_specific_models[allele] = []
 
@@ -737,8 +876,8 @@ class Class2AffinityPredictor(object):
             for round in sorted(set(train_rounds)):
                 round_mask = train_rounds > round
                 if round_mask.any():
-                    sub_encodable_peptides = EncodableSequences.create(
-                        encodable_peptides.sequences[round_mask])
+                    sub_encodable_peptides = encodable_peptides.subset(
+                        round_mask)
                     peptides_affinities_inequalities_per_round.append((
                         sub_encodable_peptides,
                         affinities[round_mask],
@@ -765,7 +904,7 @@ class Class2AffinityPredictor(object):
         for model_num in range(n_models):
             for (architecture_num, architecture_hyperparameters) in enumerate(
                     architecture_hyperparameters_list):
-                model = Class1NeuralNetwork(**architecture_hyperparameters)
+                model = Class2NeuralNetwork(**architecture_hyperparameters)
                 for round_num in range(n_rounds):
                     (round_peptides, round_affinities, round_inequalities) = (
                         peptides_affinities_inequalities_per_round[round_num]
@@ -859,7 +998,7 @@ class Class2AffinityPredictor(object):
         list of `Class2NeuralNetwork`
         """
 
-        alleles = pandas.Series(alleles).map(mhcnames.normalize_allele_name)
+        alleles = pandas.Series(normalize_allele_names(alleles))
         allele_encoding = AlleleEncoding(
             alleles,
             borrow_from=self.master_allele_encoding)
@@ -868,7 +1007,7 @@ class Class2AffinityPredictor(object):
         models = []
         for i in range(n_models):
             logging.info("Training model %d / %d", i + 1, n_models)
-            model = Class1NeuralNetwork(**architecture_hyperparameters)
+            model = Class2NeuralNetwork(**architecture_hyperparameters)
             model.fit(
                 encodable_peptides,
                 affinities,
@@ -946,14 +1085,22 @@ class Class2AffinityPredictor(object):
         numpy.array of float
         """
         if allele is not None:
-            normalized_allele = mhcnames.normalize_allele_name(allele)
+            normalized_allele = normalize_allele_name(allele)
+            if normalized_allele not in self.allele_to_percent_rank_transform:
+                # A beta allele (e.g. DRB1*07:01) may be calibrated under the
+                # name of the pair it implies.
+                pair = split_allele_pair(normalized_allele)
+                if pair is not None:
+                    normalized_allele = allele_pair_name(*pair)
             try:
                 transform = self.allele_to_percent_rank_transform[normalized_allele]
                 return transform.transform(affinities)
             except KeyError:
+                sequence = None
                 if self.allele_to_sequence:
+                    sequence = self.allele_to_sequence.get(normalized_allele)
+                if sequence is not None:
                     # See if we have information for an equivalent allele
-                    sequence = self.allele_to_sequence[normalized_allele]
                     other_alleles = [
                         other_allele for (other_allele, other_sequence)
                         in self.allele_to_sequence.items()
@@ -992,7 +1139,8 @@ class Class2AffinityPredictor(object):
             allele=None,
             throw=True,
             centrality_measure=DEFAULT_CENTRALITY_MEASURE,
-            model_kwargs={}):
+            model_kwargs={},
+            backend=None):
         """
         Predict nM binding affinities.
         
@@ -1007,6 +1155,9 @@ class Class2AffinityPredictor(object):
         Parameters
         ----------
         peptides : `EncodableSequences` or list of string
+            May be backed by an encoded peptide store (see
+            `EncodableSequences.load_store`). Stored encodings are used when
+            all peptides are predicted.
         alleles : list of string
         allele : string
         throw : boolean
@@ -1018,12 +1169,16 @@ class Class2AffinityPredictor(object):
             ensemble. Options include: mean, median, robust_mean.
         model_kwargs : dict
             Additional keyword arguments to pass to Class2NeuralNetwork.predict
+        backend : string
+            Inference backend for Class2NeuralNetwork.predict: "tensorflow"
+            or "numpy". Defaults to the MHC2FLURRY_PREDICT_BACKEND
+            environment variable, or "tensorflow".
 
         Returns
         -------
         numpy.array of predictions
         """
-        df = self.predict_to_dataframe(
+        return self.predict_arrays(
             peptides=peptides,
             alleles=alleles,
             allele=allele,
@@ -1031,58 +1186,211 @@ class Class2AffinityPredictor(object):
             include_percentile_ranks=False,
             include_confidence_intervals=False,
             centrality_measure=centrality_measure,
-            model_kwargs=model_kwargs
-        )
-        return df.prediction.values
+            model_kwargs=model_kwargs,
+            backend=backend,
+        )["prediction"]
 
-    def predict_to_dataframe(
+    def predict_matrix(
+            self,
+            peptides,
+            allele_pairs,
+            throw=True,
+            include_percentile_ranks=False,
+            centrality_measure=DEFAULT_CENTRALITY_MEASURE,
+            model_kwargs={}):
+        """
+        Predict nM binding affinities of every peptide for every allele pair.
+
+        Equivalent to calling `predict` on the cross product of peptides and
+        allele pairs, but the peptides are encoded and the first peptide
+        convolution of each pan-allele model is computed once per peptide
+        instead of once per (peptide, allele pair). See
+        `Class2NeuralNetwork.predict_matrix`.
+
+        Parameters
+        ----------
+        peptides : `EncodableSequences` or list of string
+        allele_pairs : list of string or (string, string) tuples
+            Allele pair names (e.g. the pairs for a genotype as given by
+            `common.make_allele_pairs`) or (alpha, beta) allele tuples
+        throw : boolean
+            If True, a ValueError will be raised in the case of unsupported
+            alleles. If False, a warning will be logged and the predictions
+            for the unsupported allele pairs will be NaN.
+        include_percentile_ranks : boolean
+            If True, also return percentile ranks, computed separately for
+            each allele pair (column).
+        centrality_measure : string or callable
+            Measure of central tendency to use to combine predictions in the
+            ensemble. Options include: mean, median, robust_mean.
+        model_kwargs : dict
+            Additional keyword arguments to pass to
+            Class2NeuralNetwork.predict_matrix
+
+        Returns
+        -------
+        numpy.array of shape (num peptides, num allele pairs), or a tuple of
+        this and an array of percentile ranks of the same shape if
+        include_percentile_ranks is True.
+        """
+        if not self.class1_pan_allele_models:
+            raise ValueError("predict_matrix requires pan-allele models")
+
+        peptides = EncodableSequences.create(peptides)
+        pair_names = [
+            split_allele_pair(pair) if isinstance(pair, str) else tuple(
+                normalize_allele_name(allele) for allele in pair)
+            for pair in allele_pairs
+        ]
+        supported = numpy.array([
+            pair is not None and all(
+                allele in self.allele_to_sequence for allele in pair)
+            for pair in pair_names
+        ], dtype=bool)
+        if not supported.all():
+            msg = "No sequences for allele pair(s): %s" % " ".join(
+                pair if isinstance(pair, str) else "-".join(
+                    str(allele) for allele in pair)
+                for (pair, is_supported) in zip(allele_pairs, supported)
+                if not is_supported)
+            logging.warning(msg)
+            if throw:
+                raise ValueError(msg)
+
+        predictions = numpy.full(
+            (len(peptides), len(pair_names), self.num_pan_allele_models),
+            numpy.nan,
+            dtype="float64")
+        if supported.any():
+            master_allele_encoding = self.master_allele_encoding
+            supported_pairs = [
+                pair for (pair, is_supported) in zip(pair_names, supported)
+                if is_supported
+            ]
+            merged = self.optimization_info.get("pan_models_merged")
+            if merged:
+                # The members of a merged network cannot be factored into
+                # allele and peptide parts, so the merged network is evaluated
+                # on every (peptide, allele pair) combination. Repeated
+                # peptides are encoded once (see Class2NeuralNetwork.predict).
+                assert len(self.class1_pan_allele_models) == 1
+                num_supported = len(supported_pairs)
+                rows = numpy.repeat(numpy.arange(len(peptides)), num_supported)
+                supported_pairs = supported_pairs * len(peptides)
+            allele_encoding_pair = AlleleEncodingPair(
+                AlleleEncoding(
+                    [pair[0] for pair in supported_pairs],
+                    borrow_from=master_allele_encoding),
+                AlleleEncoding(
+                    [pair[1] for pair in supported_pairs],
+                    borrow_from=master_allele_encoding))
+            if merged:
+                merged_predictions = self.class1_pan_allele_models[0].predict(
+                    peptides.subset(rows),
+                    allele_encoding_pair=allele_encoding_pair,
+                    output_index=None,
+                    **model_kwargs)
+                predictions[:, supported, :] = to_ic50(
+                    merged_predictions).reshape(
+                        (len(peptides), num_supported, -1))
+            else:
+                for (i, model) in enumerate(self.class1_pan_allele_models):
+                    predictions[:, supported, i] = to_ic50(
+                        model.predict_matrix(
+                            peptides,
+                            allele_encoding_pair=allele_encoding_pair,
+                            **model_kwargs))
+
+        if callable(centrality_measure):
+            centrality_function = centrality_measure
+        else:
+            centrality_function = CENTRALITY_MEASURES[centrality_measure]
+
+        logs = numpy.log(predictions)
+        result = numpy.exp(
+            centrality_function(logs.reshape((-1, logs.shape[2])))).reshape(
+                logs.shape[:2])
+
+        if not include_percentile_ranks:
+            return result
+
+        percentile_ranks = numpy.full(result.shape, numpy.nan)
+        if self.allele_to_percent_rank_transform:
+            for (j, pair) in enumerate(pair_names):
+                if supported[j]:
+                    percentile_ranks[:, j] = self.percentile_ranks(
+                        result[:, j],
+                        allele=allele_pair_name(*pair),
+                        throw=throw)
+        else:
+            warnings.warn("No percentile rank information available.")
+        return (result, percentile_ranks)
+
+    def predict_arrays(
             self,
             peptides,
             alleles=None,
             allele=None,
+            allele_codes=None,
             throw=True,
             include_individual_model_predictions=False,
-            include_percentile_ranks=True,
+            include_percentile_ranks=False,
             include_confidence_intervals=True,
             centrality_measure=DEFAULT_CENTRALITY_MEASURE,
-            model_kwargs={}):
+            out=None,
+            model_kwargs={},
+            backend=None):
         """
-        Predict nM binding affinities. Gives more detailed output than `predict`
-        method, including 5-95% prediction intervals.
-        
-        If multiple predictors are available for an allele, the predictions are
-        the geometric means of the individual model predictions.
-        
-        One of 'allele' or 'alleles' must be specified. If 'allele' is specified
-        all predictions will be for the given allele. If 'alleles' is specified
-        it must be the same length as 'peptides' and give the allele
-        corresponding to each peptide. 
-        
+        Predict nM binding affinities, working only with numpy arrays.
+
+        This is the implementation of `predict` and `predict_to_dataframe`,
+        without the overhead of building a DataFrame, for low-latency use.
+
+        One of 'allele' or 'alleles' must be specified, as in `predict`.
+        Alternatively, alleles may be given as integer codes: 'allele_codes'
+        gives for each peptide an index into 'alleles', which then lists the
+        distinct allele names (e.g. as returned by `pandas.factorize`). Each
+        distinct name is normalized only once.
+
         Parameters
         ----------
         peptides : `EncodableSequences` or list of string
         alleles : list of string
         allele : string
+        allele_codes : numpy.array of int, optional
         throw : boolean
             If True, a ValueError will be raised in the case of unsupported
             alleles or peptide lengths. If False, a warning will be logged and
             the predictions for the unsupported alleles or peptides will be NaN.
         include_individual_model_predictions : boolean
-            If True, the predictions of each individual model are included as
-            columns in the result DataFrame.
-        include_percentile_ranks : boolean, default True
-            If True, a "prediction_percentile" column will be included giving
-            the percentile ranks. If no percentile rank info is available,
-            this will be ignored with a warning.
+            If True, the result includes "individual_model_predictions", of
+            shape (num peptides, num models). The first
+            `num_pan_allele_models` columns are the pan-allele models.
+        include_percentile_ranks : boolean
+            If True, the result includes "prediction_percentile". If no
+            percentile rank info is available, this will be ignored with a
+            warning.
+        include_confidence_intervals : boolean
+            If True, the result includes "prediction_low" and
+            "prediction_high", the 5th and 95th percentiles of the individual
+            model predictions.
         centrality_measure : string or callable
             Measure of central tendency to use to combine predictions in the
             ensemble. Options include: mean, median, robust_mean.
+        out : dict of string -> numpy.array, optional
+            Preallocated arrays (e.g. for "prediction", "prediction_low",
+            "prediction_high", "prediction_percentile") to write results to,
+            each of length num peptides.
         model_kwargs : dict
             Additional keyword arguments to pass to Class2NeuralNetwork.predict
+        backend : string
+            Inference backend for Class2NeuralNetwork.predict: "tensorflow"
+            or "numpy". Defaults to the MHC2FLURRY_PREDICT_BACKEND
+            environment variable, or "tensorflow".
 
         Returns
         -------
-        `pandas.DataFrame` of predictions
+        dict of string -> numpy.array
         """
         if isinstance(peptides, string_types):
             raise TypeError("peptides must be a list or array, not a string")
@@ -1090,84 +1398,111 @@ class Class2AffinityPredictor(object):
             raise TypeError("alleles must be a list or array, not a string")
         if allele is None and alleles is None:
             raise ValueError("Must specify 'allele' or 'alleles'.")
+        if backend is not None:
+            model_kwargs = dict(model_kwargs, backend=backend)
 
         peptides = EncodableSequences.create(peptides)
-        df = pandas.DataFrame({
-            'peptide': peptides.sequences
-        }, copy=False)
+        num_peptides = len(peptides)
 
+        # Each row's code is an index into unique_alleles, the distinct
+        # normalized allele names (which may include None).
         if allele is not None:
-            if alleles is not None:
+            if alleles is not None or allele_codes is not None:
                 raise ValueError("Specify exactly one of allele or alleles")
-            df["allele"] = allele
-            normalized_allele = mhcnames.normalize_allele_name(allele)
-            df["normalized_allele"] = normalized_allele
-            unique_alleles = [normalized_allele]
+            unique_alleles = [
+                normalize_allele_name(allele, raise_on_error=throw)]
+            codes = numpy.zeros(num_peptides, dtype=int)
         else:
-            df["allele"] = numpy.array(alleles)
-            df["normalized_allele"] = df.allele.map(
-                mhcnames.normalize_allele_name)
-            unique_alleles = df.normalized_allele.unique()
-
-        if len(df) == 0:
-            # No predictions.
+            if allele_codes is None:
+                # Unlike numpy.unique, factorize supports a mix of strings
+                # and None.
+                (allele_codes, alleles) = pandas.factorize(
+                    pandas.Series(alleles, dtype=object))
+                missing = allele_codes == -1
+                if missing.any():
+                    alleles = list(alleles) + [None]
+                    allele_codes[missing] = len(alleles) - 1
+            elif len(allele_codes) != num_peptides:
+                raise ValueError(
+                    "Expected %d allele codes, got %d" % (
+                        num_peptides, len(allele_codes)))
+            allele_to_code = {}
+            distinct_codes = numpy.array([
+                allele_to_code.setdefault(name, len(allele_to_code))
+                for name in normalize_allele_names(
+                    alleles, raise_on_error=throw)
+            ], dtype=int)
+            unique_alleles = list(allele_to_code)
+            codes = distinct_codes[numpy.asarray(allele_codes, dtype=int)]
+
+        if out is None:
+            out = {}
+        result = {}
+
+        def set_result(name, values):
+            if name in out:
+                out[name][:] = values
+                values = out[name]
+            result[name] = values
+
+        if num_peptides == 0:
             logging.warning("Predicting for 0 peptides.")
-            empty_result = pandas.DataFrame(
-                columns=[
-                    'peptide',
-                    'allele',
-                    'prediction',
-                    'prediction_low',
-                    'prediction_high'
-                ])
-            return empty_result
+            for name in ["prediction", "prediction_low", "prediction_high"]:
+                set_result(name, numpy.empty(0, dtype="float64"))
+            return result
+
+        # Rows of each distinct allele.
+        order = codes.argsort(kind="stable")
+        rows_by_code = numpy.split(
+            order,
+            numpy.searchsorted(
+                codes[order], numpy.arange(1, len(unique_alleles))))
 
         (min_peptide_length, max_peptide_length) = (
             self.supported_peptide_lengths)
 
+        supported_peptide_length = None  # All peptide lengths are supported.
         if (peptides.min_length < min_peptide_length or
                 peptides.max_length > max_peptide_length):
-            # Only compute this if needed
-            all_peptide_lengths_supported = False
-            sequence_length = df.peptide.str.len()
-            df["supported_peptide_length"] = (
-                (sequence_length >= min_peptide_length) &
-                (sequence_length <= max_peptide_length))
-            if (~df.supported_peptide_length).any():
+            lengths = peptides.lengths
+            supported_peptide_length = (
+                (lengths >= min_peptide_length) &
+                (lengths <= max_peptide_length))
+            if not supported_peptide_length.all():
                 msg = (
                     "%d peptides have lengths outside of supported range [%d, %d]: "
                     "%s" % (
-                        (~df.supported_peptide_length).sum(),
+                        (~supported_peptide_length).sum(),
                         min_peptide_length,
                         max_peptide_length,
-                        str(df.loc[~df.supported_peptide_length].peptide.unique())))
+                        str(numpy.unique(
+                            peptides.subset(
+                                ~supported_peptide_length).sequences))))
                 logging.warning(msg)
                 if throw:
                     raise ValueError(msg)
-        else:
-            # Handle common case efficiently.
-            df["supported_peptide_length"] = True
-            all_peptide_lengths_supported = True
-
-        num_pan_models = (
-            len(self.class1_pan_allele_models)
-            if not self.optimization_info.get("pan_models_merged", False)
-            else self.optimization_info["num_pan_models_merged"])
+
+        num_pan_models = self.num_pan_allele_models
         max_single_allele_models = max(
             len(self.allele_to_allele_specific_models.get(allele, []))
             for allele in unique_alleles
         )
-        predictions_array = numpy.zeros(
-            shape=(df.shape[0], num_pan_models + max_single_allele_models),
+        predictions_array = numpy.full(
+            (num_peptides, num_pan_models + max_single_allele_models),
+            numpy.nan,
             dtype="float64")
-        predictions_array[:] = numpy.nan
 
         if self.class1_pan_allele_models:
             master_allele_encoding = self.master_allele_encoding
+            unique_pairs = [split_allele_pair(allele) for allele in unique_alleles]
+            supported_allele = numpy.array([
+                pair is not None and all(
+                    chain in self.allele_to_sequence for chain in pair)
+                for pair in unique_pairs
+            ], dtype=bool)
             unsupported_alleles = [
-                allele for allele in
-                df.normalized_allele.unique()
-                if allele not in self.allele_to_sequence
+                str(allele) for (allele, supported)
+                in zip(unique_alleles, supported_allele) if not supported
             ]
             if unsupported_alleles:
                 truncate_at = 100
@@ -1183,32 +1518,40 @@ class Class2AffinityPredictor(object):
                 logging.warning(msg)
                 if throw:
                     raise ValueError(msg)
-            mask = df.supported_peptide_length & (
-                ~df.normalized_allele.isin(unsupported_alleles))
-
+            mask = supported_allele[codes]
+            if supported_peptide_length is not None:
+                mask &= supported_peptide_length
+
+            unique_alphas = numpy.array([
+                pair[0] if pair is not None else None for pair in unique_pairs
+            ], dtype=object)
+            unique_betas = numpy.array([
+                pair[1] if pair is not None else None for pair in unique_pairs
+            ], dtype=object)
             row_slice = None
-            if mask is None or mask.all():
+            if mask.all():
                 row_slice = slice(None, None, None)  # all rows
-                masked_allele_encoding = AlleleEncoding(
-                    df.normalized_allele,
-                    borrow_from=master_allele_encoding)
-                masked_peptides = EncodableSequences.create(peptides)
-            elif mask.sum() > 0:
+                masked_codes = codes
+                masked_peptides = peptides
+            elif mask.any():
                 row_slice = mask
-                masked_allele_encoding = AlleleEncoding(
-                    df.loc[mask].normalized_allele,
-                    borrow_from=master_allele_encoding)
-                masked_peptides = EncodableSequences.create(
-                    peptides.sequences[mask])
+                masked_codes = codes[mask]
+                masked_peptides = peptides.subset(mask)
 
             if row_slice is not None:
-                # The following line is a performance optimization that may be
-                # revisited. It causes the neural network to set to include
-                # only the alleles actually being predicted for. This makes
-                # the network much smaller. However, subsequent calls to
+                # The compact() calls are a performance optimization that may
+                # be revisited. They cause the neural network to set to
+                # include only the alleles actually being predicted for. This
+                # makes the network much smaller. However, subsequent calls to
                 # predict will need to reset these weights, so there is a
                 # tradeoff.
-                masked_allele_encoding = masked_allele_encoding.compact()
+                masked_allele_encoding = AlleleEncodingPair(
+                    AlleleEncoding(
+                        unique_alphas[masked_codes],
+                        borrow_from=master_allele_encoding).compact(),
+                    AlleleEncoding(
+                        unique_betas[masked_codes],
+                        borrow_from=master_allele_encoding).compact())
 
                 if self.optimization_info.get("pan_models_merged"):
                     # Multiple pan-allele models have been merged into one
@@ -1216,20 +1559,22 @@ class Class2AffinityPredictor(object):
                     assert len(self.class1_pan_allele_models) == 1
                     predictions = self.class1_pan_allele_models[0].predict(
                         masked_peptides,
-                        allele_encoding=masked_allele_encoding,
+                        allele_encoding_pair=masked_allele_encoding,
                         output_index=None,
                         **model_kwargs)
-                    predictions_array[row_slice, :num_pan_models] = predictions
+                    predictions_array[row_slice, :num_pan_models] = to_ic50(
+                        predictions)
                 else:
                     for (i, model) in enumerate(self.class1_pan_allele_models):
-                        predictions_array[row_slice, i] = model.predict(
-                            masked_peptides,
-                            allele_encoding=masked_allele_encoding,
-                            **model_kwargs)
+                        predictions_array[row_slice, i] = to_ic50(
+                            model.predict(
+                                masked_peptides,
+                                allele_encoding_pair=masked_allele_encoding,
+                                **model_kwargs)[:, 0])
 
         if self.allele_to_allele_specific_models:
             unsupported_alleles = [
-                allele for allele in unique_alleles
+                str(allele) for allele in unique_alleles
                 if not self.allele_to_allele_specific_models.get(allele)
             ]
             if unsupported_alleles:
@@ -1242,30 +1587,26 @@ class Class2AffinityPredictor(object):
                 if throw:
                     raise ValueError(msg)
 
-            for allele in unique_alleles:
+            for (allele, rows) in zip(unique_alleles, rows_by_code):
                 models = self.allele_to_allele_specific_models.get(allele, [])
-                if len(unique_alleles) == 1 and all_peptide_lengths_supported:
-                    mask = None
-                else:
-                    mask = (
-                        (df.normalized_allele == allele) &
-                        df.supported_peptide_length).values
+                if supported_peptide_length is not None:
+                    rows = rows[supported_peptide_length[rows]]
 
-                row_slice = None
-                if mask is None or mask.all():
+                if len(rows) == num_peptides:
                     peptides_for_allele = peptides
                     row_slice = slice(None, None, None)
-                elif mask.sum() > 0:
-                    peptides_for_allele = EncodableSequences.create(
-                        df.loc[mask].peptide.values)
-                    row_slice = mask
-
-                if row_slice is not None:
-                    for (i, model) in enumerate(models):
-                        predictions_array[
-                            row_slice,
-                            num_pan_models + i,
-                        ] = model.predict(peptides_for_allele, **model_kwargs)
+                elif len(rows) > 0:
+                    peptides_for_allele = peptides.subset(rows)
+                    row_slice = rows
+                else:
+                    continue
+
+                for (i, model) in enumerate(models):
+                    predictions_array[
+                        row_slice,
+                        num_pan_models + i,
+                    ] = to_ic50(
+                        model.predict(peptides_for_allele, **model_kwargs)[:, 0])
 
         if callable(centrality_measure):
             centrality_function = centrality_measure
@@ -1273,35 +1614,142 @@ class Class2AffinityPredictor(object):
             centrality_function = CENTRALITY_MEASURES[centrality_measure]
 
         logs = numpy.log(predictions_array)
-        log_centers = centrality_function(logs)
-        df["prediction"] = numpy.exp(log_centers)
+        set_result("prediction", numpy.exp(centrality_function(logs)))
 
         if include_confidence_intervals:
-            df["prediction_low"] = numpy.exp(
-                numpy.nanpercentile(logs, 5.0, axis=1))
-            df["prediction_high"] = numpy.exp(
-                numpy.nanpercentile(logs, 95.0, axis=1))
+            set_result(
+                "prediction_low",
+                numpy.exp(numpy.nanpercentile(logs, 5.0, axis=1)))
+            set_result(
+                "prediction_high",
+                numpy.exp(numpy.nanpercentile(logs, 95.0, axis=1)))
 
         if include_individual_model_predictions:
+            set_result("individual_model_predictions", predictions_array)
+
+        if include_percentile_ranks:
+            if self.allele_to_percent_rank_transform:
+                percentiles = numpy.full(num_peptides, numpy.nan)
+                for (allele, rows) in zip(unique_alleles, rows_by_code):
+                    if allele is not None and len(rows) > 0:
+                        percentiles[rows] = self.percentile_ranks(
+                            result["prediction"][rows],
+                            allele=allele,
+                            throw=throw)
+                set_result("prediction_percentile", percentiles)
+            else:
+                warnings.warn("No percentile rank information available.")
+
+        return result
+
+    def predict_to_dataframe(
+            self,
+            peptides,
+            alleles=None,
+            allele=None,
+            throw=True,
+            include_individual_model_predictions=False,
+            include_percentile_ranks=True,
+            include_confidence_intervals=True,
+            centrality_measure=DEFAULT_CENTRALITY_MEASURE,
+            model_kwargs={},
+            backend=None):
+        """
+        Predict nM binding affinities. Gives more detailed output than `predict`
+        method, including 5-95% prediction intervals.
+        
+        If multiple predictors are available for an allele, the predictions are
+        the geometric means of the individual model predictions.
+        
+        One of 'allele' or 'alleles' must be specified. If 'allele' is specified
+        all predictions will be for the given allele. If 'alleles' is specified
+        it must be the same length as 'peptides' and give the allele
+        corresponding to each peptide. 
+        
+        This formats the results of `predict_arrays` as a DataFrame.
+
+        Parameters
+        ----------
+        peptides : `EncodableSequences` or list of string
+            May be backed by an encoded peptide store (see
+            `EncodableSequences.load_store`). Stored encodings are used when
+            all peptides are predicted.
+        alleles : list of string
+        allele : string
+        throw : boolean
+            If True, a ValueError will be raised in the case of unsupported
+            alleles or peptide lengths. If False, a warning will be logged and
+            the predictions for the unsupported alleles or peptides will be NaN.
+        include_individual_model_predictions : boolean
+            If True, the predictions of each individual model are included as
+            columns in the result DataFrame.
+        include_percentile_ranks : boolean, default True
+            If True, a "prediction_percentile" column will be included giving
+            the percentile ranks. If no percentile rank info is available,
+            this will be ignored with a warning.
+        centrality_measure : string or callable
+            Measure of central tendency to use to combine predictions in the
+            ensemble. Options include: mean, median, robust_mean.
+        model_kwargs : dict
+            Additional keyword arguments to pass to Class2NeuralNetwork.predict
+        backend : string
+            Inference backend for Class2NeuralNetwork.predict: "tensorflow"
+            or "numpy". Defaults to the MHC2FLURRY_PREDICT_BACKEND
+            environment variable, or "tensorflow".
+
+        Returns
+        -------
+        `pandas.DataFrame` of predictions
+        """
+        if isinstance(peptides, string_types):
+            raise TypeError("peptides must be a list or array, not a string")
+        peptides = EncodableSequences.create(peptides)
+        result = self.predict_arrays(
+            peptides,
+            alleles=alleles,
+            allele=allele,
+            throw=throw,
+            include_individual_model_predictions=(
+                include_individual_model_predictions),
+            include_percentile_ranks=include_percentile_ranks,
+            include_confidence_intervals=include_confidence_intervals,
+            centrality_measure=centrality_measure,
+            model_kwargs=model_kwargs,
+            backend=backend)
+
+        if len(peptides) == 0:
+            # No predictions.
+            empty_result = pandas.DataFrame(
+                columns=[
+                    'peptide',
+                    'allele',
+                    'prediction',
+                    'prediction_low',
+                    'prediction_high'
+                ])
+            return empty_result
+
+        df = pandas.DataFrame({
+            'peptide': peptides.sequences
+        }, copy=False)
+        df["allele"] = allele if allele is not None else numpy.array(alleles)
+        for name in ["prediction", "prediction_low", "prediction_high"]:
+            if name in result:
+                df[name] = result[name]
+
+        if include_individual_model_predictions:
+            predictions_array = result["individual_model_predictions"]
+            num_pan_models = self.num_pan_allele_models
             for i in range(num_pan_models):
                 df["model_pan_%d" % i] = predictions_array[:, i]
 
-            for i in range(max_single_allele_models):
+            for i in range(predictions_array.shape[1] - num_pan_models):
                 df["model_single_%d" % i] = predictions_array[
                     :, num_pan_models + i
                 ]
 
-        if include_percentile_ranks:
-            if self.allele_to_percent_rank_transform:
-                df["prediction_percentile"] = self.percentile_ranks(
-                    df.prediction,
-                    alleles=df.normalized_allele.values,
-                    throw=throw)
-            else:
-                warnings.warn("No percentile rank information available.")
-
-        del df["supported_peptide_length"]
-        del df["normalized_allele"]
+        if "prediction_percentile" in result:
+            df["prediction_percentile"] = result["prediction_percentile"]
         return df
 
     def calibrate_percentile_ranks(
@@ -1313,7 +1761,8 @@ class Class2AffinityPredictor(object):
             motif_summary=False,
             summary_top_peptide_fractions=[0.001],
             verbose=False,
-            model_kwargs={}):
+            model_kwargs={},
+            autotune_batch_size=AUTOTUNE_PREDICT_BATCH_SIZE):
         """
         Compute the cumulative distribution of ic50 values for a set of alleles
         over a large universe of random peptides, to enable taking quantiles
@@ -1345,6 +1794,11 @@ class Class2AffinityPredictor(object):
             Whether to print status updates to stdout
         model_kwargs : dict
             Additional low-level Class2NeuralNetwork.predict() kwargs.
+        autotune_batch_size : boolean
+            If True, prediction batch sizes not already tuned for this host
+            are tuned before calibrating (see `autotune_predict_batch_sizes`).
+            Defaults to True if the MHC2FLURRY_AUTOTUNE_PREDICT_BATCH_SIZE
+            environment variable is set.
 
         Returns
         ----------
@@ -1371,6 +1825,9 @@ class Class2AffinityPredictor(object):
 
         encoded_peptides = EncodableSequences.create(peptides)
 
+        if autotune_batch_size and 'batch_size' not in model_kwargs:
+            self.autotune_predict_batch_sizes()
+
         if motif_summary:
             frequency_matrices = []
             length_distributions = []
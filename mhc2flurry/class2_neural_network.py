@@ -1,5 +1,6 @@
 import time
 import collections
+import hashlib
 import json
 import weakref
 import itertools
@@ -7,6 +8,9 @@ import os
 import logging
 import random
 import math
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import partial
 
 import numpy
 import pandas
@@ -17,9 +21,22 @@ from .custom_loss import get_loss
 from .data_dependent_weights_initialization import lsuv_init
 from .random_negative_peptides import RandomNegativePeptides
 
+from . import amino_acid
 from .hyperparameters import HyperparameterDefaults
 from .encodable_sequences import EncodableSequences, EncodingError
 from .allele_encoding_pair import AlleleEncodingPair
+from .allele_representation_slots import AlleleRepresentationSlots
+from .batch_size_tuning import (
+    AUTOTUNE_PREDICT_BATCH_SIZE,
+    BatchSizeTuner,
+    default_cache_path,
+    network_bytes_per_row,
+)
+from .numpy_network import NumpyNetwork
+from .reduced_precision import (
+    network_json_with_precision,
+    simulate_int8_network_weights,
+)
 
 
 DEFAULT_PREDICT_BATCH_SIZE = 4096
@@ -30,6 +47,17 @@ if os.environ.get("MHCFLURRY_DEFAULT_PREDICT_BATCH_SIZE"):
     logging.info(
         "Configured default predict batch size: %d" % DEFAULT_PREDICT_BATCH_SIZE)
 
+DEFAULT_PREDICT_BACKEND = os.environ.get(
+    "MHC2FLURRY_PREDICT_BACKEND", "tensorflow")
+
+DEFAULT_ALLELE_SLOT_CAPACITY = None
+if os.environ.get("MHC2FLURRY_ALLELE_SLOT_CAPACITY"):
+    DEFAULT_ALLELE_SLOT_CAPACITY = int(os.environ[
+        "MHC2FLURRY_ALLELE_SLOT_CAPACITY"
+    ])
+    logging.info(
+        "Configured allele slot capacity: %d" % DEFAULT_ALLELE_SLOT_CAPACITY)
+
 
 class Class2NeuralNetwork(object):
     """
@@ -50,6 +78,8 @@ class Class2NeuralNetwork(object):
             'alignment_method': 'right_pad',
             'max_length': 50,
         },
+        peptide_input_format="vector",
+        peptide_padding_mask=False,
         peptide_convolutions=[
             {'kernel_size': 9, 'filters': 64, 'activation': "relu"},
             {'kernel_size': 16, 'filters': 16, 'activation': "relu"},
@@ -68,6 +98,35 @@ class Class2NeuralNetwork(object):
     """
     Hyperparameters (and their default values) that affect the neural network
     architecture.
+
+    The peptide_input_format hyperparameter gives how peptides are passed to
+    the network. It is one of:
+        "vector": peptides are vector encoded (e.g. BLOSUM62) on the host, as
+            specified by the peptide_encoding hyperparameter.
+        "index": peptides are passed as int8 amino acid indices and the vector
+            encoding is looked up in a non-trainable embedding layer within the
+            network. This requires much less memory.
+
+    If the peptide_padding_mask hyperparameter is True, the outputs of the
+    peptide convolutions are zeroed at padding positions and padding positions
+    are excluded from the global max pooling, so that predictions do not
+    depend on how much padding follows a peptide. The network then takes
+    peptides of any encoded length, and `predict` runs peptides grouped by
+    length with the padding trimmed (see `length_bucketed_network_predict`).
+    This requires peptide_input_format "index". X residues are treated as
+    padding.
+    """
+
+    LENGTH_BUCKET_SIZE = 8
+    """
+    Granularity of peptide lengths used by `length_bucketed_network_predict`
+    """
+
+    MASKED_PADDING_PENALTY = -1e4
+    """
+    Added to padding positions before global max pooling in networks with the
+    peptide_padding_mask hyperparameter. Small enough in magnitude to be
+    representable in float16.
     """
 
     compile_hyperparameter_defaults = HyperparameterDefaults(
@@ -171,8 +230,35 @@ class Class2NeuralNetwork(object):
         self.network_weights = None
         self.network_weights_loader = None
 
+        # Result of keras_network_cache_key(self.network_json), computed
+        # when first needed.
+        self.network_cache_key = None
+
         self.fit_info = []
 
+        # Runtime state for serving alleles from fixed-capacity allele
+        # representation tables (see enable_allele_slots). Not included in
+        # get_config().
+        self.allele_slot_capacity = DEFAULT_ALLELE_SLOT_CAPACITY
+        self.allele_slots = None
+        self.allele_representation_counters = collections.Counter()
+
+        # Held while the allele representations of this instance's network
+        # are set and used for prediction, see checkout_allele_network. Not
+        # serialized.
+        self.allele_representations_lock = threading.Lock()
+
+        # (network, dict of submodels of the network), see cached_subnetwork.
+        # Not serialized.
+        self.subnetworks = None
+
+        # (network weights, NumpyNetwork), see numpy_network. Not serialized.
+        self._numpy_network = None
+
+        # (network or network JSON, hash), see architecture_hash. Not
+        # serialized.
+        self._architecture_hash = None
+
     KERAS_MODELS_CACHE = {}
     """
     Process-wide keras model cache, a map from: architecture JSON string to
@@ -185,9 +271,337 @@ class Class2NeuralNetwork(object):
         Clear the Keras model cache.
         """
         klass.KERAS_MODELS_CACHE.clear()
+        with klass.KERAS_MODEL_POOLS_LOCK:
+            klass.KERAS_MODEL_POOLS.clear()
+
+    BATCH_SIZE_TUNER = BatchSizeTuner(cache_path=default_cache_path())
+    """
+    Process-wide `BatchSizeTuner` giving the default predict batch size, see
+    `predict_batch_size`
+    """
+
+    COMPILED_PREDICT_FUNCTIONS = weakref.WeakKeyDictionary()
+    """
+    Process-wide cache of compiled prediction functions, a map from: Keras
+    model to dict of batch size bucket -> tensorflow concrete function
+    """
+
+    MIN_COMPILED_BATCH_SIZE = 16
+    """
+    Smallest batch size bucket used by `compiled_network_predict`
+    """
 
     @classmethod
-    def borrow_cached_network(klass, network_json, network_weights):
+    def compiled_batch_size_bucket(klass, num_rows):
+        """
+        Return the batch size bucket for a batch of the given size: the next
+        power of two, at least MIN_COMPILED_BATCH_SIZE.
+
+        Parameters
+        ----------
+        num_rows : int
+
+        Returns
+        -------
+        int
+        """
+        bucket = klass.MIN_COMPILED_BATCH_SIZE
+        while bucket < num_rows:
+            bucket *= 2
+        return bucket
+
+    @classmethod
+    def compiled_network_predict(
+            klass, network, x_dict, batch_size=DEFAULT_PREDICT_BATCH_SIZE):
+        """
+        Evaluate a Keras model in inference mode without going through
+        `keras.Model.predict`, whose per-call setup dominates the latency of
+        small predictions.
+
+        The model is called through tensorflow functions traced once per
+        batch size bucket (see `compiled_batch_size_bucket`) and cached in
+        COMPILED_PREDICT_FUNCTIONS. Each batch is padded up to its bucket, so
+        the number of traces is logarithmic in batch_size.
+
+        Parameters
+        ----------
+        network : keras.models.Model
+        x_dict : dict of string -> numpy.array
+            Network inputs
+        batch_size : int
+            Maximum number of rows per call
+
+        Returns
+        -------
+        numpy.array, or list of numpy.array if the model has multiple outputs
+        """
+        configure_tensorflow()
+        import tensorflow as tf
+
+        functions = klass.COMPILED_PREDICT_FUNCTIONS.get(network)
+        if functions is None:
+            functions = klass.COMPILED_PREDICT_FUNCTIONS[network] = {}
+
+        # The traced functions reference the model weakly so that the cache
+        # does not keep the model alive.
+        network_ref = weakref.ref(network)
+        inputs = list(zip(network.input_names, network.inputs))
+        num_rows = len(x_dict[inputs[0][0]])
+        results = None
+        for start in range(0, num_rows, batch_size):
+            end = min(start + batch_size, num_rows)
+            bucket = klass.compiled_batch_size_bucket(end - start)
+            function = functions.get(bucket)
+            if function is None:
+                function = tf.function(
+                    lambda batch: network_ref()(batch, training=False)
+                ).get_concrete_function(dict(
+                    (name, tf.TensorSpec(
+                        shape=(bucket,) + tuple(tensor.shape[1:]),
+                        dtype=tensor.dtype,
+                        name=name))
+                    for (name, tensor) in inputs))
+                functions[bucket] = function
+
+            batch = {}
+            for (name, tensor) in inputs:
+                values = numpy.asarray(
+                    x_dict[name][start:end],
+                    dtype=tensor.dtype.as_numpy_dtype).reshape(
+                        (end - start,) + tuple(
+                            -1 if d is None else d
+                            for d in tensor.shape[1:]))
+                if bucket > end - start:
+                    values = numpy.concatenate([
+                        values,
+                        numpy.zeros(
+                            (bucket - (end - start),) + values.shape[1:],
+                            dtype=values.dtype),
+                    ])
+                batch[name] = values
+            outputs = function(batch)
+            if not isinstance(outputs, (list, tuple)):
+                outputs = [outputs]
+            outputs = [
+                output.numpy()[:end - start] for output in outputs
+            ]
+            if results is None:
+                results = [[] for _ in outputs]
+            for (result, output) in zip(results, outputs):
+                result.append(output)
+
+        if results is None:
+            return network.predict(x_dict, batch_size=batch_size)
+        results = [numpy.concatenate(result) for result in results]
+        if len(results) == 1:
+            (results,) = results
+        return results
+
+    KERAS_MODEL_POOLS = {}
+    """
+    Process-wide pools of idle keras models for concurrent use, a map from:
+    architecture cache key to list of (Keras model, existing network weights)
+    """
+
+    KERAS_MODEL_POOLS_LOCK = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def checkout_cached_network(
+            klass, network_json, network_weights, key=None):
+        """
+        Context manager giving exclusive use of a keras model with the
+        specified architecture and weights.
+
+        Unlike `borrow_cached_network`, this is thread safe: the model is
+        taken from a per-architecture pool (preferring a model that already
+        has the requested weights) or newly created if the pool is empty, and
+        returned to the pool on exit. Since tensorflow releases the GIL,
+        predictions can then run concurrently, e.g. from a
+        `concurrent.futures.ThreadPoolExecutor`.
+
+        Parameters
+        ----------
+        network_json : string of JSON
+        network_weights : list of numpy.array
+        key : string, optional
+            keras_network_cache_key(network_json), if already computed
+
+        Returns
+        -------
+        context manager giving a keras.models.Model
+        """
+        assert network_weights is not None
+        if key is None:
+            key = klass.keras_network_cache_key(network_json)
+
+        entry = None
+        with klass.KERAS_MODEL_POOLS_LOCK:
+            pool = klass.KERAS_MODEL_POOLS.setdefault(key, [])
+            for (i, (_, existing_weights)) in enumerate(pool):
+                if existing_weights is network_weights:
+                    entry = pool.pop(i)
+                    break
+            else:
+                if pool:
+                    entry = pool.pop()
+
+        if entry is None:
+            configure_tensorflow()
+            from tensorflow.keras.models import model_from_json
+            network = model_from_json(network_json)
+            existing_weights = None
+        else:
+            (network, existing_weights) = entry
+        if existing_weights is not network_weights:
+            network.set_weights(network_weights)
+
+        try:
+            yield network
+        finally:
+            with klass.KERAS_MODEL_POOLS_LOCK:
+                pool.append((network, network_weights))
+
+    def numpy_network(self):
+        """
+        Return a `NumpyNetwork` computing the same function as this model's
+        Keras network, without importing tensorflow if the network has not
+        been built (e.g. for a model loaded from disk).
+
+        Returns
+        -------
+        NumpyNetwork
+        """
+        if self._network is not None:
+            # The Keras network may since have been changed, e.g. by fit, so
+            # the result is not cached.
+            return NumpyNetwork(
+                self._network.to_json(), self._network.get_weights())
+        self.load_weights()
+        if (self._numpy_network is None or
+                self._numpy_network[0] is not self.network_weights):
+            self._numpy_network = (
+                self.network_weights,
+                NumpyNetwork(self.network_json, self.network_weights))
+        return self._numpy_network[1]
+
+    def architecture_hash(self):
+        """
+        Hash of the Keras architecture of this model's network (see
+        `keras_network_cache_key`).
+
+        Returns
+        -------
+        string
+        """
+        source = self._network if self._network is not None else (
+            self.network_json)
+        if self._architecture_hash is None or (
+                self._architecture_hash[0] is not source):
+            network_json = (
+                self.network_json if self._network is None
+                else self._network.to_json())
+            self._architecture_hash = (
+                source,
+                hashlib.sha1(
+                    self.keras_network_cache_key(network_json).encode()
+                ).hexdigest())
+        return self._architecture_hash[1]
+
+    def predict_batch_size(self, autotune=AUTOTUNE_PREDICT_BATCH_SIZE):
+        """
+        Batch size used by `predict` when none is specified: the batch size
+        tuned for this architecture on this host (see
+        `autotune_predict_batch_size`) if there is one, otherwise
+        DEFAULT_PREDICT_BATCH_SIZE.
+
+        Parameters
+        ----------
+        autotune : boolean
+            Whether to tune the batch size now if it has not been tuned.
+            Defaults to True if the MHC2FLURRY_AUTOTUNE_PREDICT_BATCH_SIZE
+            environment variable is set.
+
+        Returns
+        -------
+        int
+        """
+        if self._network is None and self.network_json is None:
+            return DEFAULT_PREDICT_BATCH_SIZE
+        batch_size = self.BATCH_SIZE_TUNER.lookup(self.architecture_hash())
+        if batch_size is None:
+            batch_size = (
+                self.autotune_predict_batch_size() if autotune
+                else DEFAULT_PREDICT_BATCH_SIZE)
+        return batch_size
+
+    def autotune_predict_batch_size(self, tuner=None):
+        """
+        Measure prediction throughput of this model's network at each
+        candidate batch size allowed by the tuner's memory ceiling, and
+        record the best for use by `predict_batch_size`.
+
+        Parameters
+        ----------
+        tuner : BatchSizeTuner, optional
+            Defaults to BATCH_SIZE_TUNER
+
+        Returns
+        -------
+        int : best batch size
+        """
+        if tuner is None:
+            tuner = self.BATCH_SIZE_TUNER
+        with self.checkout_network() as network:
+            x_dict = {}
+
+            def measure(batch_size, num_rows):
+                # Inputs are all zeros: throughput does not depend on values.
+                if not x_dict:
+                    for (name, tensor) in zip(
+                            network.input_names, network.inputs):
+                        x_dict[name] = numpy.zeros(
+                            (num_rows,) + tuple(tensor.shape[1:]),
+                            dtype=tensor.dtype.as_numpy_dtype)
+                network.predict(x_dict, batch_size=batch_size, verbose=0)
+
+            return tuner.tune(
+                self.architecture_hash(),
+                network_bytes_per_row(network),
+                measure)
+
+    @contextmanager
+    def checkout_network(self):
+        """
+        Context manager giving the keras model to use for prediction.
+
+        If this instance has its own network (e.g. a pan-allele model whose
+        allele representations have been set), that network is given.
+        Otherwise a model is checked out from the process-wide pool (see
+        `checkout_cached_network`), so that instances sharing an
+        architecture can predict concurrently from multiple threads.
+
+        Returns
+        -------
+        context manager giving a keras.models.Model
+        """
+        if self._network is not None or self.network_json is None:
+            yield self.network()
+            return
+
+        self.load_weights()
+        if self.network_cache_key is None:
+            self.network_cache_key = self.keras_network_cache_key(
+                self.network_json)
+        with self.checkout_cached_network(
+                self.network_json,
+                self.network_weights,
+                key=self.network_cache_key) as network:
+            yield network
+
+    @classmethod
+    def borrow_cached_network(
+            klass, network_json, network_weights, key=None):
         """
         Return a keras Model with the specified architecture and weights.
         As an optimization, when possible this will reuse architectures from a
@@ -197,19 +611,23 @@ class Class2NeuralNetwork(object):
         change later after subsequent calls to this method from other objects.
 
         If you're using this from a parallel implementation you'll need to
-        hold a lock while using the returned object.
+        hold a lock while using the returned object, or use
+        `checkout_cached_network` instead.
 
         Parameters
         ----------
         network_json : string of JSON
         network_weights : list of numpy.array
+        key : string, optional
+            keras_network_cache_key(network_json), if already computed
 
         Returns
         -------
         keras.models.Model
         """
         assert network_weights is not None
-        key = klass.keras_network_cache_key(network_json)
+        if key is None:
+            key = klass.keras_network_cache_key(network_json)
         if key not in klass.KERAS_MODELS_CACHE:
             # Cache miss.
             configure_tensorflow()
@@ -248,9 +666,13 @@ class Class2NeuralNetwork(object):
         if self._network is None and self.network_json is not None:
             self.load_weights()
             if borrow:
+                if self.network_cache_key is None:
+                    self.network_cache_key = self.keras_network_cache_key(
+                        self.network_json)
                 return self.borrow_cached_network(
                     self.network_json,
-                    self.network_weights)
+                    self.network_weights,
+                    key=self.network_cache_key)
             else:
                 configure_tensorflow()
                 from tensorflow import keras
@@ -269,6 +691,7 @@ class Class2NeuralNetwork(object):
         if self._network is not None:
             self.network_json = self._network.to_json()
             self.network_weights = self._network.get_weights()
+            self.network_cache_key = None
 
     @staticmethod
     def keras_network_cache_key(network_json):
@@ -311,6 +734,16 @@ class Class2NeuralNetwork(object):
         result['_network'] = None
         result['network_weights'] = None
         result['network_weights_loader'] = None
+        for key in [
+                'network_cache_key',
+                'allele_slot_capacity',
+                'allele_slots',
+                'allele_representation_counters',
+                'allele_representations_lock',
+                'subnetworks',
+                '_numpy_network',
+                '_architecture_hash']:
+            result.pop(key, None)
         return result
 
     @classmethod
@@ -374,6 +807,12 @@ class Class2NeuralNetwork(object):
         self.load_weights()
         result = dict(self.__dict__)
         result['_network'] = None
+        result['allele_slots'] = None
+        result['allele_representation_counters'] = collections.Counter()
+        result['allele_representations_lock'] = None
+        result['subnetworks'] = None
+        result['_numpy_network'] = None
+        result['_architecture_hash'] = None
         return result
 
     def __setstate__(self, state):
@@ -381,8 +820,9 @@ class Class2NeuralNetwork(object):
         Deserialize. For pickle support.
         """
         self.__dict__.update(state)
+        self.allele_representations_lock = threading.Lock()
 
-    def peptides_to_network_input(self, peptides):
+    def peptides_to_network_input(self, peptides, dtype="float32"):
         """
         Encode peptides to the fixed-length encoding expected by the neural
         network (which depends on the architecture).
@@ -390,14 +830,23 @@ class Class2NeuralNetwork(object):
         Parameters
         ----------
         peptides : EncodableSequences or list of string
+        dtype : numpy dtype
+            Type of the result for vector-encoded peptide input. Index-encoded
+            peptide input is always int8.
 
         Returns
         -------
         numpy.array
         """
         encoder = EncodableSequences.create(peptides)
-        encoded = encoder.variable_length_to_fixed_length_vector_encoding(
-            **self.hyperparameters['peptide_encoding'])
+        if self.hyperparameters['peptide_input_format'] == "index":
+            kwargs = dict(self.hyperparameters['peptide_encoding'])
+            del kwargs['vector_encoding_name']
+            encoded = encoder.variable_length_to_fixed_length_categorical(
+                dtype="int8", **kwargs)
+        else:
+            encoded = encoder.variable_length_to_fixed_length_vector_encoding(
+                dtype=dtype, **self.hyperparameters['peptide_encoding'])
         assert len(encoded) == len(peptides)
         return encoded
 
@@ -422,7 +871,7 @@ class Class2NeuralNetwork(object):
             return e.supported_peptide_lengths
         raise RuntimeError("peptides_to_network_input did not raise")
 
-    def allele_encoding_to_network_input(self, allele_encoding):
+    def allele_encoding_to_network_input(self, allele_encoding, dtype="float32"):
         """
         Encode alleles to the fixed-length encoding expected by the neural
         network (which depends on the architecture).
@@ -430,6 +879,8 @@ class Class2NeuralNetwork(object):
         Parameters
         ----------
         allele_encoding : AlleleEncoding
+        dtype : numpy dtype
+            Type of the allele representations
 
         Returns
         -------
@@ -439,9 +890,10 @@ class Class2NeuralNetwork(object):
 
         """
         return (
-            allele_encoding.indices,
+            numpy.asarray(allele_encoding.indices),
             allele_encoding.allele_representations(
-                self.hyperparameters['allele_amino_acid_encoding']))
+                self.hyperparameters['allele_amino_acid_encoding'],
+                dtype=dtype))
 
     @staticmethod
     def data_dependent_weights_initialization(
@@ -681,6 +1133,9 @@ class Class2NeuralNetwork(object):
         Parameters
         ----------
         peptides : EncodableSequences or list of string
+            May be backed by an encoded peptide store (see
+            `EncodableSequences.load_store`), in which case stored encodings
+            are used instead of re-encoding.
         
         affinities : list of float
             nM affinities. Must be same length of as peptides.
@@ -731,18 +1186,19 @@ class Class2NeuralNetwork(object):
             **RandomNegativePeptides.hyperparameter_defaults.subselect(
                 self.hyperparameters))
         random_negatives_planner.plan(
-            peptides=encodable_peptides.sequences,
+            peptides=encodable_peptides,
             affinities=affinities,
             alleles=(
-                allele_encoding_pair.allele_pairs if allele_encoding_pair
+                allele_encoding_pair.pair_codes if allele_encoding_pair
                 else None
             ),
             inequalities=inequalities)
 
         random_negatives_allele_encoding = None
         if allele_encoding_pair is not None:
-            random_negatives_allele_encoding = allele_encoding_pair.from_pairs(
-                random_negatives_planner.get_alleles())
+            random_negatives_allele_encoding = (
+                allele_encoding_pair.from_pair_codes(
+                    random_negatives_planner.get_alleles()))
         num_random_negatives = random_negatives_planner.get_total_count()
 
         y_values = numpy.array(affinities, copy=False)
@@ -1027,8 +1483,14 @@ class Class2NeuralNetwork(object):
             self,
             peptides,
             allele_encoding_pair=None,
-            batch_size=DEFAULT_PREDICT_BATCH_SIZE,
-            output_index=0):
+            batch_size=None,
+            output_index=0,
+            stream_block_size=None,
+            deduplicate=True,
+            split_allele_encoder=False,
+            compiled=False,
+            backend=DEFAULT_PREDICT_BACKEND,
+            length_buckets=True):
         """
         Predict affinities.
 
@@ -1039,36 +1501,462 @@ class Class2NeuralNetwork(object):
         allele_encoding : AlleleEncoding, optional
             Only required when this model is a pan-allele model
 
-        batch_size : int
-            batch_size passed to Keras
+        batch_size : int, optional
+            batch_size passed to Keras. Defaults to `predict_batch_size()`.
+
+        output_index : int or None
+            Network output to return. If None, all outputs are returned.
+            Ignored for networks with a single output.
+
+        stream_block_size : int, optional
+            If specified, peptides are encoded and predicted in blocks of
+            this many peptides (rounded up to a multiple of batch_size) and
+            the results written to a preallocated array. Peak memory is then
+            bounded by the block size instead of the number of peptides.
+            Since batches are the same as in the non-streaming path, so are
+            the predictions.
+
+        deduplicate : bool
+            If True, each distinct combination of peptide and alleles is
+            predicted once and the predictions expanded to all rows.
+
+        split_allele_encoder : bool
+            If True, the allele branch of the network is evaluated once per
+            distinct (alpha, beta) allele pair and its output gathered into
+            the rest of the network. See
+            `allele_encoder_and_peptide_scorer`.
+
+        compiled : bool
+            If True, the network is evaluated with `compiled_network_predict`
+            instead of `keras.Model.predict`. This reduces the latency of
+            small predictions.
+
+        backend : string
+            "tensorflow" to predict with Keras, or "numpy" to predict with
+            `NumpyNetwork`, which does not import tensorflow. The numpy
+            backend does not support split_allele_encoder or compiled.
+
+        length_buckets : bool
+            If True and the network has the peptide_padding_mask
+            hyperparameter (with right-padded peptides), peptides are
+            predicted in groups of similar length with the padding trimmed.
+            See `length_bucketed_network_predict`.
+
+        If allele slots are enabled (see `enable_allele_slots`), the allele
+        representations are written to slots instead of replacing the
+        allele representation tables.
+
         Returns
         -------
         numpy.array of affinity predictions
         """
+        peptides = EncodableSequences.create(peptides)
+        if batch_size is None:
+            batch_size = self.predict_batch_size()
+
+        x_dict = {}
+        if backend == "numpy":
+            if split_allele_encoder or compiled:
+                raise ValueError(
+                    "split_allele_encoder and compiled are not supported by "
+                    "the numpy backend")
+            network = self.numpy_network()
+            # The allele representations are passed to each call rather than
+            # set on the network, which may be shared by concurrent calls.
+            layer_weights = {}
+            if allele_encoding_pair is not None:
+                for (chain, encoding) in allele_encoding_pair.allele_encodings:
+                    (indices, representations) = (
+                        self.allele_encoding_to_network_input(encoding))
+                    layer_weights["%s_allele_representation" % chain] = [
+                        representations.reshape((len(representations), -1))
+                    ]
+                    x_dict["%s_allele" % chain] = indices
+            network_context = nullcontext(network)
+        elif backend == "tensorflow":
+            if allele_encoding_pair is not None:
+                network_context = self.checkout_allele_network(
+                    allele_encoding_pair, x_dict)
+            else:
+                network_context = self.checkout_network()
+        else:
+            raise ValueError("Unsupported backend: %s" % backend)
+
+        with network_context as network:
+            allele_vectors = None
+            if split_allele_encoder and allele_encoding_pair is not None:
+                (allele_encoder, network) = (
+                    self.allele_encoder_and_peptide_scorer())
+                (pair_rows, pair_index) = self.unique_input_rows(None, x_dict)
+                allele_vectors = allele_encoder.predict(
+                    dict(
+                        (key, value[pair_rows])
+                        for (key, value) in x_dict.items()),
+                    batch_size=batch_size)
+                x_dict = {'allele_pair': pair_index}
+
+            if compiled:
+                network_predict = partial(
+                    self.compiled_network_predict, network)
+            elif backend == "numpy":
+                network_predict = partial(
+                    network.predict, layer_weights=layer_weights)
+            else:
+                network_predict = network.predict
+
+            if length_buckets and self.hyperparameters[
+                    'peptide_padding_mask'] and self.hyperparameters[
+                        'peptide_encoding']['alignment_method'] == 'right_pad':
+                network_predict = partial(
+                    self.length_bucketed_network_predict, network_predict)
+
+            inverse = None
+            if deduplicate and peptides.store is None and len(peptides) > 0:
+                # Store-backed peptides are not deduplicated, since their
+                # encodings are already computed.
+                (rows, inverse) = self.unique_input_rows(peptides, x_dict)
+                if len(rows) < len(peptides):
+                    # The distinct peptides (and their encodings, through the
+                    # encoding cache) are shared by all calls with the same
+                    # EncodableSequences, e.g. across ensemble members. The
+                    # peptides of the distinct rows are gathered from them.
+                    (unique_peptides, peptide_inverse) = peptides.unique()
+                    peptides = unique_peptides.subset(peptide_inverse[rows])
+                    x_dict = dict(
+                        (key, value[rows]) for (key, value) in x_dict.items())
+                else:
+                    inverse = None
+
+            if allele_vectors is not None:
+                pair_index = x_dict['allele_pair']
+
+            streaming = stream_block_size is not None and len(peptides) > 0
+            if streaming:
+                block_size = int(
+                    math.ceil(stream_block_size / batch_size)) * batch_size
+                predictions = None
+                for (start, end, block_x_dict) in self.network_input_blocks(
+                        peptides, x_dict, block_size):
+                    if allele_vectors is not None:
+                        block_x_dict['allele_dense_final'] = allele_vectors[
+                            block_x_dict.pop('allele_pair')]
+                    block_predictions = network_predict(
+                        block_x_dict, batch_size=batch_size)
+                    if not isinstance(block_predictions, list):
+                        block_predictions = [block_predictions]
+                    if predictions is None:
+                        predictions = [
+                            numpy.empty(
+                                (len(peptides),) + values.shape[1:],
+                                dtype="float64")
+                            for values in block_predictions
+                        ]
+                    for (result, values) in zip(
+                            predictions, block_predictions):
+                        result[start:end] = values
+                if len(predictions) == 1:
+                    (predictions,) = predictions
+            else:
+                if inverse is not None:
+                    x_dict['peptide'] = self.peptides_to_network_input(
+                        unique_peptides)[peptide_inverse[rows]]
+                else:
+                    x_dict['peptide'] = self.peptides_to_network_input(
+                        peptides)
+                if allele_vectors is not None:
+                    x_dict['allele_dense_final'] = allele_vectors[
+                        x_dict.pop('allele_pair')]
+                predictions = network_predict(x_dict, batch_size=batch_size)
+            if allele_vectors is not None:
+                # The peptide scorer has only the affinity output. The allele
+                # branch output is gathered from the allele vectors.
+                predictions = [predictions]
+                if output_index != 0:
+                    predictions.append(allele_vectors[pair_index])
+            if inverse is not None:
+                if isinstance(predictions, list):
+                    predictions = [values[inverse] for values in predictions]
+                else:
+                    predictions = predictions[inverse]
+            if output_index is not None and isinstance(predictions, list):
+                predictions = predictions[output_index]
+            return numpy.asarray(predictions, dtype="float64")
+
+    @contextmanager
+    def checkout_allele_network(self, allele_encoding_pair, x_dict):
+        """
+        Context manager setting the allele representations for the given
+        allele encodings, adding the allele inputs to x_dict, and giving the
+        keras model to use for prediction.
 
-        x_dict = {
-            'peptide': self.peptides_to_network_input(peptides)
+        The allele representations are part of this instance's network, so
+        `allele_representations_lock` is held until exit. Concurrent
+        predictions for different alleles from multiple threads then wait for
+        each other instead of overwriting each other's representations.
+
+        Parameters
+        ----------
+        allele_encoding_pair : AlleleEncodingPair
+        x_dict : dict of string -> numpy.array
+            Network inputs, updated in place
+
+        Returns
+        -------
+        context manager giving a keras.models.Model
+        """
+        with self.allele_representations_lock:
+            x_dict.update(self.allele_network_input(allele_encoding_pair))
+            with self.checkout_network() as network:
+                yield network
+
+    def allele_network_input(self, allele_encoding_pair):
+        """
+        Set the allele representations for the given allele encodings (or
+        write them to slots, if enabled) and return the allele inputs of the
+        network.
+
+        Parameters
+        ----------
+        allele_encoding_pair : AlleleEncodingPair
+
+        Returns
+        -------
+        dict of string -> numpy.array of int
+        """
+        if self.allele_slot_capacity:
+            return self.allele_slot_network_input(allele_encoding_pair)
+
+        (alpha_allele_encoding_input, alpha_allele_representations) = (
+            self.allele_encoding_to_network_input(
+                allele_encoding_pair.alpha_allele_encoding))
+        (beta_allele_encoding_input, beta_allele_representations) = (
+            self.allele_encoding_to_network_input(
+                allele_encoding_pair.beta_allele_encoding))
+        self.set_allele_representations(
+            alpha_allele_representations, beta_allele_representations)
+        return {
+            'alpha_allele': alpha_allele_encoding_input,
+            'beta_allele': beta_allele_encoding_input,
         }
 
-        if allele_encoding_pair is not None:
-            (alpha_allele_encoding_input, alpha_allele_representations) = (
-                self.allele_encoding_to_network_input(
-                    allele_encoding_pair.alpha_allele_encoding))
-            (beta_allele_encoding_input, beta_allele_representations) = (
-                self.allele_encoding_to_network_input(
-                    allele_encoding_pair.beta_allele_encoding))
+    def predict_matrix(
+            self,
+            peptides,
+            allele_encoding_pair,
+            batch_size=4 * DEFAULT_PREDICT_BATCH_SIZE):
+        """
+        Predict affinities for every combination of peptide and allele pair.
 
-            x_dict['alpha_allele'] = alpha_allele_encoding_input
-            x_dict['beta_allele'] = beta_allele_encoding_input
-            self.set_allele_representations(
-                alpha_allele_representations, beta_allele_representations)
-            network = self.network()
+        The allele branch of the network is evaluated once per allele pair,
+        and the peptide encoding and first peptide convolution (which do not
+        depend on the alleles) once per distinct peptide. The first
+        convolution output is then broadcast against the allele vectors
+        before the rest of the network is applied, in batches of about
+        `batch_size` (peptide, allele pair) combinations.
+
+        Parameters
+        ----------
+        peptides : EncodableSequences or list of string
+        allele_encoding_pair : AlleleEncodingPair
+            The allele pairs, one per column of the result
+        batch_size : int
+            Number of (peptide, allele pair) combinations per batch. Each
+            batch is a single Keras call, so larger batches amortize the
+            per-call overhead.
+
+        Returns
+        -------
+        numpy.array of shape (num peptides, num allele pairs)
+        """
+        peptides = EncodableSequences.create(peptides)
+        num_pairs = len(allele_encoding_pair)
+        if len(peptides) == 0 or num_pairs == 0:
+            return numpy.empty((len(peptides), num_pairs), dtype="float64")
+
+        if peptides.store is None:
+            (unique_peptides, inverse) = peptides.unique()
         else:
-            network = self.network(borrow=True)
-        predictions = network.predict(x_dict, batch_size=batch_size)
-        if output_index is not None:
-            predictions = predictions[output_index]
-        return numpy.array(predictions, dtype="float64")
+            (unique_peptides, inverse) = (peptides, None)
+
+        result = numpy.empty((len(unique_peptides), num_pairs), dtype="float64")
+        # The allele representations are part of this instance's network, see
+        # checkout_allele_network.
+        with self.allele_representations_lock:
+            # Setting the allele representations may replace the network, so
+            # this is done before getting its subnetworks.
+            allele_input = self.allele_network_input(allele_encoding_pair)
+            (allele_encoder, _) = self.allele_encoder_and_peptide_scorer()
+            allele_vectors = allele_encoder.predict(
+                allele_input, batch_size=batch_size)
+            if self.hyperparameters['peptide_padding_mask']:
+                # The rest of the network also needs the padding mask, which
+                # is computed from the peptide input.
+                features_name = "peptide_first_convolution_masked"
+                scorer_input_names = [
+                    features_name, "allele_dense_final", "peptide"]
+            else:
+                features_name = "peptide_first_convolution"
+                scorer_input_names = [features_name, "allele_dense_final"]
+            peptide_featurizer = self.cached_subnetwork(
+                ["peptide"], features_name)
+            merged_scorer = self.cached_subnetwork(
+                scorer_input_names, "output")
+
+            block_size = max(1, batch_size // num_pairs)
+            for (start, end, block) in unique_peptides.iter_blocks(block_size):
+                encoded = self.peptides_to_network_input(block)
+                features = peptide_featurizer.predict_on_batch(
+                    {'peptide': encoded})
+                block_x_dict = {
+                    features_name: numpy.repeat(features, num_pairs, axis=0),
+                    'allele_dense_final': numpy.tile(
+                        allele_vectors, (end - start, 1)),
+                }
+                if 'peptide' in scorer_input_names:
+                    block_x_dict['peptide'] = numpy.repeat(
+                        encoded, num_pairs, axis=0)
+                predictions = merged_scorer.predict_on_batch(block_x_dict)
+                result[start:end] = predictions.reshape(
+                    (end - start, num_pairs))
+
+        if inverse is not None:
+            result = result[inverse]
+        return result
+
+    @classmethod
+    def length_bucketed_network_predict(
+            klass, network_predict, x_dict, batch_size):
+        """
+        Evaluate a network with the peptide_padding_mask hyperparameter on
+        index-encoded, right-padded peptides, grouping rows by peptide length
+        (rounded up to a multiple of LENGTH_BUCKET_SIZE) and trimming the
+        padding of each group. Since the network ignores padding, the
+        predictions are the same as for the untrimmed input.
+
+        Parameters
+        ----------
+        network_predict : function
+            E.g. `keras.Model.predict`
+        x_dict : dict of string -> numpy.array
+            Network inputs, including "peptide"
+        batch_size : int
+
+        Returns
+        -------
+        numpy.array, or list of numpy.array if the network has multiple
+        outputs
+        """
+        peptide = x_dict['peptide']
+        max_length = peptide.shape[1]
+        not_padding = peptide != amino_acid.AMINO_ACID_INDEX["X"]
+
+        # Position after the last non-padding residue.
+        lengths = max_length - numpy.argmax(not_padding[:, ::-1], axis=1)
+        lengths[~not_padding.any(axis=1)] = 0
+        bucket_lengths = numpy.minimum(
+            numpy.maximum(
+                numpy.ceil(lengths / klass.LENGTH_BUCKET_SIZE).astype(int),
+                1) * klass.LENGTH_BUCKET_SIZE,
+            max_length)
+
+        results = None
+        for bucket_length in numpy.unique(bucket_lengths):
+            rows = numpy.where(bucket_lengths == bucket_length)[0]
+            bucket_x_dict = dict(
+                (key, value[rows]) for (key, value) in x_dict.items())
+            bucket_x_dict['peptide'] = bucket_x_dict['peptide'][
+                :, :bucket_length]
+            predictions = network_predict(bucket_x_dict, batch_size=batch_size)
+            if not isinstance(predictions, list):
+                predictions = [predictions]
+            if results is None:
+                results = [
+                    numpy.empty(
+                        (len(peptide),) + values.shape[1:],
+                        dtype=values.dtype)
+                    for values in predictions
+                ]
+            for (result, values) in zip(results, predictions):
+                result[rows] = values
+
+        if results is None:
+            return network_predict(x_dict, batch_size=batch_size)
+        if len(results) == 1:
+            (results,) = results
+        return results
+
+    @staticmethod
+    def unique_input_rows(peptides, x_dict):
+        """
+        Find the distinct combinations of peptide and other network inputs.
+
+        Parameters
+        ----------
+        peptides : EncodableSequences or None
+            If None, only the other network inputs are considered
+        x_dict : dict of string -> numpy.array of int
+            Other network inputs, e.g. allele indices, one value per peptide
+
+        Returns
+        -------
+        (numpy.array of int, numpy.array of int) tuple
+
+        The position of the first occurrence of each distinct combination,
+        and for each input row the index of its combination in the first
+        array.
+        """
+        if peptides is not None:
+            (_, key) = peptides.unique()
+            key = key.astype(numpy.int64)
+        else:
+            key = numpy.zeros(
+                len(next(iter(x_dict.values()))), dtype=numpy.int64)
+        for name in sorted(x_dict):
+            values = numpy.asarray(x_dict[name], dtype=numpy.int64)
+            key = key * (values.max() + 1) + values
+        (inverse, unique_keys) = pandas.factorize(key)
+        rows = numpy.empty(len(unique_keys), dtype=numpy.int64)
+        rows[inverse[::-1]] = numpy.arange(len(key))[::-1]
+        return (rows, inverse)
+
+    def network_input_blocks(self, peptides, x_dict, block_size):
+        """
+        Generate network inputs for consecutive blocks of peptides.
+
+        Parameters
+        ----------
+        peptides : EncodableSequences
+        x_dict : dict of string -> numpy.array
+            Non-peptide network inputs (e.g. allele indices) for all peptides.
+            These are sliced to match each block.
+        block_size : int
+
+        Returns
+        -------
+        generator of (int, int, dict) tuples
+
+        Each tuple gives the start and end positions of a block and the
+        network inputs for the block.
+        """
+        for (start, end, block) in peptides.iter_blocks(block_size):
+            block_x_dict = {
+                'peptide': self.peptides_to_network_input(block),
+            }
+            for (key, value) in x_dict.items():
+                block_x_dict[key] = value[start:end]
+            yield (start, end, block_x_dict)
+
+    MERGE_SHARED_LAYER_NAMES = [
+        "alpha_allele_representation",
+        "beta_allele_representation",
+        "peptide_amino_acid_representation",
+        "peptide_padding_mask",
+        "peptide_padding_penalty",
+    ]
+    """
+    Layers (with weights) shared by all members of a merged pan-allele
+    ensemble, see `merge`
+    """
 
     @classmethod
     def merge(cls, models, merge_method="average"):
@@ -1078,6 +1966,12 @@ class Class2NeuralNetwork(object):
         Only certain neural network architectures support merging. Others will
         result in a NotImplementedError.
 
+        For pan-allele networks (see `make_network`), the inputs and the
+        allele and peptide amino acid representation layers are shared by all
+        members, which must therefore have the same representations. The
+        remaining layers of each member form a tower, and the tower outputs
+        are merged, so the whole ensemble is evaluated in one call.
+
         Parameters
         ----------
         models : list of Class2NeuralNetwork
@@ -1092,7 +1986,6 @@ class Class2NeuralNetwork(object):
 
         """
         configure_tensorflow()
-        from tensorflow.keras import backend as K
         from tensorflow.keras.layers import Input, average, add, concatenate
         from tensorflow.keras.models import Model
 
@@ -1119,79 +2012,71 @@ class Class2NeuralNetwork(object):
             for network in networks
         ]
 
-        pan_allele_layer_initial_names = [
-            'allele', 'peptide', 'allele_representation', 'flattened_0',
-            'allele_flat', 'allele_peptide_merged', 'dense_0', 'dropout_0',
-            #'dense_1', 'dropout_1', 'output',
-        ]
-        pan_allele_layer_final_names = [
-            'output'
-        ]
-
-        def startswith(lst, prefix):
-            return lst[:len(prefix)] == prefix
-
-        def endswith(lst, suffix):
-            return lst[-len(suffix):] == suffix
-
-        if all(startswith(names, pan_allele_layer_initial_names) and
-                endswith(names, pan_allele_layer_final_names)
+        if all(
+                "alpha_allele_representation" in names and
+                "beta_allele_representation" in names and
+                "output" in names
                 for names in layer_names):
-
-            # Merging an ensemble of pan-allele architectures
-            network = networks[0]
-            peptide_input = Input(
-                shape=tuple(int(x) for x in K.int_shape(network.inputs[0])[1:]),
-                dtype='float32',
-                name='peptide')
-            allele_input = Input(
-                shape=(1,),
-                dtype='float32',
-                name='allele')
-
-            allele_embedding = network.get_layer(
-                "allele_representation")(allele_input)
-            peptide_flat = network.get_layer("flattened_0")(peptide_input)
-            allele_flat = network.get_layer("allele_flat")(allele_embedding)
-            allele_peptide_merged = network.get_layer("allele_peptide_merged")(
-                [peptide_flat, allele_flat])
-
+            # Merging an ensemble of pan-allele architectures. The inputs and
+            # the (non-trainable) allele representation layers are shared;
+            # the remaining layers of each network form a separate tower.
+            for name in cls.MERGE_SHARED_LAYER_NAMES:
+                if name not in layer_names[0]:
+                    continue
+                weights = networks[0].get_layer(name).get_weights()
+                for network in networks[1:]:
+                    other_weights = network.get_layer(name).get_weights()
+                    if len(other_weights) != len(weights) or not all(
+                            w1.shape == w2.shape and numpy.array_equal(
+                                w1, w2, equal_nan=True)
+                            for (w1, w2) in zip(weights, other_weights)):
+                        raise NotImplementedError(
+                            "Can't merge networks with different weights for "
+                            "shared layer %s" % name)
+
+            shared = {}
+            for layer_config in networks[0].get_config()['layers']:
+                name = layer_config['name']
+                layer = networks[0].get_layer(name)
+                inbound_names = [
+                    item[0]
+                    for node in layer_config['inbound_nodes']
+                    for item in node
+                ]
+                if not inbound_names:
+                    shared[name] = Input(
+                        shape=layer.output.shape[1:],
+                        dtype=layer.output.dtype,
+                        name=name)
+                elif all(inbound in shared for inbound in inbound_names) and (
+                        name in cls.MERGE_SHARED_LAYER_NAMES or
+                        not layer.weights):
+                    layer_inputs = [shared[inbound] for inbound in inbound_names]
+                    shared[name] = layer(
+                        layer_inputs if len(layer_inputs) > 1
+                        else layer_inputs[0])
 
             sub_networks = []
             for (i, network) in enumerate(networks):
-                layers = network.layers[
-                    pan_allele_layer_initial_names.index(
-                        "allele_peptide_merged") + 1:
-                ]
-                for layer in layers:
-                    new_name = layer.name + "_%d" % i
-                    layer._name = new_name
-                    assert layer.name == new_name, (layer.name, new_name)
-
-                node = allele_peptide_merged
-                layer_name_to_new_node = {
-                    "allele_peptide_merged": allele_peptide_merged,
-                }
-                for layer in layers:
-                    assert layer.name not in layer_name_to_new_node
-                    input_layer_names = []
-                    for inbound_node in layer._inbound_nodes:
-                        try:
-                            inbound_layers = list(inbound_node.inbound_layers)
-                        except TypeError:
-                            inbound_layers = [inbound_node.inbound_layers]
-                        for inbound_layer in inbound_layers:
-                            input_layer_names.append(inbound_layer.name)
-                    input_nodes = [
-                        layer_name_to_new_node[name]
-                        for name in input_layer_names
-                    ]
-                    if len(input_nodes) == 1:
-                        node = layer(input_nodes[0])
-                    else:
-                        node = layer(input_nodes)
-                    layer_name_to_new_node[layer.name] = node
-                sub_networks.append(node)
+                tensors = dict(shared)
+                for layer_config in network.get_config()['layers']:
+                    name = layer_config['name']
+                    if name in tensors:
+                        continue
+                    (inbound_node,) = layer_config['inbound_nodes']
+                    layer_inputs = [tensors[item[0]] for item in inbound_node]
+
+                    # Copy the layer under a new name, leaving the original
+                    # network intact.
+                    layer = network.get_layer(name)
+                    layer_config = dict(layer.get_config())
+                    layer_config['name'] = "%s_%d" % (name, i)
+                    new_layer = layer.__class__.from_config(layer_config)
+                    tensors[name] = new_layer(
+                        layer_inputs if len(layer_inputs) > 1
+                        else layer_inputs[0])
+                    new_layer.set_weights(layer.get_weights())
+                sub_networks.append(tensors['output'])
 
             if merge_method == 'average':
                 output = average(sub_networks)
@@ -1204,7 +2089,9 @@ class Class2NeuralNetwork(object):
                     "Unsupported merge method", merge_method)
 
             result._network = Model(
-                inputs=[peptide_input, allele_input],
+                inputs=[
+                    shared[name] for name in networks[0].input_names
+                ],
                 outputs=[output],
                 name="merged_predictor"
             )
@@ -1218,6 +2105,8 @@ class Class2NeuralNetwork(object):
     def make_network(
             self,
             peptide_encoding,
+            peptide_input_format,
+            peptide_padding_mask,
             peptide_convolutions,
             allele_amino_acid_encoding,
             allele_dense_layer_sizes,
@@ -1247,11 +2136,50 @@ class Class2NeuralNetwork(object):
         from . import condconv
 
         peptide_encoding_shape = self.peptides_to_network_input([]).shape[1:]
-        peptide_input = Input(
-            shape=peptide_encoding_shape,
-            dtype='float32',
-            name='peptide')
-        current_layer = peptide_input
+        if peptide_padding_mask:
+            if peptide_input_format != "index":
+                raise ValueError(
+                    "peptide_padding_mask requires peptide_input_format "
+                    "'index'")
+            # Any length, so that padding can be trimmed at prediction time.
+            peptide_encoding_shape = (None,)
+
+        if peptide_input_format == "index":
+            peptide_input = Input(
+                shape=peptide_encoding_shape,
+                dtype='int8',
+                name='peptide')
+            peptide_vectors = amino_acid.ENCODING_DATA_FRAMES[
+                peptide_encoding['vector_encoding_name']
+            ]
+            current_layer = Embedding(
+                name="peptide_amino_acid_representation",
+                input_dim=peptide_vectors.shape[0],
+                output_dim=peptide_vectors.shape[1],
+                trainable=False)(peptide_input)
+            if peptide_padding_mask:
+                # 1 at peptide positions, 0 at padding.
+                padding_mask = Embedding(
+                    name="peptide_padding_mask",
+                    input_dim=peptide_vectors.shape[0],
+                    output_dim=1,
+                    trainable=False)(peptide_input)
+                padding_penalty = Embedding(
+                    name="peptide_padding_penalty",
+                    input_dim=peptide_vectors.shape[0],
+                    output_dim=1,
+                    trainable=False)(peptide_input)
+                current_layer = keras.layers.Multiply(
+                    name="peptide_masked")([current_layer, padding_mask])
+        elif peptide_input_format == "vector":
+            peptide_input = Input(
+                shape=peptide_encoding_shape,
+                dtype='float32',
+                name='peptide')
+            current_layer = peptide_input
+        else:
+            raise ValueError(
+                "Unsupported peptide_input_format: %s" % peptide_input_format)
 
         inputs = [peptide_input]
 
@@ -1269,6 +2197,10 @@ class Class2NeuralNetwork(object):
             name="peptide_first_convolution",
             padding="same",
             **first_peptide_convolution)(current_layer)
+        if peptide_padding_mask:
+            current_layer = keras.layers.Multiply(
+                name="peptide_first_convolution_masked")(
+                    [current_layer, padding_mask])
 
         outputs = []
 
@@ -1373,6 +2305,15 @@ class Class2NeuralNetwork(object):
                 name="peptide_additional_conv_%d" % i,
                 padding="same",
                 **peptide_convolution)(current_layer)
+            if peptide_padding_mask:
+                current_layer = keras.layers.Multiply(
+                    name="peptide_additional_conv_%d_masked" % i)(
+                        [current_layer, padding_mask])
+
+        if peptide_padding_mask:
+            current_layer = keras.layers.Add(
+                name="peptide_padding_penalty_added")(
+                    [current_layer, padding_penalty])
 
         # Global max pooling after all peptide convolutions.
         current_layer = keras.layers.GlobalMaxPooling1D()(current_layer)
@@ -1404,8 +2345,320 @@ class Class2NeuralNetwork(object):
             outputs=outputs,
             name="predictor")
 
+        if peptide_input_format == "index":
+            model.get_layer("peptide_amino_acid_representation").set_weights(
+                [peptide_vectors.values])
+        if peptide_padding_mask:
+            mask_values = numpy.ones((peptide_vectors.shape[0], 1))
+            mask_values[amino_acid.AMINO_ACID_INDEX["X"]] = 0.0
+            model.get_layer("peptide_padding_mask").set_weights([mask_values])
+            model.get_layer("peptide_padding_penalty").set_weights(
+                [(1.0 - mask_values) * self.MASKED_PADDING_PENALTY])
+
         return model
 
+    def with_peptide_input_format(self, peptide_input_format):
+        """
+        Return a new Class2NeuralNetwork that gives the same predictions as
+        this one but takes peptides in the specified format. This can be used
+        to convert models trained with vector-encoded peptide inputs to take
+        index-encoded peptides. See the peptide_input_format hyperparameter.
+
+        Parameters
+        ----------
+        peptide_input_format : string
+            One of "vector" or "index"
+
+        Returns
+        -------
+        Class2NeuralNetwork
+        """
+        if peptide_input_format != "index" and self.hyperparameters[
+                'peptide_padding_mask']:
+            raise ValueError(
+                "Networks with peptide_padding_mask require index input")
+        hyperparameters = dict(self.hyperparameters)
+        hyperparameters['peptide_input_format'] = peptide_input_format
+        result = Class2NeuralNetwork(**hyperparameters)
+        result.fit_info = list(self.fit_info)
+
+        original_model = self.network()
+        layer_names = [layer.name for layer in original_model.layers]
+
+        # Placeholder allele representations. Only their shapes are used:
+        # the actual representations are copied from the original model below.
+        allele_representations = {}
+        vector_length = amino_acid.vector_encoding_length(
+            self.hyperparameters['allele_amino_acid_encoding'])
+        for name in ["alpha", "beta"]:
+            layer_name = "%s_allele_representation" % name
+            if layer_name in layer_names:
+                layer = original_model.get_layer(layer_name)
+                allele_representations[
+                    "%s_allele_representations" % name
+                ] = numpy.zeros((
+                    layer.input_dim,
+                    layer.output_dim // vector_length,
+                    vector_length))
+
+        kwargs = result.network_hyperparameter_defaults.subselect(
+            result.hyperparameters)
+        kwargs.update(allele_representations)
+        new_model = result.make_network(**kwargs)
+        for layer in new_model.layers:
+            if layer.weights and layer.name in layer_names:
+                layer.set_weights(
+                    original_model.get_layer(layer.name).get_weights())
+        result._network = new_model
+        return result
+
+    def with_inference_precision(
+            self, precision, simulate_int8_weights=False):
+        """
+        Return a new Class2NeuralNetwork that computes its predictions at
+        reduced precision.
+
+        Activations are computed in `precision` (except for the network
+        outputs, which stay float32). If simulate_int8_weights is True, the
+        Conv1D and Dense kernels are also replaced by their int8-quantized
+        values, still stored as float32. See the `reduced_precision` module.
+
+        The result is for prediction only. Whether it is faster depends on the
+        hardware (on CPU, float16 and bfloat16 are often slower than float32),
+        so accuracy and throughput should be checked against the original
+        model, e.g. with the mhc2flurry-audit-precision command.
+
+        Parameters
+        ----------
+        precision : string
+            One of "float32", "float16", or "bfloat16"
+        simulate_int8_weights : boolean
+
+        Returns
+        -------
+        Class2NeuralNetwork
+        """
+        configure_tensorflow()
+        from tensorflow.keras.models import model_from_json
+
+        original_model = self.network()
+        result = Class2NeuralNetwork(**self.hyperparameters)
+        result.fit_info = list(self.fit_info)
+        result._network = model_from_json(
+            network_json_with_precision(original_model.to_json(), precision))
+        result._network.set_weights(original_model.get_weights())
+        if simulate_int8_weights:
+            simulate_int8_network_weights(result._network)
+        return result
+
+    @staticmethod
+    def subnetwork(network, input_layer_names, output_layer_name):
+        """
+        Make a Keras model computing part of the given network.
+
+        The outputs of the layers named in `input_layer_names` become inputs
+        (with the same names) of the new model, and layers that do not depend
+        on other inputs of the original network are skipped. Layers, and
+        therefore weights, are shared with the original network.
+
+        Parameters
+        ----------
+        network : keras.models.Model
+        input_layer_names : list of string
+        output_layer_name : string
+
+        Returns
+        -------
+        keras.models.Model
+        """
+        configure_tensorflow()
+        from tensorflow import keras
+
+        inputs = []
+        tensors = {}
+        for name in input_layer_names:
+            original = network.get_layer(name).output
+            tensors[name] = keras.layers.Input(
+                shape=original.shape[1:],
+                dtype=original.dtype,
+                name=name)
+            inputs.append(tensors[name])
+
+        # Layers are listed in topological order.
+        for layer_config in network.get_config()['layers']:
+            name = layer_config['name']
+            if name in tensors or not layer_config['inbound_nodes']:
+                continue
+            (inbound_node,) = layer_config['inbound_nodes']
+            inbound_names = [item[0] for item in inbound_node]
+            if any(inbound not in tensors for inbound in inbound_names):
+                continue
+            layer_inputs = [tensors[inbound] for inbound in inbound_names]
+            tensors[name] = network.get_layer(name)(
+                layer_inputs if len(layer_inputs) > 1 else layer_inputs[0])
+
+        if output_layer_name not in tensors:
+            raise ValueError(
+                "Layer %s does not depend only on %s" % (
+                    output_layer_name, " ".join(input_layer_names)))
+        return keras.models.Model(
+            inputs=inputs,
+            outputs=tensors[output_layer_name])
+
+    def allele_encoder_and_peptide_scorer(self):
+        """
+        Factor the (pan-allele) network into an allele encoder and a peptide
+        scorer.
+
+        The allele encoder maps the alpha and beta allele inputs to the output
+        of the allele branch of the network (the "allele_dense_final" layer),
+        which depends only on the allele pair. The peptide scorer takes the
+        peptide input and this allele vector (input name
+        "allele_dense_final") and gives the affinity output. The submodels
+        share weights with the network, and are rebuilt if the network is
+        replaced.
+
+        Returns
+        -------
+        (keras.models.Model, keras.models.Model) tuple
+        """
+        return (
+            self.cached_subnetwork(
+                ["alpha_allele", "beta_allele"], "allele_dense_final"),
+            self.cached_subnetwork(
+                ["peptide", "allele_dense_final"], "output"))
+
+    def cached_subnetwork(self, input_layer_names, output_layer_name):
+        """
+        Return `subnetwork` of this model's network, reusing a previously
+        made submodel unless the network has since been replaced.
+
+        Parameters
+        ----------
+        input_layer_names : list of string
+        output_layer_name : string
+
+        Returns
+        -------
+        keras.models.Model
+        """
+        network = self.network()
+        if self.subnetworks is None or self.subnetworks[0] is not network:
+            self.subnetworks = (network, {})
+        key = (tuple(input_layer_names), output_layer_name)
+        submodels = self.subnetworks[1]
+        if key not in submodels:
+            submodels[key] = self.subnetwork(
+                network, input_layer_names, output_layer_name)
+        return submodels[key]
+
+    def enable_allele_slots(self, capacity):
+        """
+        Serve allele representations from fixed-capacity tables.
+
+        By default, each call to `predict` replaces the allele representation
+        tables with those of the allele universe of the given allele
+        encodings, which requires network surgery (a `clone_model` call)
+        whenever the universe is larger than the current table. With slots
+        enabled, the tables have room for `capacity` alleles per chain and
+        the alleles in use are assigned to slots in least-recently-used
+        order, so once the tables hold the alleles in use, no surgery is
+        needed. Alleles are identified by name.
+
+        The tables grow (with one surgery) if a single call uses more than
+        `capacity` distinct alleles of a chain.
+
+        See `allele_representation_counters` for slot hits, misses, and the
+        number of surgeries.
+
+        Parameters
+        ----------
+        capacity : int or None
+            Number of alleles per chain. If None, slots are disabled.
+        """
+        self.allele_slot_capacity = capacity
+        self.allele_slots = None
+
+    def allele_slot_network_input(self, allele_encoding_pair):
+        """
+        Write the representations of the alleles used by the given allele
+        encodings to slots in the allele representation tables, and return
+        the slot of each allele as the network input.
+
+        Parameters
+        ----------
+        allele_encoding_pair : AlleleEncodingPair
+
+        Returns
+        -------
+        dict of string -> numpy.array of int32
+        """
+        chains = []
+        for (chain, encoding) in allele_encoding_pair.allele_encodings:
+            (indices, representations) = self.allele_encoding_to_network_input(
+                encoding)
+            (unique_indices, inverse) = numpy.unique(
+                indices, return_inverse=True)
+            chains.append(
+                (chain, encoding, unique_indices, inverse, representations))
+
+        num_needed = max(len(item[2]) for item in chains)
+        capacity = max(self.allele_slot_capacity, num_needed)
+        if self.allele_slots is not None:
+            current_capacity = min(
+                slots.capacity for slots in self.allele_slots.values())
+            if num_needed > current_capacity:
+                capacity = max(capacity, 2 * current_capacity)
+            else:
+                capacity = None
+        if capacity is not None:
+            self.resize_allele_representations(capacity)
+            self.allele_slots = dict(
+                (chain, AlleleRepresentationSlots(capacity))
+                for (chain, _, _, _, _) in chains)
+
+        network = self.network()
+        x_dict = {}
+        for (chain, encoding, unique_indices, inverse, representations) in (
+                chains):
+            (slots, assigned) = self.allele_slots[chain].assign(
+                list(encoding.index_to_allele[unique_indices]))
+            self.allele_representation_counters["slot_hits"] += (
+                len(slots) - len(assigned))
+            self.allele_representation_counters["slot_misses"] += len(
+                assigned)
+            if len(assigned) > 0:
+                values = representations[unique_indices[assigned]]
+                layer = network.get_layer("%s_allele_representation" % chain)
+                layer.embeddings.scatter_nd_update(
+                    slots[assigned].reshape((-1, 1)),
+                    values.reshape((len(values), -1)).astype(
+                        layer.embeddings.dtype.as_numpy_dtype))
+            x_dict["%s_allele" % chain] = slots[inverse]
+        return x_dict
+
+    def resize_allele_representations(self, num_alleles):
+        """
+        Set the allele representation tables to hold `num_alleles` alleles
+        per chain, all with NaN representations.
+
+        Parameters
+        ----------
+        num_alleles : int
+        """
+        target_representations = []
+        for name in [
+                "alpha_allele_representation", "beta_allele_representation"]:
+            layer = self.network().get_layer(name)
+            target_representations.append(
+                numpy.full(
+                    (num_alleles, layer.output_dim),
+                    numpy.nan,
+                    dtype="float32"))
+        self.set_allele_representations(
+            *target_representations,
+            force_surgery=True)
+
     def clear_allele_representations(self):
         """
         Set allele representations to an empty array. Useful before saving to
@@ -1455,6 +2708,9 @@ class Class2NeuralNetwork(object):
         configure_tensorflow()
         from tensorflow.keras.models import clone_model
 
+        # Slot assignments no longer describe the tables.
+        self.allele_slots = None
+
         names_and_targets = [
             ("alpha_allele_representation", alpha_allele_representations),
             ("beta_allele_representation", beta_allele_representations),
@@ -1479,10 +2735,10 @@ class Class2NeuralNetwork(object):
                 # matrix, which is expensive.
                 reshaped = numpy.append(
                     reshaped,
-                    numpy.ones([
+                    numpy.full([
                         existing_weights_shape[0] - reshaped.shape[0],
                         reshaped.shape[1]
-                    ]) * numpy.nan,
+                    ], numpy.nan, dtype=reshaped.dtype),
                     axis=0)
 
             if existing_weights_shape != reshaped.shape or force_surgery:
@@ -1490,6 +2746,7 @@ class Class2NeuralNetwork(object):
                 # dimensions changed. Kind of a hack.
                 layer.input_dim = reshaped.shape[0]
                 new_model = clone_model(original_model)
+                self.allele_representation_counters["surgeries"] += 1
 
                 # copy weights for other layers over
                 for layer in new_model.layers:
@@ -1,9 +1,12 @@
 from __future__ import print_function, division, absolute_import
+import atexit
 import collections
+import functools
 import logging
 import sys
 import os
 import json
+import threading
 
 import mhcgnomes
 
@@ -13,10 +16,25 @@ import pandas
 from . import amino_acid
 
 
+# Memo of allele name -> normalized name (or None if invalid). It is bounded
+# to the given number of names, evicting the least recently used. If the
+# MHC2FLURRY_ALLELE_NAME_CACHE environment variable is set to a filename, the
+# memo is loaded from that file on first use and written back at exit.
+NORMALIZE_ALLELE_NAME_CACHE_SIZE = int(os.environ.get(
+    "MHC2FLURRY_NORMALIZE_ALLELE_NAME_CACHE_SIZE", 100000))
+ALLELE_NAME_CACHE_PATH = os.environ.get("MHC2FLURRY_ALLELE_NAME_CACHE")
+_NORMALIZED_ALLELE_NAMES = collections.OrderedDict()
+_NORMALIZED_ALLELE_NAMES_LOCK = threading.Lock()
+_ALLELE_NAME_CACHE_LOADED = False
+
+
 def normalize_allele_name(name, raise_on_error=False):
     """
     Standardize the name of an allele or pair of alpha/beta alleles.
 
+    Results are memoized (see NORMALIZE_ALLELE_NAME_CACHE_SIZE), so repeated
+    names are only parsed once.
+
     >>> normalize_allele_name("DQA1*01:02")
     'HLA-DQA1*01:02'
 
@@ -35,6 +53,37 @@ def normalize_allele_name(name, raise_on_error=False):
     string
         Normalized name
     """
+    global _ALLELE_NAME_CACHE_LOADED
+    with _NORMALIZED_ALLELE_NAMES_LOCK:
+        # The file is loaded under the lock, so concurrent first calls load it
+        # once and do not see a partially loaded memo.
+        if ALLELE_NAME_CACHE_PATH and not _ALLELE_NAME_CACHE_LOADED:
+            if os.path.exists(ALLELE_NAME_CACHE_PATH):
+                with open(ALLELE_NAME_CACHE_PATH) as fd:
+                    _add_normalized_allele_names(json.load(fd))
+            atexit.register(save_allele_name_cache, ALLELE_NAME_CACHE_PATH)
+            _ALLELE_NAME_CACHE_LOADED = True
+
+        if name in _NORMALIZED_ALLELE_NAMES:
+            _NORMALIZED_ALLELE_NAMES.move_to_end(name)
+            result = _NORMALIZED_ALLELE_NAMES[name]
+            # Invalid names are re-parsed if an error is requested, to raise
+            # the parser's error.
+            if result is not None or not raise_on_error:
+                return result
+
+    result = _normalize_allele_name(name, raise_on_error=raise_on_error)
+    with _NORMALIZED_ALLELE_NAMES_LOCK:
+        _NORMALIZED_ALLELE_NAMES[name] = result
+        while len(_NORMALIZED_ALLELE_NAMES) > NORMALIZE_ALLELE_NAME_CACHE_SIZE:
+            _NORMALIZED_ALLELE_NAMES.popitem(last=False)
+    return result
+
+
+def _normalize_allele_name(name, raise_on_error=False):
+    """
+    Implementation of `normalize_allele_name` without memoization.
+    """
     result = mhcgnomes.parse(name, raise_on_error=raise_on_error)
     if type(result) not in (
             mhcgnomes.Class2Pair,
@@ -55,6 +104,146 @@ def normalize_allele_name(name, raise_on_error=False):
     return result.to_string()
 
 
+def normalize_allele_names(names, raise_on_error=True):
+    """
+    Normalize a sequence of allele names. Each distinct name is normalized
+    once and the results broadcast back to all positions.
+
+    Parameters
+    ----------
+    names : list or numpy.array or pandas.Series of string
+    raise_on_error : boolean
+        If True (default), throw a ValueError if any name is invalid or
+        missing. Otherwise, return None for those names.
+
+    Returns
+    -------
+    numpy.array of object
+        Normalized names
+    """
+    (codes, unique_names) = pandas.factorize(pandas.Series(names))
+    normalized = numpy.array(
+        [normalize_allele_name(name) for name in unique_names] + [None],
+        dtype=object)
+    if raise_on_error:
+        invalid = [
+            name for (name, result) in zip(unique_names, normalized)
+            if result is None
+        ]
+        if (codes == -1).any():
+            invalid.append(None)
+        if invalid:
+            raise ValueError("Invalid allele name(s): %s" % " ".join(
+                str(name) for name in invalid))
+    return normalized[codes]  # missing names have code -1, i.e. None
+
+
+def save_allele_name_cache(filename):
+    """
+    Write the memo of normalized allele names to a JSON file, so other
+    processes can use it (see `load_allele_name_cache`). The file is replaced
+    atomically.
+
+    Parameters
+    ----------
+    filename : string
+    """
+    with _NORMALIZED_ALLELE_NAMES_LOCK:
+        items = dict(_NORMALIZED_ALLELE_NAMES)
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp_filename, "w") as fd:
+        json.dump(items, fd)
+    os.replace(temp_filename, filename)
+
+
+def load_allele_name_cache(filename):
+    """
+    Add the normalized allele names written by `save_allele_name_cache` to
+    the memo.
+
+    Parameters
+    ----------
+    filename : string
+    """
+    with open(filename) as fd:
+        items = json.load(fd)
+    with _NORMALIZED_ALLELE_NAMES_LOCK:
+        _add_normalized_allele_names(items)
+
+
+def _add_normalized_allele_names(items):
+    """
+    Add names to the memo without replacing existing entries. The caller must
+    hold _NORMALIZED_ALLELE_NAMES_LOCK.
+
+    Parameters
+    ----------
+    items : dict of string -> string or None
+    """
+    for (name, result) in items.items():
+        _NORMALIZED_ALLELE_NAMES.setdefault(name, result)
+    while len(_NORMALIZED_ALLELE_NAMES) > NORMALIZE_ALLELE_NAME_CACHE_SIZE:
+        _NORMALIZED_ALLELE_NAMES.popitem(last=False)
+
+
+def allele_pair_name(alpha, beta):
+    """
+    Return the normalized name of an (alpha, beta) allele pair, as used for
+    allele pairs elsewhere (e.g. `make_allele_pairs`).
+
+    >>> allele_pair_name("DRA*01:01", "HLA-DRB1*07:01")
+    'HLA-DRA*01:01-DRB1*07:01'
+
+    Parameters
+    ----------
+    alpha : string
+    beta : string
+
+    Returns
+    -------
+    string
+    """
+    (species, _, alpha_name) = _parse_individual_allele(alpha)
+    (_, _, beta_name) = _parse_individual_allele(beta)
+    return normalize_allele_name(
+        "%s-%s-%s" % (species, alpha_name, beta_name), raise_on_error=True)
+
+
+@functools.lru_cache(maxsize=NORMALIZE_ALLELE_NAME_CACHE_SIZE)
+def split_allele_pair(name):
+    """
+    Return the normalized alpha and beta alleles of an allele pair. The alpha
+    allele is inferred if only a beta allele is given (e.g. DRA*01:01 for
+    DRB1 alleles).
+
+    >>> split_allele_pair("HLA-DQA1*01:02-DQB1*02:02")
+    ('HLA-DQA1*01:02', 'HLA-DQB1*02:02')
+
+    >>> split_allele_pair("DRB1*07:01")
+    ('HLA-DRA*01:01', 'HLA-DRB1*07:01')
+
+    Parameters
+    ----------
+    name : string
+
+    Returns
+    -------
+    (string, string) tuple, or None if the name is not an allele pair
+    """
+    if name is None:
+        return None
+    parsed = mhcgnomes.parse(
+        name, infer_class2_pairing=True, raise_on_error=False)
+    if type(parsed) is not mhcgnomes.Class2Pair:
+        return None
+    result = tuple(
+        normalize_allele_name(chain.to_string())
+        for chain in (parsed.alpha, parsed.beta))
+    if None in result:
+        return None
+    return result
+
+
 def make_allele_pairs(alleles):
     """
     Given a list of MHC II alleles, find all the pairs (i.e. DRA with DRB,
@@ -73,46 +262,91 @@ def make_allele_pairs(alleles):
     list of string
         List of allele pairs
     """
+    return list(_make_allele_pairs(tuple(alleles)))
 
 
+def expand_genotypes(genotypes):
     """
-    Given a list of individual alleles, like
-    """
-    parsed = [mhcgnomes.parse(a, raise_on_error=True) for a in alleles]
-    if any(p.species_prefix != "HLA" for p in parsed):
-        raise NotImplementedError(
-            "Only human is supported currently. Got: %s" % alleles)
+    Find the allele pairs (see `make_allele_pairs`) for each of many
+    genotypes, e.g. a cohort of patients.
 
-    def make_pairs(alphas, betas):
-        for alpha in alphas:
-            for beta in betas:
-                yield normalize_allele_name(
-                    "%s-%s" % (
-                        alpha.to_string(include_species=False),
-                        beta.to_string(include_species=False)),
-                    raise_on_error=True)
+    Allele parses and pairings are cached, so alleles and genotypes shared
+    across the cohort are only processed once. The result gives the distinct
+    pairs over all genotypes, so predictions can be made once per pair and
+    mapped back to genotypes with the returned matrix.
 
-    result = []
+    Parameters
+    ----------
+    genotypes : list of list of string
+        Individual alleles for each genotype
+
+    Returns
+    -------
+    (list of string, scipy.sparse.csr_matrix) tuple
 
-    # DR
-    result.extend(
-        make_pairs(
-            [mhcgnomes.parse("HLA-DRA1*01:01")],
-            [p for p in parsed if "DRB" in p.gene_name]))
+    The distinct allele pairs (in order of first appearance) and a boolean
+    matrix of shape (num genotypes, num pairs) whose (i, j) element is True if
+    genotype i has pair j.
+    """
+    from scipy.sparse import csr_matrix
+
+    pair_to_index = collections.OrderedDict()
+    indices = []
+    indptr = [0]
+    for alleles in genotypes:
+        for pair in collections.OrderedDict.fromkeys(
+                _make_allele_pairs(tuple(alleles))):
+            if pair not in pair_to_index:
+                pair_to_index[pair] = len(pair_to_index)
+            indices.append(pair_to_index[pair])
+        indptr.append(len(indices))
+    matrix = csr_matrix(
+        (
+            numpy.ones(len(indices), dtype=bool),
+            numpy.array(indices, dtype=numpy.int32),
+            numpy.array(indptr, dtype=numpy.int64),
+        ),
+        shape=(len(indptr) - 1, len(pair_to_index)))
+    return (list(pair_to_index), matrix)
+
+
+@functools.lru_cache(maxsize=NORMALIZE_ALLELE_NAME_CACHE_SIZE)
+def _parse_individual_allele(name):
+    """
+    Return (species prefix, gene name, name without species) for an allele.
+    """
+    parsed = mhcgnomes.parse(name, raise_on_error=True)
+    return (
+        parsed.species_prefix,
+        parsed.gene_name,
+        parsed.to_string(include_species=False))
 
-    # DP
-    result.extend(
-        make_pairs(
-            [p for p in parsed if "DPA" in p.gene_name],
-            [p for p in parsed if "DPB" in p.gene_name]))
 
-    # DQ
-    result.extend(
-        make_pairs(
-            [p for p in parsed if "DQA" in p.gene_name],
-            [p for p in parsed if "DQB" in p.gene_name]))
+@functools.lru_cache(maxsize=NORMALIZE_ALLELE_NAME_CACHE_SIZE)
+def _make_allele_pairs(alleles):
+    """
+    Implementation of `make_allele_pairs`, taking and returning tuples so the
+    result can be cached.
+    """
+    parsed = [_parse_individual_allele(a) for a in alleles]
+    if any(species != "HLA" for (species, _, _) in parsed):
+        raise NotImplementedError(
+            "Only human is supported currently. Got: %s" % list(alleles))
 
-    return result
+    def names(gene_fragment):
+        return [name for (_, gene, name) in parsed if gene_fragment in gene]
+
+    (_, _, dra) = _parse_individual_allele("HLA-DRA1*01:01")
+    result = []
+    for (alphas, betas) in [
+            ([dra], names("DRB")),  # DR
+            (names("DPA"), names("DPB")),  # DP
+            (names("DQA"), names("DQB"))]:  # DQ
+        for alpha in alphas:
+            for beta in betas:
+                result.append(normalize_allele_name(
+                    "%s-%s" % (alpha, beta), raise_on_error=True))
+    return tuple(result)
 
 
 TENSORFLOW_CONFIGURED = False
@@ -15,6 +15,8 @@ import numpy
 import pandas
 
 from . import amino_acid
+from .encoded_peptide_store import EncodedPeptideStore
+from .encoding_cache import content_hash, get_default_cache
 
 
 class EncodingError(ValueError):
@@ -28,6 +30,122 @@ class EncodingError(ValueError):
             message + " Supported lengths: %s - %s." % supported_peptide_lengths)
 
 
+def sequences_to_byte_matrix(sequences):
+    """
+    Pack a sequence of strings into a contiguous matrix of bytes.
+
+    Strings are stored one per row, left aligned and followed by zeros up to
+    the width of the matrix: the length of the longest string, or the width of
+    the dtype for numpy string and bytes arrays. Strings are not trimmed, so
+    column i of a row is character i of its string. Characters with code
+    points above 255 are stored as 255. Like any other non-ASCII value, this
+    is not a valid amino acid.
+
+    For numpy bytes arrays the result is a view of the input, not a copy.
+
+    Parameters
+    ----------
+    sequences : list of string or numpy.array of string or bytes
+
+    Returns
+    -------
+    (numpy.array of uint8 with shape (num sequences, max length),
+     numpy.array of int with shape (num sequences,)) tuple
+
+    The byte matrix and the length of each sequence.
+    """
+    if not isinstance(sequences, numpy.ndarray):
+        sequences = numpy.array(sequences, dtype=numpy.object_)
+    if sequences.dtype.kind == "O" or len(sequences) == 0:
+        try:
+            sequences = sequences.astype(numpy.bytes_)
+        except UnicodeEncodeError:
+            sequences = sequences.astype(numpy.str_)
+    sequences = numpy.ascontiguousarray(sequences)
+
+    if sequences.dtype.kind == "S":
+        byte_matrix = sequences.view(numpy.uint8).reshape(
+            (len(sequences), sequences.dtype.itemsize))
+    elif sequences.dtype.kind == "U":
+        code_points = sequences.view(numpy.uint32).reshape(
+            (len(sequences), sequences.dtype.itemsize // 4))
+        byte_matrix = numpy.minimum(code_points, 255).astype(numpy.uint8)
+    else:
+        raise ValueError("Sequence of strings is required")
+
+    return (byte_matrix, character_matrix_lengths(byte_matrix))
+
+
+def character_matrix_lengths(matrix):
+    """
+    Return the length of each row of a matrix of character codes in which
+    strings are left aligned and followed by zeros.
+
+    Length is the position of the last non-zero character plus one, which is
+    how numpy defines the length of fixed-width strings.
+
+    Parameters
+    ----------
+    matrix : numpy.array of unsigned int with shape (num sequences, width)
+
+    Returns
+    -------
+    numpy.array of int with shape (num sequences,)
+    """
+    nonzero = matrix != 0
+    return numpy.where(
+        nonzero.any(axis=1),
+        matrix.shape[1] - numpy.argmax(nonzero[:, ::-1], axis=1),
+        0)
+
+
+def sequence_lengths(sequences):
+    """
+    Return the length of each string in a numpy `U` or `S` dtype array,
+    without per-element Python work.
+
+    Parameters
+    ----------
+    sequences : numpy.array of string or bytes
+
+    Returns
+    -------
+    numpy.array of int with shape (num sequences,)
+    """
+    sequences = numpy.ascontiguousarray(sequences)
+    if sequences.dtype.kind == "U":
+        character_type = numpy.uint32
+    elif sequences.dtype.kind == "S":
+        character_type = numpy.uint8
+    else:
+        raise ValueError("Sequence of strings is required")
+    matrix = sequences.view(character_type).reshape(
+        (len(sequences), -1))
+    return character_matrix_lengths(matrix)
+
+
+def group_by_length(lengths):
+    """
+    Group sequence positions by sequence length.
+
+    Parameters
+    ----------
+    lengths : numpy.array of int
+
+    Returns
+    -------
+    list of (int, numpy.array of int) tuples
+
+    Each tuple gives a length and the (sorted) positions of the sequences with
+    that length. Lengths are in increasing order.
+    """
+    order = numpy.argsort(lengths, kind="stable")
+    (unique_lengths, starts) = numpy.unique(lengths[order], return_index=True)
+    return list(zip(
+        (int(length) for length in unique_lengths),
+        numpy.split(order, starts[1:])))
+
+
 class EncodableSequences(object):
     """
     Class for encoding variable-length peptides to fixed-size numerical matrices
@@ -36,6 +154,15 @@ class EncodableSequences(object):
 
     In practice this is used only for peptides. To encode MHC allele sequences,
     see AlleleEncoding.
+
+    Encodings are stored in a process-wide `EncodingCache` keyed by a hash of
+    the sequences, so instances wrapping the same sequences share them. The
+    returned arrays are read-only.
+
+    Instances may also be backed by an on-disk `EncodedPeptideStore` (see
+    `save_store` and `load_store`), in which case stored index encodings are
+    memory mapped instead of being recomputed and the sequences themselves are
+    only decoded if accessed.
     """
     unknown_character = "X"
 
@@ -48,32 +175,353 @@ class EncodableSequences(object):
         """
         if isinstance(sequences, klass):
             return sequences
+        if type(sequences).__module__.split(".")[0] == "pyarrow":
+            return klass.from_arrow(sequences)
         return klass(sequences)
 
+    @classmethod
+    def from_bytes(klass, data, offsets):
+        """
+        Create an EncodableSequences from ASCII sequences concatenated in a
+        single buffer.
+
+        Parameters
+        ----------
+        data : bytes or other object supporting the buffer protocol
+        offsets : numpy.array of int
+            Start of each sequence in `data`, followed by the end of the last
+            sequence. Sequences must be contiguous, i.e. each sequence ends
+            where the next begins. Empty (or a single offset) for no
+            sequences.
+
+        Returns
+        -------
+        EncodableSequences
+        """
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        if len(offsets) == 0:
+            return klass([])
+        lengths = numpy.diff(offsets)
+        width = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+        byte_matrix = numpy.zeros((len(lengths), width), dtype=numpy.uint8)
+        byte_matrix[
+            numpy.arange(width) < lengths[:, None]
+        ] = data[offsets[0]:offsets[-1]]
+        return klass(byte_matrix.view("S%d" % width).ravel())
+
+    @classmethod
+    def from_arrow(klass, array):
+        """
+        Create an EncodableSequences from a pyarrow string array, without
+        converting each element to a Python string.
+
+        Parameters
+        ----------
+        array : pyarrow.Array or pyarrow.ChunkedArray of string or large_string
+
+        Returns
+        -------
+        EncodableSequences
+        """
+        if hasattr(array, "combine_chunks"):
+            array = array.combine_chunks()
+        if str(array.type) == "string":
+            offset_type = numpy.int32
+        elif str(array.type) == "large_string":
+            offset_type = numpy.int64
+        else:
+            raise ValueError(
+                "Sequence of strings is required, not %s" % array.type)
+        if array.null_count > 0:
+            raise ValueError("Sequence of strings is required (found nulls)")
+        (_, offsets_buffer, data_buffer) = array.buffers()
+        if offsets_buffer is None:
+            return klass([])
+        offsets = numpy.frombuffer(offsets_buffer, dtype=offset_type)[
+            array.offset : array.offset + len(array) + 1
+        ]
+        return klass.from_bytes(
+            data_buffer if data_buffer is not None else b"", offsets)
+
+    @classmethod
+    def load_store(klass, path):
+        """
+        Open an encoded peptide store written by `save_store`.
+
+        Parameters
+        ----------
+        path : string
+            Store directory
+
+        Returns
+        -------
+        EncodableSequences
+        """
+        return klass.from_store(EncodedPeptideStore(path))
+
+    @classmethod
+    def from_store(klass, store):
+        """
+        Wrap an open encoded peptide store (or a view of part of one, see
+        `EncodedPeptideStore.subset`).
+
+        Parameters
+        ----------
+        store : EncodedPeptideStore
+
+        Returns
+        -------
+        EncodableSequences
+        """
+        result = klass.__new__(klass)
+        result.store = store
+        result._sequences = None
+        result._content_hash = store.content_hash
+        result._unique = None
+        result.encoding_cache = get_default_cache()
+        result._set_lengths(store.lengths)
+        return result
+
     def __init__(self, sequences):
-        if not all(isinstance(obj, string_types) for obj in sequences):
+        if isinstance(sequences, numpy.ndarray) and (
+                sequences.dtype.kind in ("U", "S")):
+            # Numpy string arrays need no per-element validation.
+            if sequences.dtype.kind == "S":
+                try:
+                    sequences = sequences.astype(numpy.str_)
+                except UnicodeDecodeError:
+                    sequences = numpy.char.decode(sequences, "utf-8")
+        elif not all(isinstance(obj, string_types) for obj in sequences):
             raise ValueError("Sequence of strings is required")
-        self.sequences = numpy.array(sequences)
-        lengths = pandas.Series(self.sequences, dtype=numpy.object_).str.len()
-
-        self.min_length = lengths.min()
-        self.max_length = lengths.max()
+        else:
+            # Lists and object arrays (e.g. pandas.Series.values).
+            sequences = numpy.asarray(sequences).astype(numpy.str_)
+        self.store = None
+        self._sequences = numpy.array(sequences)
+        self._content_hash = None
+        self._unique = None
+        self.encoding_cache = get_default_cache()
+        if len(self._sequences) > 0:
+            self._set_lengths(sequence_lengths(self._sequences))
+        else:
+            self._set_lengths(numpy.array([], dtype=int))
 
-        self.encoding_cache = {}
+    def _set_lengths(self, lengths):
+        if len(lengths) == 0:
+            self.min_length = self.max_length = numpy.nan
+        else:
+            self.min_length = lengths.min()
+            self.max_length = lengths.max()
         self.fixed_sequence_length = None
-        if len(self.sequences) > 0 and all(
-                len(s) == len(self.sequences[0]) for s in self.sequences):
-            self.fixed_sequence_length = len(self.sequences[0])
+        if len(lengths) > 0 and self.min_length == self.max_length:
+            self.fixed_sequence_length = int(self.min_length)
+
+    @property
+    def sequences(self):
+        """
+        numpy.array of string
+        """
+        if self._sequences is None:
+            self._sequences = self.store.decode_sequences()
+        return self._sequences
+
+    @property
+    def lengths(self):
+        """
+        numpy.array of int giving the length of each sequence. For
+        store-backed instances this is read from the store.
+        """
+        if self.store is not None:
+            return numpy.asarray(self.store.lengths)
+        return sequence_lengths(self.sequences)
 
     def __len__(self):
-        return len(self.sequences)
+        if self.store is not None:
+            return self.store.num_sequences
+        return len(self._sequences)
+
+    def subset(self, rows):
+        """
+        Return the sequences at the given positions.
+
+        For store-backed instances the result is backed by a view of the same
+        store, so stored encodings are used and the sequences are not decoded.
+
+        Parameters
+        ----------
+        rows : slice, numpy.array of int, or numpy.array of bool
+
+        Returns
+        -------
+        EncodableSequences
+        """
+        if self.store is not None:
+            return self.from_store(self.store.subset(rows))
+        return EncodableSequences(self.sequences[rows])
+
+    def __getstate__(self):
+        # The encoding cache is process-wide and is not pickled. Store-backed
+        # instances are pickled as a reference to the store.
+        state = dict(self.__dict__)
+        del state["encoding_cache"]
+        state["_unique"] = None
+        if self.store is not None:
+            state["_sequences"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.encoding_cache = get_default_cache()
+
+    def cached_encoding(self, cache_key, compute):
+        """
+        Return the encoding identified by `cache_key` from the encoding cache,
+        calling `compute()` to generate it if needed.
+
+        Parameters
+        ----------
+        cache_key : tuple
+            Encoding parameters. These are combined with a hash of the
+            sequences to form the full cache key.
+        compute : function of no arguments returning numpy.array
+
+        Returns
+        -------
+        numpy.array
+        """
+        if self.encoding_cache is None:
+            return compute()
+        if self._content_hash is None:
+            self._content_hash = content_hash(self.sequences)
+        return self.encoding_cache.get_or_compute(
+            (self._content_hash,) + cache_key, compute)
+
+    def unique(self):
+        """
+        Return the distinct sequences and the position of each sequence among
+        them. Computed once per instance.
+
+        Encodings are computed for the distinct sequences only and then
+        expanded, so repeated sequences are encoded once.
+
+        Returns
+        -------
+        (EncodableSequences, numpy.array of int) tuple
+
+        The distinct sequences, in order of first appearance, and an array
+        `inverse` such that `unique.sequences[inverse]` equals `sequences`.
+        """
+        if self._unique is None:
+            (inverse, unique_sequences) = pandas.factorize(self.sequences)
+            unique = EncodableSequences(
+                numpy.asarray(unique_sequences, dtype=self.sequences.dtype))
+            unique.encoding_cache = self.encoding_cache
+            unique._unique = (unique, numpy.arange(len(unique)))
+            self._unique = (unique, inverse)
+        return self._unique
+
+    def iter_blocks(self, block_size):
+        """
+        Split the sequences into consecutive blocks, for encoding a large
+        number of sequences a piece at a time.
+
+        Blocks do not use the encoding cache, since each is encoded once.
+
+        Parameters
+        ----------
+        block_size : int
+            Number of sequences per block (the last block may be smaller)
+
+        Returns
+        -------
+        generator of (int, int, EncodableSequences) tuples
+
+        Each tuple gives the start and end positions of a block and the block
+        itself.
+        """
+        for start in range(0, len(self), block_size):
+            end = min(start + block_size, len(self))
+            block = self.subset(slice(start, end))
+            block.encoding_cache = None
+            yield (start, end, block)
+
+    def save_store(self, path, index_encodings=({},)):
+        """
+        Write the sequences and their index encodings to an on-disk store
+        that can be opened with `load_store`.
+
+        Parameters
+        ----------
+        path : string
+            Directory to create
+        index_encodings : list of dict
+            Keyword arguments to `variable_length_to_fixed_length_categorical`
+            for each encoding to store. The default is a single encoding with
+            the default parameters.
+
+        Returns
+        -------
+        EncodableSequences backed by the new store
+        """
+        (byte_matrix, lengths) = sequences_to_byte_matrix(self.sequences)
+        if self._content_hash is None:
+            self._content_hash = content_hash(self.sequences)
+        encodings = []
+        for kwargs in index_encodings:
+            params = self._index_encoding_params(**kwargs)
+            encodings.append(
+                (params, self._fixed_length_index_encoding(params)))
+        EncodedPeptideStore.write(
+            path,
+            byte_matrix=byte_matrix,
+            lengths=lengths,
+            content_hash=self._content_hash,
+            index_encodings=encodings)
+        return self.load_store(path)
+
+    @staticmethod
+    def _index_encoding_params(
+            alignment_method="pad_middle",
+            left_edge=4,
+            right_edge=4,
+            max_length=15,
+            trim=False,
+            allow_unsupported_amino_acids=False):
+        return {
+            "alignment_method": alignment_method,
+            "left_edge": left_edge,
+            "right_edge": right_edge,
+            "max_length": max_length,
+            "trim": trim,
+            "allow_unsupported_amino_acids": allow_unsupported_amino_acids,
+        }
+
+    def _fixed_length_index_encoding(self, params):
+        """
+        Return the index encoding with the given parameters, using the store
+        if possible. The result may be a uint8 memory map (if read from the
+        store) or an int32 array (if computed).
+        """
+        if self.store is not None:
+            result = self.store.index_encoding(params)
+            if result is not None:
+                return result
+        (unique, inverse) = self.unique()
+        if len(unique) < len(self):
+            return unique._fixed_length_index_encoding(params)[inverse]
+        return self.sequences_to_fixed_length_index_encoded_array(
+            self.sequences, **params)
 
     def variable_length_to_fixed_length_categorical(
             self,
             alignment_method="pad_middle",
             left_edge=4,
             right_edge=4,
-            max_length=15):
+            max_length=15,
+            trim=False,
+            allow_unsupported_amino_acids=False,
+            dtype=None):
         """
         Encode variable-length sequences to a fixed-size index-encoded (integer)
         matrix.
@@ -89,6 +537,14 @@ class EncodableSequences(object):
         right_edge : int, size of the fixed-position right side
             Only relevant for pad_middle alignment method
         max_length : maximum supported peptide length
+        trim : bool
+            If True, longer sequences will be trimmed to fit the maximum
+            supported length. Not supported for all alignment methods.
+        allow_unsupported_amino_acids : bool
+            If True, non-canonical amino acids will be replaced with the X
+            character before encoding.
+        dtype : numpy dtype, optional
+            Integer type of the result. Defaults to int32.
 
         Returns
         -------
@@ -103,18 +559,32 @@ class EncodableSequences(object):
             alignment_method,
             left_edge,
             right_edge,
-            max_length)
-
-        if cache_key not in self.encoding_cache:
-            fixed_length_sequences = (
-                self.sequences_to_fixed_length_index_encoded_array(
-                    self.sequences,
-                    alignment_method=alignment_method,
-                    left_edge=left_edge,
-                    right_edge=right_edge,
-                    max_length=max_length))
-            self.encoding_cache[cache_key] = fixed_length_sequences
-        return self.encoding_cache[cache_key]
+            max_length,
+            trim,
+            allow_unsupported_amino_acids,
+            dtype)
+
+        params = self._index_encoding_params(
+            alignment_method=alignment_method,
+            left_edge=left_edge,
+            right_edge=right_edge,
+            max_length=max_length,
+            trim=trim,
+            allow_unsupported_amino_acids=allow_unsupported_amino_acids)
+
+        if (self.store is not None and dtype is not None and
+                numpy.dtype(dtype).itemsize == 1):
+            # Stored encodings are uint8 with values < 128, so they can be
+            # returned as a view of the memory map without copying.
+            stored = self.store.index_encoding(params)
+            if stored is not None:
+                return stored.view(dtype)
+
+        def compute():
+            return self._fixed_length_index_encoding(params).astype(
+                dtype if dtype is not None else numpy.int32, copy=False)
+
+        return self.cached_encoding(cache_key, compute)
 
     def variable_length_to_fixed_length_vector_encoding(
             self,
@@ -124,7 +594,8 @@ class EncodableSequences(object):
             right_edge=4,
             max_length=15,
             trim=False,
-            allow_unsupported_amino_acids=False):
+            allow_unsupported_amino_acids=False,
+            dtype=None):
         """
         Encode variable-length sequences to a fixed-size matrix. Amino acids
         are encoded as specified by the vector_encoding_name argument.
@@ -155,6 +626,9 @@ class EncodableSequences(object):
         allow_unsupported_amino_acids : bool
             If True, non-canonical amino acids will be replaced with the X
             character before encoding.
+        dtype : numpy dtype, optional
+            Type of the result, e.g. "float32". If not specified, the type
+            of the values in the vector encoding is used.
 
         Returns
         -------
@@ -173,11 +647,11 @@ class EncodableSequences(object):
             right_edge,
             max_length,
             trim,
-            allow_unsupported_amino_acids)
-        if cache_key not in self.encoding_cache:
-            fixed_length_sequences = (
-                self.sequences_to_fixed_length_index_encoded_array(
-                    self.sequences,
+            allow_unsupported_amino_acids,
+            dtype)
+        def compute():
+            fixed_length_sequences = self._fixed_length_index_encoding(
+                self._index_encoding_params(
                     alignment_method=alignment_method,
                     left_edge=left_edge,
                     right_edge=right_edge,
@@ -186,10 +660,12 @@ class EncodableSequences(object):
                     allow_unsupported_amino_acids=allow_unsupported_amino_acids))
             result = amino_acid.fixed_vectors_encoding(
                 fixed_length_sequences,
-                amino_acid.ENCODING_DATA_FRAMES[vector_encoding_name])
-            assert result.shape[0] == len(self.sequences)
-            self.encoding_cache[cache_key] = result
-        return self.encoding_cache[cache_key]
+                amino_acid.ENCODING_DATA_FRAMES[vector_encoding_name],
+                dtype=dtype)
+            assert result.shape[0] == len(self)
+            return result
+
+        return self.cached_encoding(cache_key, compute)
 
     @classmethod
     def sequences_to_fixed_length_index_encoded_array(
@@ -269,15 +745,29 @@ class EncodableSequences(object):
         it's 2 * max_length. For left_pad_centered_right_pad, it's
         3 * max_length.
         """
+        fill_value = -1
         if allow_unsupported_amino_acids:
             fill_value = amino_acid.AMINO_ACID_INDEX['X']
+        lookup_table = amino_acid.index_lookup_table(
+            amino_acid.AMINO_ACID_INDEX, fill_value=fill_value)
+
+        # Matrix of shape (num sequences, longest sequence length) giving the
+        # amino acid index at each position. Positions past the end of a
+        # sequence are junk and are never read.
+        (byte_matrix, lengths) = sequences_to_byte_matrix(sequences)
+        index_matrix = lookup_table[byte_matrix]
+
+        def check_supported(rows, fixed_length_sequences, offset=0):
+            # The fixed_length_sequences columns are the sequence characters
+            # starting at offset (non-zero for trimmed left_pad sequences).
+            if fill_value == -1 and (fixed_length_sequences < 0).any():
+                (row, column) = numpy.argwhere(fixed_length_sequences < 0)[0]
+                residue = sequences[rows[row]][offset + column]
+                if isinstance(residue, (int, numpy.integer)):
+                    # Indexing bytes gives the character code.
+                    residue = chr(residue)
+                raise KeyError(residue)
 
-            def get_amino_acid_index(a):
-                return amino_acid.AMINO_ACID_INDEX.get(a, fill_value)
-        else:
-            get_amino_acid_index = amino_acid.AMINO_ACID_INDEX.__getitem__
-
-        result = None
         if alignment_method == 'pad_middle':
             if trim:
                 raise NotImplementedError("trim not supported")
@@ -288,31 +778,25 @@ class EncodableSequences(object):
                 shape=(len(sequences), max_length),
                 dtype="int32")
 
-            df = pandas.DataFrame({"peptide": sequences}, dtype=numpy.object_)
-            df["length"] = df.peptide.str.len()
-
             middle_length = max_length - left_edge - right_edge
             min_length = left_edge + right_edge
 
             # For efficiency we handle each supported peptide length using bulk
             # array operations.
-            for (length, sub_df) in df.groupby("length"):
+            for (length, rows) in group_by_length(lengths):
                 if length < min_length or length > max_length:
                     raise EncodingError(
                         "Sequence '%s' (length %d) unsupported. There are %d "
                         "total peptides with this length." % (
-                            sub_df.iloc[0].peptide,
+                            sequences[rows[0]],
                             length,
-                            len(sub_df)), supported_peptide_lengths=(
+                            len(rows)), supported_peptide_lengths=(
                                 min_length, max_length))
 
                 # Array of shape (num peptides, length) giving fixed-length
                 # amino acid encoding each peptide of the current length.
-                fixed_length_sequences = numpy.stack(
-                    sub_df.peptide.map(
-                        lambda s: numpy.array([
-                            get_amino_acid_index(char) for char in s
-                        ])).values)
+                fixed_length_sequences = index_matrix[rows, :length]
+                check_supported(rows, fixed_length_sequences)
 
                 num_null = max_length - length
                 num_null_left = int(math.ceil(num_null / 2))
@@ -320,13 +804,13 @@ class EncodableSequences(object):
                 middle_start = left_edge + num_null_left
 
                 # Set left edge
-                result[sub_df.index, :left_edge] = fixed_length_sequences[
+                result[rows, :left_edge] = fixed_length_sequences[
                     :, :left_edge
                 ]
 
                 # Set middle.
                 result[
-                    sub_df.index,
+                    rows,
                     middle_start : middle_start + num_middle_filled
                 ] = fixed_length_sequences[
                     :, left_edge : left_edge + num_middle_filled
@@ -334,7 +818,7 @@ class EncodableSequences(object):
 
                 # Set right edge.
                 result[
-                    sub_df.index,
+                    rows,
                     -right_edge:
                 ] = fixed_length_sequences[:, -right_edge:]
         elif alignment_method == "left_pad_right_pad":
@@ -351,32 +835,28 @@ class EncodableSequences(object):
                 shape=(len(sequences), max_length * 2),
                 dtype="int32")
 
-            df = pandas.DataFrame({"peptide": sequences}, dtype=numpy.object_)
-
             # For efficiency we handle each supported peptide length using bulk
             # array operations.
-            for (length, sub_df) in df.groupby(df.peptide.str.len()):
+            for (length, rows) in group_by_length(lengths):
                 if length < min_length or length > max_length:
                     raise EncodingError(
                         "Sequence '%s' (length %d) unsupported. There are %d "
                         "total peptides with this length." % (
-                            sub_df.iloc[0].peptide,
+                            sequences[rows[0]],
                             length,
-                            len(sub_df)), supported_peptide_lengths=(
+                            len(rows)), supported_peptide_lengths=(
                                 min_length, max_length))
 
                 # Array of shape (num peptides, length) giving fixed-length
                 # amino acid encoding each peptide of the current length.
-                fixed_length_sequences = numpy.stack(sub_df.peptide.map(
-                    lambda s: numpy.array([
-                        get_amino_acid_index(char) for char in s
-                    ])).values)
+                fixed_length_sequences = index_matrix[rows, :length]
+                check_supported(rows, fixed_length_sequences)
 
                 # Set left edge
-                result[sub_df.index, :length] = fixed_length_sequences
+                result[rows, :length] = fixed_length_sequences
 
                 # Set right edge.
-                result[sub_df.index, -length:] = fixed_length_sequences
+                result[rows, -length:] = fixed_length_sequences
         elif alignment_method == "left_pad_centered_right_pad":
             if trim:
                 raise NotImplementedError("trim not supported")
@@ -391,39 +871,35 @@ class EncodableSequences(object):
                 shape=(len(sequences), max_length * 3),
                 dtype="int32")
 
-            df = pandas.DataFrame({"peptide": sequences}, dtype=numpy.object_)
-
             # For efficiency we handle each supported peptide length using bulk
             # array operations.
-            for (length, sub_df) in df.groupby(df.peptide.str.len()):
+            for (length, rows) in group_by_length(lengths):
                 if length < min_length or length > max_length:
                     raise EncodingError(
                         "Sequence '%s' (length %d) unsupported. There are %d "
                         "total peptides with this length." % (
-                            sub_df.iloc[0].peptide,
+                            sequences[rows[0]],
                             length,
-                            len(sub_df)), supported_peptide_lengths=(
+                            len(rows)), supported_peptide_lengths=(
                                 min_length, max_length))
 
                 # Array of shape (num peptides, length) giving fixed-length
                 # amino acid encoding each peptide of the current length.
-                fixed_length_sequences = numpy.stack(sub_df.peptide.map(
-                    lambda s: numpy.array([
-                        get_amino_acid_index(char) for char in s
-                    ])).values)
+                fixed_length_sequences = index_matrix[rows, :length]
+                check_supported(rows, fixed_length_sequences)
 
                 # Set left edge
-                result[sub_df.index, :length] = fixed_length_sequences
+                result[rows, :length] = fixed_length_sequences
 
                 # Set right edge.
-                result[sub_df.index, -length:] = fixed_length_sequences
+                result[rows, -length:] = fixed_length_sequences
 
                 # Set center.
                 center_left_padding = int(
                     math.floor((max_length - length) / 2))
                 center_left_offset = max_length + center_left_padding
                 result[
-                    sub_df.index,
+                    rows,
                     center_left_offset : center_left_offset + length
                 ] = fixed_length_sequences
         elif alignment_method in ("right_pad", "left_pad"):
@@ -435,45 +911,45 @@ class EncodableSequences(object):
                 shape=(len(sequences), max_length),
                 dtype="int32")
 
-            df = pandas.DataFrame({"peptide": sequences}, dtype=numpy.object_)
-
             # For efficiency we handle each supported peptide length using bulk
             # array operations.
-            for (length, sub_df) in df.groupby(df.peptide.str.len()):
+            for (length, rows) in group_by_length(lengths):
                 if length < min_length or (not trim and length > max_length):
                     raise EncodingError(
                         "Sequence '%s' (length %d) unsupported. There are %d "
                         "total peptides with this length." % (
-                            sub_df.iloc[0].peptide,
+                            sequences[rows[0]],
                             length,
-                            len(sub_df)), supported_peptide_lengths=(
+                            len(rows)), supported_peptide_lengths=(
                                 min_length, max_length))
 
-                peptides = sub_df.peptide
+                # Array of shape (num peptides, length) giving fixed-length
+                # amino acid encoding each peptide of the current length,
+                # trimmed if needed.
+                offset = 0
                 if length > max_length:
-                    # Trim.
                     if alignment_method == "right_pad":
-                        peptides = peptides.str.slice(0, max_length)
+                        fixed_length_sequences = index_matrix[
+                            rows, :max_length
+                        ]
                     else:
-                        peptides = peptides.str.slice(length - max_length)
-
-                # Array of shape (num peptides, length) giving fixed-length
-                # amino acid encoding each peptide of the current length.
-                fixed_length_sequences = numpy.stack(peptides.map(
-                    lambda s: numpy.array([
-                        get_amino_acid_index(char) for char in s
-                    ])).values)
+                        offset = length - max_length
+                        fixed_length_sequences = index_matrix[
+                            rows, offset : length
+                        ]
+                else:
+                    fixed_length_sequences = index_matrix[rows, :length]
+                check_supported(rows, fixed_length_sequences, offset)
 
                 if alignment_method == "right_pad":
                     # Left align (i.e. pad right): set left edge
-                    result[sub_df.index, :length] = fixed_length_sequences
+                    result[rows, :length] = fixed_length_sequences
                 else:
                     # Right align: set right edge.
-                    result[sub_df.index, -length:] = fixed_length_sequences
+                    result[rows, -length:] = fixed_length_sequences
 
         else:
             raise NotImplementedError(
                 "Unsupported alignment method: %s" % alignment_method)
 
-
         return result
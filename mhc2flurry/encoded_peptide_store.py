@@ -0,0 +1,220 @@
+"""
+On-disk store of peptides and their index encodings, for sharing encoded
+peptides across processes via memory mapping.
+
+A store is a directory containing:
+
+    manifest.json
+        Number of sequences, content hash, and the parameters of each
+        stored index encoding.
+    residues.npy
+        uint8 array of all sequences concatenated (ASCII).
+    offsets.npy
+        int64 array giving the start of each sequence in residues.npy, plus a
+        final element giving the total number of residues.
+    lengths.npy
+        int32 array of sequence lengths.
+    index_encoding_<i>.npy
+        uint8 matrix of index-encoded sequences (see
+        `EncodableSequences.variable_length_to_fixed_length_categorical`) for
+        the i'th encoding listed in the manifest.
+
+Use `EncodableSequences.save_store` to write a store and
+`EncodableSequences.load_store` to open one.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import hashlib
+import json
+from os import mkdir
+from os.path import join, exists
+
+import numpy
+
+from .encoding_cache import content_hash
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+class EncodedPeptideStore(object):
+    """
+    Read-only view of an encoded peptide store. Arrays are opened with
+    `numpy.load(mmap_mode='r')` on first use, so processes opening the same
+    store share memory through the OS page cache.
+
+    Parameters
+    ----------
+    path : string
+        Store directory
+    rows : numpy.array of int, optional
+        Positions of the stored sequences to include, for a view of a subset
+        of the store (see `subset`). Defaults to all sequences.
+    """
+    def __init__(self, path, rows=None):
+        self.path = path
+        with open(join(path, MANIFEST_FILENAME)) as fd:
+            self.manifest = json.load(fd)
+        self.rows = rows
+        if rows is None:
+            self.num_sequences = self.manifest["num_sequences"]
+            self.content_hash = self.manifest["content_hash"]
+        else:
+            self.num_sequences = len(rows)
+            self.content_hash = hashlib.sha1((
+                "%s:%s" % (self.manifest["content_hash"], content_hash(rows))
+            ).encode()).hexdigest()
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Memory maps are reopened after unpickling.
+        return {"path": self.path, "rows": self.rows}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], rows=state.get("rows"))
+
+    def subset(self, rows):
+        """
+        Return a view of some of the stored sequences. Arrays read through
+        the view (e.g. `lengths` and `index_encoding`) include only the
+        selected sequences.
+
+        Parameters
+        ----------
+        rows : slice, numpy.array of int, or numpy.array of bool
+            Selection of sequences, relative to this view
+
+        Returns
+        -------
+        EncodedPeptideStore
+        """
+        rows = numpy.arange(self.num_sequences)[rows]
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return EncodedPeptideStore(self.path, rows=rows)
+
+    def select_rows(self, array):
+        """
+        Return the rows of an array with one row per stored sequence that are
+        included in this view.
+        """
+        if self.rows is None:
+            return array
+        return array[self.rows]
+
+    def load(self, name):
+        """
+        Return the memory-mapped array stored as <name>.npy.
+        """
+        if name not in self._arrays:
+            self._arrays[name] = numpy.load(
+                join(self.path, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def lengths(self):
+        return self.select_rows(self.load("lengths"))
+
+    @property
+    def offsets(self):
+        return self.load("offsets")
+
+    @property
+    def residues(self):
+        return self.load("residues")
+
+    def index_encoding(self, params):
+        """
+        Return the stored index encoding generated with the given parameters,
+        or None if there is no such encoding in the store.
+
+        Parameters
+        ----------
+        params : dict
+            Keyword arguments to
+            `EncodableSequences.variable_length_to_fixed_length_categorical`,
+            including all defaults.
+
+        Returns
+        -------
+        numpy.memmap of uint8 with shape (num sequences, encoded length)
+        """
+        for (i, stored_params) in enumerate(self.manifest["index_encodings"]):
+            if stored_params == params:
+                return self.select_rows(self.load("index_encoding_%d" % i))
+        return None
+
+    def decode_sequences(self):
+        """
+        Reconstruct the stored sequences.
+
+        Returns
+        -------
+        numpy.array of string
+        """
+        lengths = numpy.asarray(self.lengths)
+        max_length = int(lengths.max()) if len(lengths) > 0 else 1
+        byte_matrix = numpy.zeros(
+            (len(lengths), max_length), dtype=numpy.uint8)
+        filled = numpy.arange(max_length) < lengths[:, None]
+        if self.rows is None:
+            byte_matrix[filled] = self.residues
+        else:
+            positions = (
+                self.offsets[self.rows][:, None] + numpy.arange(max_length))
+            byte_matrix[filled] = self.residues[positions[filled]]
+        return byte_matrix.view("S%d" % max_length).ravel().astype(
+            numpy.str_)
+
+    @classmethod
+    def write(klass, path, byte_matrix, lengths, content_hash, index_encodings):
+        """
+        Write a store.
+
+        Parameters
+        ----------
+        path : string
+            Directory to create. Must not already exist.
+        byte_matrix : numpy.array of uint8 with shape (num sequences, width)
+            Sequences as returned by `sequences_to_byte_matrix`
+        lengths : numpy.array of int
+            Sequence lengths
+        content_hash : string
+            Hash of the sequences, used as the encoding cache key
+        index_encodings : list of (dict, numpy.array) tuples
+            Encoding parameters and the corresponding index-encoded matrices
+
+        Returns
+        -------
+        EncodedPeptideStore
+        """
+        if exists(path):
+            raise ValueError("Path already exists: %s" % path)
+        mkdir(path)
+
+        lengths = numpy.asarray(lengths, dtype=numpy.int32)
+        offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        residues = byte_matrix[
+            numpy.arange(byte_matrix.shape[1]) < lengths[:, None]
+        ]
+        numpy.save(join(path, "residues.npy"), residues)
+        numpy.save(join(path, "offsets.npy"), offsets)
+        numpy.save(join(path, "lengths.npy"), lengths)
+
+        for (i, (_, matrix)) in enumerate(index_encodings):
+            numpy.save(
+                join(path, "index_encoding_%d.npy" % i),
+                matrix.astype(numpy.uint8))
+
+        manifest = {
+            "num_sequences": len(lengths),
+            "content_hash": content_hash,
+            "index_encodings": [params for (params, _) in index_encodings],
+        }
+        with open(join(path, MANIFEST_FILENAME), "w") as fd:
+            json.dump(manifest, fd, indent=4)
+        return klass(path)
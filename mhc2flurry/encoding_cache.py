@@ -0,0 +1,201 @@
+"""
+Process-wide cache of sequence encodings with a memory budget.
+
+Encodings are keyed by a content hash of the sequences together with the
+encoding parameters, so identical sequence lists wrapped in different
+EncodableSequences instances (e.g. across calls or ensemble members) share
+the same encoded arrays.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import hashlib
+import threading
+from collections import OrderedDict
+from os import environ
+
+import numpy
+
+DEFAULT_MAX_BYTES = int(environ.get(
+    "MHC2FLURRY_ENCODING_CACHE_MAX_BYTES", 2 ** 30))
+
+
+def content_hash(array):
+    """
+    Return a hex digest identifying the contents of a numpy array.
+
+    Arrays of strings are hashed by their content only: object, bytes, and
+    numpy string arrays of any width holding the same strings give the same
+    digest, so identical sequences share cache entries however they were
+    given.
+
+    Parameters
+    ----------
+    array : numpy.array
+        Array of fixed-width type (e.g. numpy strings or numbers), or object
+        array of strings
+
+    Returns
+    -------
+    string
+    """
+    array = numpy.ascontiguousarray(array)
+    if array.dtype.kind in ("O", "S"):
+        array = array.astype(numpy.str_)
+    if array.dtype.kind == "U":
+        # Hash at the minimal width, i.e. without trailing zero columns.
+        code_points = array.view(numpy.uint32).reshape(
+            array.shape + (array.dtype.itemsize // 4,))
+        used_columns = numpy.flatnonzero(
+            (code_points != 0).reshape((-1, code_points.shape[-1])).any(
+                axis=0))
+        width = int(used_columns[-1]) + 1 if len(used_columns) > 0 else 1
+        if width != code_points.shape[-1]:
+            array = numpy.ascontiguousarray(array.astype("U%d" % width))
+    digest = hashlib.sha1()
+    digest.update(("%s:%s:" % (array.dtype.str, array.shape)).encode())
+    digest.update(array.view(numpy.uint8).reshape((-1,)))
+    return digest.hexdigest()
+
+
+class EncodingCache(object):
+    """
+    Thread-safe least-recently-used cache of numpy arrays, bounded by the total
+    number of bytes stored.
+
+    Cached arrays are made read-only, since they may be shared by any number of
+    callers.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget. Arrays larger than this are returned to the caller but
+        not cached. Set to 0 to disable caching.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the array cached under `key`, or `default` if there is none.
+        """
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache `value` under `key`, evicting least recently used entries as
+        needed to stay within the memory budget.
+
+        Returns
+        -------
+        numpy.array : `value`, made read-only
+        """
+        value.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return value
+            self._entries[key] = value
+            self.current_bytes += value.nbytes
+            self._evict(self.max_bytes)
+        return value
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the array cached under `key`, calling `compute()` and caching
+        its result on a miss.
+
+        The computation runs without holding the lock, so concurrent misses on
+        the same key may compute it more than once.
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Change the memory budget, evicting entries if needed.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        """
+        Return cache statistics.
+
+        Returns
+        -------
+        dict with keys "hits", "misses", "evictions", "entries",
+        "current_bytes", and "max_bytes"
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self, max_bytes):
+        # Caller must hold the lock.
+        while self.current_bytes > max_bytes:
+            (_, value) = self._entries.popitem(last=False)
+            self.current_bytes -= value.nbytes
+            self.evictions += 1
+
+
+_DEFAULT_CACHE = EncodingCache()
+
+
+def get_default_cache():
+    """
+    Return the process-wide EncodingCache used by EncodableSequences.
+
+    Its budget is set by the MHC2FLURRY_ENCODING_CACHE_MAX_BYTES environment
+    variable (default 1 GiB) and can be changed at runtime with
+    `set_max_bytes`.
+
+    Returns
+    -------
+    EncodingCache
+    """
+    return _DEFAULT_CACHE
@@ -0,0 +1,66 @@
+"""
+Export the pan-allele models of a predictor as a TensorFlow SavedModel bundle,
+which can be loaded for prediction with `SavedModelPredictor`.
+
+Example:
+
+    $ mhc2flurry-export-saved-model \
+        --models-dir /path/to/models \
+        --out /path/to/bundle
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+import argparse
+import logging
+import sys
+
+from .saved_model_predictor import SavedModelPredictor
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument(
+    "--models-dir",
+    metavar="DIR",
+    required=True,
+    help="Directory to read models")
+parser.add_argument(
+    "--out",
+    metavar="DIR",
+    required=True,
+    help="Directory to write SavedModel bundle")
+parser.add_argument(
+    "--max-models",
+    type=int,
+    metavar="N",
+    help="Use at most N models")
+
+
+def run(argv=sys.argv[1:]):
+    args = parser.parse_args(argv)
+    logging.basicConfig(level="INFO")
+
+    from .class2_affinity_predictor import Class2AffinityPredictor
+
+    predictor = Class2AffinityPredictor.load(
+        args.models_dir,
+        max_models=args.max_models,
+        optimization_level=0)
+    if not predictor.class1_pan_allele_models:
+        parser.error("No pan-allele models in %s" % args.models_dir)
+
+    print("Exporting %d pan-allele models" % (
+        len(predictor.class1_pan_allele_models)))
+    SavedModelPredictor.export(
+        predictor.class1_pan_allele_models,
+        predictor.master_allele_encoding,
+        args.out)
+    print("Wrote: %s" % args.out)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,341 @@
+"""
+Inference for Keras networks without tensorflow.
+
+Interprets the architecture JSON and weights of the networks built by
+`Class2NeuralNetwork.make_network` (and ensembles merged with
+`Class2NeuralNetwork.merge`) using vectorized NumPy operations. This avoids
+the startup time and memory use of importing tensorflow, e.g. for CPU-only
+serving.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import json
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def sigmoid(x):
+    return 0.5 * (numpy.tanh(0.5 * x) + 1.0)
+
+
+def softmax(x):
+    exp = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: numpy.maximum(x, 0),
+    "tanh": numpy.tanh,
+    "sigmoid": sigmoid,
+    "softmax": softmax,
+    "softplus": lambda x: numpy.logaddexp(0, x),
+    "elu": lambda x: numpy.where(x > 0, x, numpy.expm1(numpy.minimum(x, 0))),
+}
+
+
+def activate(layer_config, x):
+    """
+    Apply the activation function of a layer.
+    """
+    name = layer_config.get("activation", "linear")
+    if name not in ACTIVATIONS:
+        raise NotImplementedError("Unsupported activation: %s" % name)
+    return ACTIVATIONS[name](x)
+
+
+def conv1d(config, weights, x):
+    (kernel, bias) = (weights + [None])[:2]
+    (kernel_size,) = config["kernel_size"]
+    if tuple(config["strides"]) != (1,) or tuple(
+            config.get("dilation_rate", (1,))) != (1,) or config.get(
+                "groups", 1) != 1:
+        raise NotImplementedError("Unsupported Conv1D configuration")
+    if config["padding"] == "same":
+        left = (kernel_size - 1) // 2
+        x = numpy.pad(
+            x, ((0, 0), (left, kernel_size - 1 - left), (0, 0)))
+    elif config["padding"] != "valid":
+        raise NotImplementedError("Unsupported padding: %s" % config["padding"])
+
+    # windows: (batch, positions, channels, kernel_size)
+    windows = sliding_window_view(x, kernel_size, axis=1)
+    result = numpy.einsum(
+        "nlck,kcf->nlf", windows, kernel, optimize=True)
+    if config["use_bias"]:
+        result += bias
+    return activate(config, result)
+
+
+def locally_connected1d(config, weights, x):
+    (kernel, bias) = (weights + [None])[:2]
+    (kernel_size,) = config["kernel_size"]
+    (stride,) = config["strides"]
+    if config["padding"] != "valid":
+        raise NotImplementedError("Unsupported padding: %s" % config["padding"])
+
+    # Keras kernel: (output length, kernel_size * input channels, filters),
+    # with each window flattened position-major.
+    windows = sliding_window_view(x, kernel_size, axis=1)[:, ::stride]
+    windows = windows.transpose(0, 1, 3, 2).reshape(
+        windows.shape[0], windows.shape[1], -1)
+    result = numpy.einsum("nld,ldf->nlf", windows, kernel, optimize=True)
+    if config["use_bias"]:
+        result += bias
+    return activate(config, result)
+
+
+def dense(config, weights, x):
+    result = numpy.matmul(x, weights[0])
+    if config["use_bias"]:
+        result += weights[1]
+    return activate(config, result)
+
+
+def embedding(config, weights, x):
+    return weights[0][numpy.asarray(x).astype(numpy.int64)]
+
+
+def batch_normalization(config, weights, x):
+    weights = list(weights)
+    gamma = weights.pop(0) if config["scale"] else 1.0
+    beta = weights.pop(0) if config["center"] else 0.0
+    (moving_mean, moving_variance) = weights
+    return (x - moving_mean) / numpy.sqrt(
+        moving_variance + config["epsilon"]) * gamma + beta
+
+
+def match_ranks(inputs):
+    """
+    Expand lower-rank inputs at axis 1 until all inputs have the same rank,
+    as the Keras merge layers do.
+    """
+    max_rank = max(x.ndim for x in inputs)
+    result = []
+    for x in inputs:
+        while x.ndim < max_rank:
+            x = numpy.expand_dims(x, axis=1)
+        result.append(x)
+    return result
+
+
+def multiply(config, weights, inputs):
+    result = 1.0
+    for x in match_ranks(inputs):
+        result = result * x
+    return result
+
+
+def add(config, weights, inputs):
+    result = 0.0
+    for x in match_ranks(inputs):
+        result = result + x
+    return result
+
+
+def average(config, weights, inputs):
+    return add(config, weights, inputs) / len(inputs)
+
+
+def concatenate(config, weights, inputs):
+    return numpy.concatenate(inputs, axis=config["axis"])
+
+
+def reshape(config, weights, x):
+    return x.reshape((x.shape[0],) + tuple(config["target_shape"]))
+
+
+def flatten(config, weights, x):
+    return x.reshape((x.shape[0], -1))
+
+
+def global_average_pooling1d(config, weights, x):
+    return x.mean(axis=1, keepdims=config.get("keepdims", False))
+
+
+def global_max_pooling1d(config, weights, x):
+    return x.max(axis=1, keepdims=config.get("keepdims", False))
+
+
+def identity(config, weights, x):
+    return x
+
+
+LAYER_FUNCTIONS = {
+    "Conv1D": conv1d,
+    "LocallyConnected1D": locally_connected1d,
+    "Dense": dense,
+    "Embedding": embedding,
+    "BatchNormalization": batch_normalization,
+    "Multiply": multiply,
+    "Add": add,
+    "Average": average,
+    "Concatenate": concatenate,
+    "Reshape": reshape,
+    "Flatten": flatten,
+    "GlobalAveragePooling1D": global_average_pooling1d,
+    "GlobalMaxPooling1D": global_max_pooling1d,
+    "Dropout": identity,
+    "Activation": lambda config, weights, x: activate(config, x),
+}
+"""
+Map from Keras layer class name to function (layer config, layer weights,
+input) -> output. Layers with multiple inputs take a list.
+"""
+
+
+def num_layer_weights(class_name, config):
+    """
+    Number of weight arrays of a layer, in the order given by Keras
+    `Model.get_weights`.
+    """
+    if class_name in ("Conv1D", "LocallyConnected1D", "Dense"):
+        return 2 if config["use_bias"] else 1
+    if class_name == "Embedding":
+        return 1
+    if class_name == "BatchNormalization":
+        return 2 + int(config["scale"]) + int(config["center"])
+    return 0
+
+
+class NumpyNetwork(object):
+    """
+    A Keras functional model evaluated with NumPy.
+
+    Parameters
+    ----------
+    network_json : string
+        Keras architecture JSON, e.g. `Class2NeuralNetwork.network_json`
+    weights : list of numpy.array
+        Weights in the order given by Keras `Model.get_weights`
+    """
+    def __init__(self, network_json, weights):
+        description = json.loads(network_json)
+        config = description["config"]
+        self.layers = []
+        self.layer_weights = {}
+        weights = list(weights)
+        for layer in config["layers"]:
+            class_name = layer["class_name"]
+            if class_name != "InputLayer" and class_name not in LAYER_FUNCTIONS:
+                raise NotImplementedError(
+                    "Unsupported layer: %s (%s)" % (layer["name"], class_name))
+            num_weights = num_layer_weights(class_name, layer["config"])
+            self.layer_weights[layer["name"]] = [
+                numpy.asarray(w) for w in weights[:num_weights]
+            ]
+            weights = weights[num_weights:]
+            inbound_names = [
+                item[0]
+                for node in layer["inbound_nodes"]
+                for item in node
+            ]
+            self.layers.append(
+                (layer["name"], class_name, layer["config"], inbound_names))
+        if weights:
+            raise ValueError("%d weight arrays left over" % len(weights))
+        self.input_names = [item[0] for item in config["input_layers"]]
+        self.output_names = [item[0] for item in config["output_layers"]]
+
+    def set_layer_weights(self, name, weights):
+        """
+        Set the weights of a layer, e.g. the allele representations of an
+        Embedding layer.
+
+        Parameters
+        ----------
+        name : string
+            Layer name
+        weights : list of numpy.array
+        """
+        self.check_layer_weights({name: weights})
+        self.layer_weights[name] = [numpy.asarray(w) for w in weights]
+
+    def check_layer_weights(self, layer_weights):
+        """
+        Check that weights given for some layers (see `evaluate`) have the
+        expected number of arrays.
+
+        Parameters
+        ----------
+        layer_weights : dict of string -> list of numpy.array
+        """
+        for (name, weights) in layer_weights.items():
+            if len(weights) != len(self.layer_weights[name]):
+                raise ValueError("Expected %d weight arrays for %s" % (
+                    len(self.layer_weights[name]), name))
+
+    def evaluate(self, x_dict, layer_weights=None):
+        """
+        Evaluate the network on a single batch.
+
+        Parameters
+        ----------
+        x_dict : dict of string -> numpy.array
+            Network inputs by name
+        layer_weights : dict of string -> list of numpy.array, optional
+            Weights to use instead of the network's weights for some layers
+            (e.g. the allele representations of an Embedding layer), for this
+            call only. Since the network is not modified, it can be shared by
+            concurrent calls with different weights.
+
+        Returns
+        -------
+        list of numpy.array, one per network output
+        """
+        if layer_weights is None:
+            layer_weights = {}
+        self.check_layer_weights(layer_weights)
+        values = {}
+        for (name, class_name, config, inbound_names) in self.layers:
+            if class_name == "InputLayer":
+                value = numpy.asarray(x_dict[name])
+                if value.dtype.kind == "f":
+                    value = value.astype(numpy.float32, copy=False)
+                values[name] = value.reshape((len(value),) + tuple(
+                    -1 if d is None else d
+                    for d in config["batch_input_shape"][1:]))
+                continue
+            layer_inputs = [values[inbound] for inbound in inbound_names]
+            values[name] = LAYER_FUNCTIONS[class_name](
+                config,
+                layer_weights.get(name, self.layer_weights[name]),
+                layer_inputs if len(layer_inputs) > 1 else layer_inputs[0])
+        return [values[name] for name in self.output_names]
+
+    def predict(self, x_dict, batch_size=4096, layer_weights=None):
+        """
+        Evaluate the network in batches, in the manner of Keras
+        `Model.predict`.
+
+        Parameters
+        ----------
+        x_dict : dict of string -> numpy.array
+            Network inputs by name
+        batch_size : int
+        layer_weights : dict of string -> list of numpy.array, optional
+            See `evaluate`
+
+        Returns
+        -------
+        numpy.array, or list of numpy.array if the network has multiple
+        outputs
+        """
+        num_rows = len(x_dict[self.input_names[0]])
+        results = [[] for _ in self.output_names]
+        for start in range(0, max(num_rows, 1), batch_size):
+            batch = dict(
+                (name, numpy.asarray(x_dict[name])[start:start + batch_size])
+                for name in self.input_names)
+            for (result, output) in zip(
+                    results, self.evaluate(batch, layer_weights)):
+                result.append(output)
+        results = [numpy.concatenate(result) for result in results]
+        if len(results) == 1:
+            (results,) = results
+        return results
@@ -6,6 +6,7 @@ import pandas
 
 from .hyperparameters import HyperparameterDefaults
 from .common import amino_acid_distribution, random_peptides
+from .encodable_sequences import EncodableSequences
 
 
 class RandomNegativePeptides(object):
@@ -60,7 +61,10 @@ class RandomNegativePeptides(object):
 
         Parameters
         ----------
-        peptides : list of string
+        peptides : list of string or EncodableSequences
+            For store-backed EncodableSequences, the peptide lengths are read
+            from the store, and the peptides are decoded only if
+            random_negative_match_distribution is set.
         affinities : list of float
         alleles : list of string, optional
         inequalities : list of string (">", "<", or "="), optional
@@ -76,12 +80,17 @@ class RandomNegativePeptides(object):
         if inequalities is not None:
             numpy.testing.assert_equal(len(peptides), len(inequalities))
 
-        peptides = pandas.Series(peptides, copy=False)
-        peptide_lengths = peptides.str.len()
+        if isinstance(peptides, EncodableSequences):
+            peptide_lengths = peptides.lengths
+        else:
+            peptides = pandas.Series(peptides, copy=False)
+            peptide_lengths = peptides.str.len().values
 
         if self.hyperparameters['random_negative_match_distribution']:
             self.aa_distribution = amino_acid_distribution(
-                peptides.values,
+                peptides.sequences
+                if isinstance(peptides, EncodableSequences)
+                else peptides.values,
                 smoothing=self.hyperparameters[
                     'random_negative_distribution_smoothing'
                 ])
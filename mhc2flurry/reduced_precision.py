@@ -0,0 +1,142 @@
+"""
+Reduced-precision inference: low-precision activations via Keras mixed
+precision policies, and simulation of int8 weight quantization.
+
+Whether reduced precision is faster depends on the hardware: GPUs with
+float16 or bfloat16 support benefit, while on CPU the mixed precision policies
+are often slower than float32. Simulated int8 weights are stored and computed
+in float32, so they only show the accuracy cost of int8 quantization and give
+no speed or memory benefit. Use the mhc2flurry-audit-precision command to
+measure both accuracy and throughput.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import json
+
+import numpy
+
+
+INFERENCE_PRECISIONS = {
+    "float32": "float32",
+    "float16": "mixed_float16",
+    "bfloat16": "mixed_bfloat16",
+}
+"""
+Map from inference precision to the Keras dtype policy used for all layers
+other than the network outputs. The mixed policies keep the weights in
+float32 and compute in the reduced precision.
+"""
+
+QUANTIZABLE_LAYER_CLASSES = ("Conv1D", "Dense")
+
+
+def network_json_with_precision(network_json, precision):
+    """
+    Rewrite a Keras architecture JSON to compute at the given precision.
+
+    Output layers stay float32, so the predictions (which are transformed to
+    nM affinities, see `regression_target.to_ic50`) are not rounded to the
+    reduced precision.
+
+    Parameters
+    ----------
+    network_json : string
+    precision : string
+        One of the keys of INFERENCE_PRECISIONS
+
+    Returns
+    -------
+    string
+    """
+    if precision not in INFERENCE_PRECISIONS:
+        raise ValueError("Unsupported precision: %s. Supported: %s" % (
+            precision, " ".join(INFERENCE_PRECISIONS)))
+    policy_name = INFERENCE_PRECISIONS[precision]
+    policy = policy_name if policy_name == "float32" else {
+        "module": "keras.mixed_precision",
+        "class_name": "Policy",
+        "config": {"name": policy_name},
+        "registered_name": None,
+    }
+    description = json.loads(network_json)
+    output_names = set(
+        item[0] for item in description["config"]["output_layers"])
+    for layer in description["config"]["layers"]:
+        if layer["class_name"] == "InputLayer":
+            continue
+        layer["config"]["dtype"] = (
+            "float32" if layer["name"] in output_names else policy)
+    return json.dumps(description)
+
+
+def quantize_int8(kernel):
+    """
+    Symmetric int8 quantization of a kernel with one scale per output channel
+    (the last axis).
+
+    Parameters
+    ----------
+    kernel : numpy.array
+
+    Returns
+    -------
+    (numpy.array of int8, numpy.array of float32) tuple
+
+    The quantized kernel and the scales, such that `quantized * scales`
+    approximates `kernel`.
+    """
+    kernel = numpy.asarray(kernel, dtype="float32")
+    max_abs = numpy.abs(kernel.reshape((-1, kernel.shape[-1]))).max(axis=0)
+    scales = numpy.where(max_abs > 0, max_abs / 127.0, 1.0).astype("float32")
+    quantized = numpy.clip(
+        numpy.round(kernel / scales), -127, 127).astype("int8")
+    return (quantized, scales)
+
+
+def dequantize_int8(quantized, scales):
+    """
+    Inverse of `quantize_int8`.
+
+    Parameters
+    ----------
+    quantized : numpy.array of int8
+    scales : numpy.array of float32
+
+    Returns
+    -------
+    numpy.array of float32
+    """
+    return quantized.astype("float32") * scales
+
+
+def simulate_int8_network_weights(network):
+    """
+    Replace the kernels of the Conv1D and Dense layers of a Keras network with
+    their int8-quantized values (see `quantize_int8`), in place.
+
+    The kernels are dequantized back to float32, so the network computes
+    exactly as before but with the rounding error of int8 weights. This
+    simulates the accuracy of int8 quantization; it does not make the
+    network smaller or faster.
+
+    Parameters
+    ----------
+    network : keras.Model
+
+    Returns
+    -------
+    list of string : names of the quantized layers
+    """
+    quantized_layer_names = []
+    for layer in network.layers:
+        if type(layer).__name__ not in QUANTIZABLE_LAYER_CLASSES:
+            continue
+        weights = layer.get_weights()
+        weights[0] = dequantize_int8(*quantize_int8(weights[0]))
+        layer.set_weights(weights)
+        quantized_layer_names.append(layer.name)
+    return quantized_layer_names
@@ -0,0 +1,252 @@
+"""
+Self-contained TensorFlow SavedModel bundles for pan-allele ensembles.
+
+A bundle holds a single network computing the predictions of all ensemble
+members, with the allele representation tables and the ensemble aggregation
+built in, so it can be restored for prediction without rebuilding, merging,
+or setting the representations of the individual networks.
+"""
+from __future__ import (
+    print_function,
+    division,
+    absolute_import,
+)
+
+import json
+import logging
+from os.path import join
+
+import numpy
+
+from .class2_neural_network import (
+    Class2NeuralNetwork,
+    DEFAULT_PREDICT_BATCH_SIZE,
+)
+from .common import configure_tensorflow, normalize_allele_names
+from .encodable_sequences import EncodableSequences
+from .version import __version__
+
+
+METADATA_FILENAME = "mhc2flurry_saved_model.json"
+
+MAX_IC50 = 50000.0
+
+
+class SavedModelPredictor(object):
+    """
+    Pan-allele class II predictor restored from a SavedModel bundle written by
+    `SavedModelPredictor.export`.
+
+    Parameters
+    ----------
+    path : string
+        Bundle directory
+    """
+    def __init__(self, path):
+        configure_tensorflow()
+        import tensorflow as tf
+
+        self.path = path
+        with open(join(path, METADATA_FILENAME)) as fd:
+            self.metadata = json.load(fd)
+        self.allele_to_index = dict(
+            (allele, i + 1)
+            for (i, allele) in enumerate(self.metadata['alleles']))
+
+        # Used only to encode peptides. No network is built.
+        self.peptide_encoder = Class2NeuralNetwork(
+            **self.metadata['hyperparameters'])
+        self.module = tf.saved_model.load(path)
+
+    @property
+    def num_models(self):
+        return self.metadata['num_models']
+
+    @staticmethod
+    def export(models, allele_encoding, path):
+        """
+        Write a SavedModel bundle for an ensemble of pan-allele models.
+
+        Copies of the models are merged (see `Class2NeuralNetwork.merge`), so
+        the given models are not changed. The ensemble prediction is the
+        geometric mean of the member nM predictions, i.e. the "mean"
+        centrality measure of `Class2AffinityPredictor`.
+
+        Parameters
+        ----------
+        models : list of Class2NeuralNetwork
+            Pan-allele models sharing a peptide encoding
+        allele_encoding : AlleleEncoding
+            Universe of supported alleles of both chains, e.g.
+            `Class2AffinityPredictor.master_allele_encoding`. As in
+            `Class2AffinityPredictor`, this one universe is used for both the
+            alpha and the beta allele representation tables, so each table
+            also holds the alleles of the other chain. The bundle does not
+            check that an allele is given for the right chain.
+        path : string
+            Directory to write
+        """
+        configure_tensorflow()
+        import tensorflow as tf
+
+        for key in ['peptide_encoding', 'peptide_input_format']:
+            values = set(
+                json.dumps(model.hyperparameters[key], sort_keys=True)
+                for model in models)
+            if len(values) > 1:
+                raise ValueError(
+                    "Models have different values for %s: %s" % (
+                        key, " ".join(sorted(values))))
+
+        # Set the representations before merging, since the merged network
+        # shares the representation layers of the members.
+        models = [
+            Class2NeuralNetwork.from_config(
+                model.get_config(), weights=model.get_weights())
+            for model in models
+        ]
+        for model in models:
+            (_, representations) = model.allele_encoding_to_network_input(
+                allele_encoding)
+            model.set_allele_representations(
+                representations, representations)
+        merged = Class2NeuralNetwork.merge(
+            models, merge_method="concatenate")
+        network = merged.network()
+
+        inputs = list(zip(network.input_names, network.inputs))
+        input_signature = [
+            dict(
+                (name, tf.TensorSpec(
+                    shape=(None,) + tuple(tensor.shape[1:]),
+                    dtype=tensor.dtype,
+                    name=name))
+                for (name, tensor) in inputs)
+        ]
+
+        # Only the variables (not the Keras objects) are tracked, so that
+        # loading does not need to rebuild Keras layers.
+        module = tf.Module()
+        module.weights = list(network.weights)
+
+        @tf.function(input_signature=input_signature)
+        def predict(batch):
+            outputs = network(batch, training=False)
+            if isinstance(outputs, (list, tuple)):
+                # Unmerged single model: the first output is the affinity.
+                outputs = outputs[0]
+            return {
+                'prediction': MAX_IC50 ** (
+                    1.0 - tf.reduce_mean(outputs, axis=1)),
+                'individual_predictions': MAX_IC50 ** (1.0 - outputs),
+            }
+
+        module.predict = predict
+        tf.saved_model.save(module, path)
+
+        metadata = {
+            'mhc2flurry_version': __version__,
+            'num_models': len(models),
+            'hyperparameters': models[0].hyperparameters,
+            'alleles': [
+                allele for allele in allele_encoding.index_to_allele[1:]
+            ],
+            'inputs': dict(
+                (name, {
+                    'shape': list(tensor.shape[1:]),
+                    'dtype': tensor.dtype.name,
+                })
+                for (name, tensor) in inputs),
+        }
+        with open(join(path, METADATA_FILENAME), "w") as fd:
+            json.dump(metadata, fd)
+        logging.info("Wrote: %s", path)
+
+    def allele_indices(self, alleles):
+        """
+        Map allele names to indices into the bundled allele representations.
+
+        Names not found as given are normalized (see
+        `common.normalize_allele_name`).
+
+        Parameters
+        ----------
+        alleles : list of string
+
+        Returns
+        -------
+        numpy.array of int
+        """
+        alleles = numpy.asarray(alleles, dtype=object)
+        (unique_alleles, inverse) = numpy.unique(alleles, return_inverse=True)
+        indices = numpy.array([
+            self.allele_to_index.get(allele, -1) for allele in unique_alleles
+        ])
+        missing = indices == -1
+        if missing.any():
+            normalized = normalize_allele_names(
+                unique_alleles[missing], raise_on_error=False)
+            indices[missing] = [
+                self.allele_to_index.get(allele, -1) for allele in normalized
+            ]
+            if (indices == -1).any():
+                raise ValueError(
+                    "No sequences for allele(s): %s" % " ".join(
+                        str(allele)
+                        for allele in unique_alleles[indices == -1]))
+        return indices[inverse]
+
+    def predict(
+            self,
+            peptides,
+            alpha_alleles,
+            beta_alleles,
+            batch_size=DEFAULT_PREDICT_BATCH_SIZE,
+            include_individual_model_predictions=False):
+        """
+        Predict nM binding affinities.
+
+        Parameters
+        ----------
+        peptides : `EncodableSequences` or list of string
+        alpha_alleles : list of string
+            Alpha chain allele for each peptide
+        beta_alleles : list of string
+            Beta chain allele for each peptide
+        batch_size : int
+        include_individual_model_predictions : boolean
+            If True, also return the nM predictions of each ensemble member
+
+        Returns
+        -------
+        numpy.array of ensemble predictions, or a tuple of this and an array
+        of shape (num peptides, num models) if
+        include_individual_model_predictions is True
+        """
+        peptides = EncodableSequences.create(peptides)
+        x_dict = {
+            'peptide': self.peptide_encoder.peptides_to_network_input(
+                peptides),
+            'alpha_allele': self.allele_indices(alpha_alleles),
+            'beta_allele': self.allele_indices(beta_alleles),
+        }
+        for (name, spec) in self.metadata['inputs'].items():
+            x_dict[name] = numpy.asarray(
+                x_dict[name], dtype=spec['dtype']).reshape(
+                    [len(peptides)] + [
+                        -1 if d is None else d for d in spec['shape']])
+
+        predictions = numpy.empty(len(peptides), dtype="float64")
+        individual_predictions = numpy.empty(
+            (len(peptides), self.num_models), dtype="float64")
+        for start in range(0, len(peptides), batch_size):
+            end = start + batch_size
+            outputs = self.module.predict(dict(
+                (name, values[start:end]) for (name, values) in x_dict.items()))
+            predictions[start:end] = outputs['prediction'].numpy()
+            individual_predictions[start:end] = (
+                outputs['individual_predictions'].numpy())
+
+        if include_individual_model_predictions:
+            return (predictions, individual_predictions)
+        return predictions
@@ -76,6 +76,10 @@ if __name__ == '__main__':
                 #    'mhc2flurry.train_pan_allele_models_command:run',
                 #'mhc2flurry-calibrate-percentile-ranks = '
                 #    'mhc2flurry.calibrate_percentile_ranks_command:run',
+                #'mhc2flurry-export-saved-model = '
+                #    'mhc2flurry.export_saved_model_command:run',
+                #'mhc2flurry-audit-precision = '
+                #    'mhc2flurry.audit_precision_command:run',
                 #'_mhc2flurry-cluster-worker-entry-point = '
                 #    'mhc2flurry.cluster_parallelism:worker_entry_point',
             ]
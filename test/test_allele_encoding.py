@@ -0,0 +1,88 @@
+import numpy
+import pytest
+
+from mhc2flurry.allele_encoding import AlleleEncoding
+from mhc2flurry.allele_encoding_pair import AlleleEncodingPair
+
+
+ALLELE_TO_SEQUENCE = {
+    "HLA-DRB1*01:01": "ACDEFGHIKL",
+    "HLA-DRB1*03:01": "ACDEFGHIKV",
+    "HLA-DRB1*04:01": "ACDEFGHIKY",
+}
+
+
+def test_indices():
+    encoding = AlleleEncoding(
+        ["HLA-DRB1*04:01", None, "HLA-DRB1*01:01", "HLA-DRB1*04:01"],
+        allele_to_sequence=ALLELE_TO_SEQUENCE)
+    assert encoding.indices.dtype == numpy.int32
+    assert list(encoding.indices) == [
+        encoding.allele_to_index[allele]
+        for allele in encoding.alleles
+    ]
+    assert list(encoding.indices) == [3, 0, 1, 3]
+
+    borrowed = AlleleEncoding(
+        ["HLA-DRB1*03:01"], borrow_from=encoding)
+    assert list(borrowed.indices) == [2]
+
+
+def test_missing_alleles():
+    with pytest.raises(AssertionError, match="Missing alleles: HLA-DRB1\\*15:01"):
+        AlleleEncoding(
+            ["HLA-DRB1*01:01", "HLA-DRB1*15:01", "HLA-DRB1*15:01"],
+            allele_to_sequence=ALLELE_TO_SEQUENCE)
+
+
+def test_allele_encoding_pair_from_pairs():
+    alpha = AlleleEncoding(
+        ["HLA-DRA*01:01"], allele_to_sequence={"HLA-DRA*01:01": "ACDEF"})
+    beta = AlleleEncoding(
+        ["HLA-DRB1*01:01"], allele_to_sequence=ALLELE_TO_SEQUENCE)
+    pair = AlleleEncodingPair(alpha, beta)
+
+    pairs = [
+        ("HLA-DRA*01:01", "HLA-DRB1*04:01"),
+        ("HLA-DRA*01:01", "HLA-DRB1*01:01"),
+        ("HLA-DRA*01:01", "HLA-DRB1*04:01"),
+    ]
+    result = pair.from_pairs(pairs)
+    assert result.allele_pairs == pairs
+    assert result.alpha_indices.dtype == numpy.int32
+    assert list(result.alpha_indices) == [1, 1, 1]
+    assert list(result.beta_indices) == [3, 1, 3]
+    assert len(result) == 3
+    assert result.pair_to_indices is pair.pair_to_indices
+    assert len(pair.pair_to_indices) == 2
+
+    # Encodings borrow from the original universe.
+    numpy.testing.assert_array_equal(
+        result.beta_allele_encoding.fixed_length_vector_encoded_sequences(
+            "BLOSUM62"),
+        AlleleEncoding(
+            [b for (a, b) in pairs],
+            borrow_from=beta).fixed_length_vector_encoded_sequences(
+            "BLOSUM62"))
+
+    with pytest.raises(AssertionError, match="Missing alleles"):
+        pair.from_pairs([("HLA-DRA*01:01", "HLA-DRB1*15:01")])
+
+
+def test_allele_encoding_pair_codes():
+    alpha = AlleleEncoding(
+        ["HLA-DRA*01:01"], allele_to_sequence={"HLA-DRA*01:01": "ACDEF"})
+    beta = AlleleEncoding(
+        ["HLA-DRB1*01:01"], allele_to_sequence=ALLELE_TO_SEQUENCE)
+    pairs = [
+        ("HLA-DRA*01:01", "HLA-DRB1*04:01"),
+        ("HLA-DRA*01:01", "HLA-DRB1*01:01"),
+        ("HLA-DRA*01:01", "HLA-DRB1*04:01"),
+    ]
+    encoding = AlleleEncodingPair(alpha, beta).from_pairs(pairs)
+    codes = encoding.pair_codes
+    assert codes[0] == codes[2] != codes[1]
+
+    result = encoding.from_pair_codes(codes[::-1])
+    assert result.allele_pairs == pairs[::-1]
+    assert list(result.beta_indices) == [3, 1, 3]
@@ -0,0 +1,58 @@
+import tempfile
+from os.path import join
+
+import numpy
+import pytest
+
+from mhc2flurry import amino_acid
+from mhc2flurry.allele_encoding import AlleleEncoding
+
+
+def test_index_encoding():
+    sequences = ["ACDEFGHIKLMN", "XXXXXXXXXXXX", "acdefghiklmn"]
+    expected = numpy.array([
+        [amino_acid.AMINO_ACID_INDEX[c] for c in sequence]
+        for sequence in sequences
+    ])
+    for values in [
+            sequences,
+            numpy.array(sequences),
+            numpy.array(sequences, dtype=object),
+            numpy.array(sequences).astype(numpy.bytes_)]:
+        numpy.testing.assert_array_equal(
+            amino_acid.index_encoding(values, amino_acid.AMINO_ACID_INDEX),
+            expected)
+
+    with pytest.raises(KeyError):
+        amino_acid.index_encoding(["AB", "AC"], amino_acid.AMINO_ACID_INDEX)
+    with pytest.raises(ValueError):
+        amino_acid.index_encoding(["AC", "A"], amino_acid.AMINO_ACID_INDEX)
+
+
+def test_allele_representations_round_trip():
+    allele_to_sequence = {
+        "HLA-DRA*01:01": "ACDEFGHIKL",
+        "HLA-DRA*01:02": "ACDEFGHIKV",
+    }
+    encoding = AlleleEncoding(
+        ["HLA-DRA*01:02"], allele_to_sequence=allele_to_sequence)
+    representations = encoding.allele_representations(
+        "BLOSUM62", dtype="float32")
+    assert representations.shape == (3, 10, 21)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = join(tmpdir, "representations.npy")
+        encoding.save_allele_representations(
+            filename, "BLOSUM62", dtype="float32")
+        loaded = AlleleEncoding(
+            ["HLA-DRA*01:01"], allele_to_sequence=allele_to_sequence)
+        loaded.load_allele_representations(
+            filename, "BLOSUM62", dtype="float32")
+        result = loaded.allele_representations("BLOSUM62", dtype="float32")
+        numpy.testing.assert_array_equal(result, representations)
+
+        with pytest.raises(ValueError):
+            AlleleEncoding(
+                allele_to_sequence={"HLA-DRA*01:01": "ACDEFGHIKL"}
+            ).load_allele_representations(
+                filename, "BLOSUM62", dtype="float32")
@@ -0,0 +1,247 @@
+import logging
+logging.getLogger('tensorflow').disabled = True
+
+import numpy
+numpy.random.seed(0)
+
+import pytest
+
+from mhc2flurry.class2_affinity_predictor import Class2AffinityPredictor
+from mhc2flurry.common import make_allele_pairs, random_peptides
+from mhc2flurry.encodable_sequences import EncodableSequences
+from mhc2flurry.regression_target import to_ic50
+
+from mhc2flurry.testing_utils import cleanup, startup
+
+from test_class2_neural_network import (
+    make_allele_encoding_pair,
+    make_prediction_inputs,
+    make_untrained_network,
+    SMALL_NETWORK_HYPERPARAMETERS,
+    ALPHA_SEQUENCES,
+    BETA_SEQUENCES,
+)
+
+teardown = cleanup
+setup = startup
+
+ALLELES = [
+    "HLA-DRA*01:01-DRB1*01:01",
+    "HLA-DRA*01:01-DRB1*03:01",
+    "HLA-DRB1*04:01",  # The DRA allele is inferred.
+]
+
+
+def make_predictor(num_models=3):
+    (_, allele_encoding) = make_prediction_inputs(num_peptides=10)
+    models = [
+        make_untrained_network(allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+        for _ in range(num_models)
+    ]
+    return Class2AffinityPredictor(
+        class1_pan_allele_models=models,
+        allele_to_sequence=dict(ALPHA_SEQUENCES, **BETA_SEQUENCES))
+
+
+def individual_model_predictions(predictor, peptides, alleles):
+    allele_encoding = make_allele_encoding_pair(
+        alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+    return numpy.column_stack([
+        to_ic50(model.predict(
+            peptides, allele_encoding_pair=allele_encoding).flatten())
+        for model in predictor.class1_pan_allele_models
+    ])
+
+
+def test_predict_arrays():
+    predictor = make_predictor()
+    (peptides, _) = make_prediction_inputs(num_peptides=200)
+    alleles = numpy.random.choice(ALLELES, size=len(peptides))
+
+    expected = individual_model_predictions(predictor, peptides, alleles)
+    result = predictor.predict_arrays(
+        peptides,
+        alleles=alleles,
+        include_individual_model_predictions=True)
+    numpy.testing.assert_allclose(
+        result["individual_model_predictions"], expected, rtol=1e-5)
+    numpy.testing.assert_allclose(
+        result["prediction"],
+        numpy.exp(numpy.log(expected).mean(1)),
+        rtol=1e-5)
+    assert (result["prediction_low"] <= result["prediction"]).all()
+    assert (result["prediction"] <= result["prediction_high"]).all()
+    numpy.testing.assert_array_equal(
+        predictor.predict(peptides, alleles=alleles), result["prediction"])
+
+    # Alleles given as codes into a list of distinct alleles.
+    allele_codes = numpy.searchsorted(ALLELES, alleles)
+    numpy.testing.assert_allclose(
+        predictor.predict_arrays(
+            peptides,
+            alleles=ALLELES,
+            allele_codes=allele_codes)["prediction"],
+        result["prediction"],
+        rtol=1e-6)
+
+    # Results written to preallocated arrays.
+    out = {
+        "prediction": numpy.empty(len(peptides)),
+        "prediction_low": numpy.empty(len(peptides)),
+    }
+    out_result = predictor.predict_arrays(peptides, alleles=alleles, out=out)
+    assert out_result["prediction"] is out["prediction"]
+    assert out_result["prediction_low"] is out["prediction_low"]
+    numpy.testing.assert_allclose(
+        out["prediction"], result["prediction"], rtol=1e-6)
+    numpy.testing.assert_allclose(
+        out["prediction_low"], result["prediction_low"], rtol=1e-6)
+
+    # Single allele.
+    numpy.testing.assert_allclose(
+        predictor.predict_arrays(peptides, allele=ALLELES[2])["prediction"],
+        numpy.exp(numpy.log(individual_model_predictions(
+            predictor, peptides, [ALLELES[2]] * len(peptides))).mean(1)),
+        rtol=1e-5)
+
+    # Merged pan-allele models give the same predictions.
+    assert predictor.optimize()
+    numpy.testing.assert_allclose(
+        predictor.predict_arrays(
+            peptides,
+            alleles=alleles,
+            include_individual_model_predictions=True)[
+                "individual_model_predictions"],
+        expected,
+        rtol=1e-5)
+
+
+def test_predict_arrays_unsupported_alleles():
+    predictor = make_predictor(num_models=2)
+    (peptides, _) = make_prediction_inputs(num_peptides=100)
+    alleles = numpy.array(
+        [ALLELES[0], None, "HLA-DRA*01:01-DRB1*15:01", "junk"] * 25,
+        dtype=object)
+
+    with pytest.raises(ValueError):
+        predictor.predict_arrays(peptides, alleles=alleles)
+    with pytest.raises(ValueError):
+        predictor.predict_arrays(peptides, alleles=list(alleles[:2]) * 50)
+
+    predictions = predictor.predict_arrays(
+        peptides, alleles=alleles, throw=False)["prediction"]
+    supported = alleles == ALLELES[0]
+    assert numpy.isnan(predictions[~supported]).all()
+    numpy.testing.assert_allclose(
+        predictions[supported],
+        numpy.exp(numpy.log(individual_model_predictions(
+            predictor,
+            numpy.array(peptides)[supported],
+            alleles[supported])).mean(1)),
+        rtol=1e-5)
+
+
+def test_predict_arrays_store_backed_peptides(tmp_path):
+    predictor = make_predictor(num_models=2)
+    (peptides, _) = make_prediction_inputs(num_peptides=100)
+    alleles = numpy.array(
+        [ALLELES[0], ALLELES[2], "HLA-DRA*01:01-DRB1*15:01", None] * 25,
+        dtype=object)
+    EncodableSequences.create(peptides).save_store(
+        str(tmp_path / "store"),
+        index_encodings=[{'alignment_method': 'right_pad', 'max_length': 20}])
+
+    expected = predictor.predict_arrays(
+        peptides, alleles=alleles, throw=False)["prediction"]
+    stored = EncodableSequences.load_store(str(tmp_path / "store"))
+    numpy.testing.assert_allclose(
+        predictor.predict_arrays(
+            stored, alleles=alleles, throw=False)["prediction"],
+        expected,
+        rtol=1e-6)
+    # Encodings were read from the store, without decoding the peptides.
+    assert stored._sequences is None
+
+
+def test_predict_to_dataframe():
+    predictor = make_predictor(num_models=2)
+    (peptides, _) = make_prediction_inputs(num_peptides=100)
+    alleles = numpy.random.choice(ALLELES, size=len(peptides))
+
+    with pytest.warns(UserWarning):
+        # No percentile rank calibration.
+        df = predictor.predict_to_dataframe(
+            peptides,
+            alleles=alleles,
+            include_individual_model_predictions=True)
+    assert list(df.columns) == [
+        "peptide",
+        "allele",
+        "prediction",
+        "prediction_low",
+        "prediction_high",
+        "model_pan_0",
+        "model_pan_1",
+    ]
+    assert list(df.peptide) == list(peptides)
+    assert list(df.allele) == list(alleles)
+    numpy.testing.assert_allclose(
+        df[["model_pan_0", "model_pan_1"]].values,
+        individual_model_predictions(predictor, peptides, alleles),
+        rtol=1e-5)
+    numpy.testing.assert_array_equal(
+        df.prediction.values,
+        predictor.predict(peptides, alleles=alleles))
+
+
+def test_predict_matrix():
+    predictor = make_predictor()
+    predictor.calibrate_percentile_ranks(
+        peptides=random_peptides(1000, length=15),
+        alleles=ALLELES[:2],
+        bins=to_ic50(numpy.linspace(1, 0, 100)))
+    (peptides, _) = make_prediction_inputs(num_peptides=50)
+    allele_pairs = [
+        ("HLA-DRA*01:01", "HLA-DRB1*01:01"),
+        ("DRA*01:01", "DRB1*03:01"),
+        ("HLA-DRA*01:01", "HLA-DRB1*15:01"),  # unsupported
+    ]
+
+    # The same predictions as for the cross product of peptides and pairs.
+    df = predictor.predict_to_dataframe(
+        numpy.repeat(peptides, 2),
+        alleles=ALLELES[:2] * len(peptides),
+        include_percentile_ranks=True)
+    expected = df.prediction.values.reshape((len(peptides), 2))
+    expected_percentiles = df.prediction_percentile.values.reshape(
+        (len(peptides), 2))
+    assert not numpy.isnan(expected_percentiles).any()
+
+    for optimize in [False, True]:
+        if optimize:
+            assert predictor.optimize()
+        (predictions, percentile_ranks) = predictor.predict_matrix(
+            peptides,
+            allele_pairs,
+            throw=False,
+            include_percentile_ranks=True)
+        assert predictions.shape == (len(peptides), 3)
+        numpy.testing.assert_allclose(
+            predictions[:, :2], expected, rtol=1e-4)
+        numpy.testing.assert_allclose(
+            percentile_ranks[:, :2], expected_percentiles, atol=1.0)
+        assert numpy.isnan(predictions[:, 2]).all()
+        assert numpy.isnan(percentile_ranks[:, 2]).all()
+
+    with pytest.raises(ValueError):
+        predictor.predict_matrix(peptides, allele_pairs)
+
+    # Allele pair names, as given by make_allele_pairs.
+    pair_names = make_allele_pairs(
+        ["HLA-DRA*01:01", "HLA-DRB1*01:01", "HLA-DRB1*03:01"])
+    assert pair_names == ALLELES[:2]
+    numpy.testing.assert_allclose(
+        predictor.predict_matrix(peptides, pair_names), expected, rtol=1e-4)
+    with pytest.raises(ValueError, match="HLA-DRA\\*01:01-DRB1\\*15:01"):
+        predictor.predict_matrix(
+            peptides, pair_names + ["HLA-DRA*01:01-DRB1*15:01"])
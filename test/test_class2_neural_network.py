@@ -7,7 +7,10 @@ import tensorflow.random
 numpy.random.seed(0)
 tensorflow.random.set_seed(0)
 
+import pickle
+
 import pandas
+import pytest
 from sklearn.metrics import roc_auc_score
 
 import mhcgnomes
@@ -16,6 +19,8 @@ from mhc2flurry.allele_encoding_pair import AlleleEncodingPair
 from mhc2flurry.allele_encoding import AlleleEncoding
 from mhc2flurry.class2_neural_network import Class2NeuralNetwork
 from mhc2flurry.common import random_peptides
+from mhc2flurry.encodable_sequences import EncodableSequences
+from mhc2flurry.encoding_cache import EncodingCache
 
 from mhc2flurry.testing_utils import cleanup, startup
 teardown = cleanup
@@ -216,3 +221,562 @@ def check_accuracy(df, network, alpha_sequences, beta_sequences, message=""):
         assert row.auc > 0.8, (message, row.allele)
 
 
+
+
+def make_untrained_network(allele_encoding, **hyperparameters):
+    """
+    Return a Class2NeuralNetwork with randomly initialized weights.
+    """
+    model = Class2NeuralNetwork(**hyperparameters)
+    (_, alpha_allele_representations) = model.allele_encoding_to_network_input(
+        allele_encoding.alpha_allele_encoding)
+    (_, beta_allele_representations) = model.allele_encoding_to_network_input(
+        allele_encoding.beta_allele_encoding)
+    model._network = model.make_network(
+        alpha_allele_representations=alpha_allele_representations,
+        beta_allele_representations=beta_allele_representations,
+        **model.network_hyperparameter_defaults.subselect(
+            model.hyperparameters))
+    return model
+
+
+SMALL_NETWORK_HYPERPARAMETERS = dict(
+    layer_sizes=[8],
+    allele_positionwise_embedding_size=4,
+    allele_dense_layer_sizes=[6],
+    peptide_convolutions=[
+        {'kernel_size': 3, 'filters': 8, 'activation': "relu"},
+        {'kernel_size': 5, 'filters': 4, 'activation': "relu"},
+    ],
+    peptide_encoding={
+        'vector_encoding_name': 'BLOSUM62',
+        'alignment_method': 'right_pad',
+        'max_length': 20,
+    },
+)
+
+ALPHA_SEQUENCES = {
+    "HLA-DRA*01:01": "AAAN",
+}
+BETA_SEQUENCES = {
+    "HLA-DRB1*01:01": "AAAQ",
+    "HLA-DRB1*03:01": "AAKK",
+    "HLA-DRB1*04:01": "CQAK",
+}
+
+
+def make_prediction_inputs(num_peptides=1000):
+    peptides = random_peptides(num_peptides // 2, length=15) + random_peptides(
+        num_peptides - num_peptides // 2, length=18)
+    alleles = numpy.random.choice(
+        ["HLA-DRB1*01:01", "HLA-DRB1*03:01", "HLA-DRB1*04:01"],
+        size=num_peptides)
+    allele_encoding = make_allele_encoding_pair(
+        alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+    return (peptides, allele_encoding)
+
+
+def test_index_peptide_input_format():
+    (peptides, allele_encoding) = make_prediction_inputs()
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    predictions = model.predict(peptides, allele_encoding_pair=allele_encoding)
+
+    index_model = model.with_peptide_input_format("index")
+    assert index_model.hyperparameters['peptide_input_format'] == "index"
+    index_input = index_model.peptides_to_network_input(peptides)
+    assert index_input.dtype == numpy.int8
+    assert index_input.shape == (len(peptides), 20)
+    numpy.testing.assert_allclose(
+        index_model.predict(peptides, allele_encoding_pair=allele_encoding),
+        predictions,
+        rtol=1e-6)
+
+    # Round trip through serialization.
+    reloaded = Class2NeuralNetwork.from_config(
+        index_model.get_config(), weights=index_model.get_weights())
+    numpy.testing.assert_allclose(
+        reloaded.predict(peptides, allele_encoding_pair=allele_encoding),
+        predictions,
+        rtol=1e-6)
+
+    # And back to vector input.
+    vector_model = reloaded.with_peptide_input_format("vector")
+    numpy.testing.assert_allclose(
+        vector_model.predict(peptides, allele_encoding_pair=allele_encoding),
+        predictions,
+        rtol=1e-6)
+
+
+def test_streaming_predict():
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=1000)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    predictions = model.predict(
+        peptides, allele_encoding_pair=allele_encoding, batch_size=64)
+    streamed = model.predict(
+        peptides,
+        allele_encoding_pair=allele_encoding,
+        batch_size=64,
+        stream_block_size=300)
+    assert streamed.shape == predictions.shape
+    numpy.testing.assert_array_equal(streamed, predictions)
+
+
+def test_store_backed_fit_and_predict(tmp_path):
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    affinities = numpy.random.uniform(0, 1, size=len(peptides))
+    EncodableSequences.create(peptides).save_store(
+        str(tmp_path / "store"),
+        index_encodings=[{'alignment_method': 'right_pad', 'max_length': 20}])
+
+    model = Class2NeuralNetwork(
+        max_epochs=2,
+        random_negative_rate=0.5,
+        random_negative_match_distribution=False,
+        **SMALL_NETWORK_HYPERPARAMETERS)
+    stored = EncodableSequences.load_store(str(tmp_path / "store"))
+    model.fit(
+        stored,
+        affinities,
+        allele_encoding_pair=allele_encoding,
+        verbose=0)
+    # Random negatives were planned from the stored lengths.
+    assert stored._sequences is None
+
+    predictions = model.predict(peptides, allele_encoding_pair=allele_encoding)
+    for kwargs in [{}, {'stream_block_size': 100}]:
+        stored = EncodableSequences.load_store(str(tmp_path / "store"))
+        numpy.testing.assert_allclose(
+            model.predict(
+                stored, allele_encoding_pair=allele_encoding, **kwargs),
+            predictions,
+            rtol=1e-6)
+        # Encodings were read from the store, without decoding the peptides.
+        assert stored._sequences is None
+
+
+def test_deduplicated_predict():
+    peptides = random_peptides(200, length=15) * 3
+    alleles = numpy.random.choice(
+        ["HLA-DRB1*01:01", "HLA-DRB1*03:01", "HLA-DRB1*04:01"],
+        size=len(peptides))
+    alleles[:200] = "HLA-DRB1*01:01"
+    allele_encoding = make_allele_encoding_pair(
+        alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+
+    (rows, inverse) = model.unique_input_rows(
+        EncodableSequences.create(peptides),
+        {
+            'alpha_allele': allele_encoding.alpha_allele_encoding.indices,
+            'beta_allele': allele_encoding.beta_allele_encoding.indices,
+        })
+    assert len(rows) < len(peptides)
+    assert (numpy.array(peptides)[rows][inverse] == peptides).all()
+    assert (alleles[rows][inverse] == alleles).all()
+
+    expected = model.predict(
+        peptides, allele_encoding_pair=allele_encoding, deduplicate=False)
+    numpy.testing.assert_allclose(
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        expected,
+        rtol=1e-6)
+
+    # The distinct peptides are encoded once per EncodableSequences, e.g.
+    # across ensemble members.
+    encodable = EncodableSequences.create(peptides)
+    encodable.encoding_cache = cache = EncodingCache()
+    model.predict(encodable, allele_encoding_pair=allele_encoding)
+    assert cache.info()["misses"] == 1
+    numpy.testing.assert_allclose(
+        model.predict(encodable, allele_encoding_pair=allele_encoding),
+        expected,
+        rtol=1e-6)
+    assert cache.info()["misses"] == 1
+    assert cache.info()["hits"] == 1
+
+
+def test_allele_slots():
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    slot_model = Class2NeuralNetwork.from_config(
+        model.get_config(), weights=model.get_weights())
+    slot_model.enable_allele_slots(2)
+
+    surgeries = None
+    allele_sets = [
+        ["HLA-DRB1*01:01"],
+        ["HLA-DRB1*03:01", "HLA-DRB1*04:01"],
+        ["HLA-DRB1*04:01"],
+        ["HLA-DRB1*01:01", "HLA-DRB1*03:01"],
+        ["HLA-DRB1*01:01", "HLA-DRB1*03:01"],
+    ]
+    for (i, allele_set) in enumerate(allele_sets):
+        alleles = numpy.random.choice(allele_set, size=len(peptides))
+        call_encoding = make_allele_encoding_pair(
+            alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+        call_encoding = AlleleEncodingPair(
+            call_encoding.alpha_allele_encoding.compact(),
+            call_encoding.beta_allele_encoding.compact())
+        numpy.testing.assert_allclose(
+            slot_model.predict(peptides, allele_encoding_pair=call_encoding),
+            model.predict(peptides, allele_encoding_pair=call_encoding),
+            rtol=1e-6)
+        # The only surgeries are sizing the tables on the first call.
+        if surgeries is None:
+            surgeries = slot_model.allele_representation_counters["surgeries"]
+            assert surgeries > 0
+        assert slot_model.allele_representation_counters[
+            "surgeries"] == surgeries
+
+    counters = slot_model.allele_representation_counters
+    assert counters["slot_hits"] > 0
+    assert counters["slot_misses"] > 0
+    assert "allele_slots" not in slot_model.get_config()
+
+    # A call with more alleles than slots grows the tables.
+    numpy.testing.assert_allclose(
+        slot_model.predict(peptides, allele_encoding_pair=allele_encoding),
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        rtol=1e-6)
+    assert slot_model.allele_representation_counters[
+        "surgeries"] > surgeries
+    assert slot_model.allele_slots["beta"].capacity == 4
+
+
+def test_split_allele_encoder_predict():
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=500)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    for output_index in [0, 1]:
+        predictions = model.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            output_index=output_index)
+        for stream_block_size in [None, 128]:
+            numpy.testing.assert_allclose(
+                model.predict(
+                    peptides,
+                    allele_encoding_pair=allele_encoding,
+                    output_index=output_index,
+                    stream_block_size=stream_block_size,
+                    split_allele_encoder=True),
+                predictions,
+                rtol=1e-6)
+
+    (allele_encoder, peptide_scorer) = model.allele_encoder_and_peptide_scorer()
+    assert allele_encoder.input_names == ["alpha_allele", "beta_allele"]
+    assert "peptide_first_convolution" not in [
+        layer.name for layer in allele_encoder.layers]
+    assert "allele_lc" not in [layer.name for layer in peptide_scorer.layers]
+
+
+def test_predict_matrix():
+    peptides = random_peptides(300, length=15) * 2
+    allele_encoding = make_allele_encoding_pair(
+        ["HLA-DRB1*04:01", "HLA-DRB1*01:01", "HLA-DRB1*03:01"],
+        ALPHA_SEQUENCES,
+        BETA_SEQUENCES)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    matrix = model.predict_matrix(
+        peptides, allele_encoding_pair=allele_encoding, batch_size=64)
+    assert matrix.shape == (len(peptides), 3)
+
+    for (j, allele) in enumerate(
+            ["HLA-DRB1*04:01", "HLA-DRB1*01:01", "HLA-DRB1*03:01"]):
+        column_encoding = make_allele_encoding_pair(
+            [allele] * len(peptides), ALPHA_SEQUENCES, BETA_SEQUENCES)
+        numpy.testing.assert_allclose(
+            matrix[:, j],
+            model.predict(
+                peptides, allele_encoding_pair=column_encoding).flatten(),
+            rtol=1e-5)
+
+
+def test_compiled_predict():
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    predictions = model.predict(peptides, allele_encoding_pair=allele_encoding)
+    numpy.testing.assert_allclose(
+        model.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            batch_size=128,
+            compiled=True),
+        predictions,
+        rtol=1e-6)
+
+    # Batches of 128, 128, and 44 rows use two buckets.
+    network = model.network()
+    assert sorted(Class2NeuralNetwork.COMPILED_PREDICT_FUNCTIONS[network]) == [
+        64, 128]
+    assert Class2NeuralNetwork.compiled_batch_size_bucket(1) == (
+        Class2NeuralNetwork.MIN_COMPILED_BATCH_SIZE)
+    assert Class2NeuralNetwork.compiled_batch_size_bucket(1000) == 1024
+
+    numpy.testing.assert_allclose(
+        model.predict(
+            peptides[:10],
+            allele_encoding_pair=allele_encoding.from_pairs(
+                allele_encoding.allele_pairs[:10]),
+            compiled=True),
+        predictions[:10],
+        rtol=1e-6)
+
+
+def test_concurrent_allele_specific_predict():
+    from concurrent.futures import ThreadPoolExecutor
+
+    peptides = random_peptides(500, length=15)
+    model = Class2NeuralNetwork(**SMALL_NETWORK_HYPERPARAMETERS)
+    model._network = model.make_network(
+        **model.network_hyperparameter_defaults.subselect(
+            model.hyperparameters))
+    config = model.get_config()
+
+    # Models sharing an architecture, with different weights.
+    models = [
+        Class2NeuralNetwork.from_config(
+            config,
+            weights=[
+                w + numpy.random.normal(scale=0.1, size=w.shape).astype(w.dtype)
+                for w in model.get_weights()
+            ])
+        for _ in range(4)
+    ]
+    expected = [model.predict(peptides) for model in models]
+    assert models[0].network_cache_key is not None
+    assert len(set(model.network_cache_key for model in models)) == 1
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda i: (i, models[i % 4].predict(peptides, batch_size=64)),
+            range(16)))
+    for (i, predictions) in results:
+        numpy.testing.assert_allclose(predictions, expected[i % 4], rtol=1e-6)
+    assert 1 <= len(Class2NeuralNetwork.KERAS_MODEL_POOLS[
+        models[0].network_cache_key]) <= 4
+
+
+def test_concurrent_pan_allele_predict():
+    from concurrent.futures import ThreadPoolExecutor
+
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=500)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+
+    # Two sets of alleles, with different allele representation tables.
+    allele_encodings = [
+        allele_encoding,
+        make_allele_encoding_pair(
+            ["HLA-DRB1*03:01"] * len(peptides),
+            ALPHA_SEQUENCES,
+            {"HLA-DRB1*03:01": BETA_SEQUENCES["HLA-DRB1*03:01"]}),
+    ]
+    expected = [
+        model.predict(peptides, allele_encoding_pair=encoding)
+        for encoding in allele_encodings
+    ]
+    matrix_encoding = make_allele_encoding_pair(
+        ["HLA-DRB1*01:01", "HLA-DRB1*04:01"], ALPHA_SEQUENCES, BETA_SEQUENCES)
+    expected_matrix = model.predict_matrix(peptides, matrix_encoding)
+
+    def predict(i):
+        if i % 3 == 2:
+            return model.predict_matrix(peptides, matrix_encoding)
+        return model.predict(
+            peptides,
+            allele_encoding_pair=allele_encodings[i % 3],
+            batch_size=64)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(predict, range(12)))
+    for (i, predictions) in enumerate(results):
+        numpy.testing.assert_allclose(
+            predictions,
+            expected_matrix if i % 3 == 2 else expected[i % 3],
+            rtol=1e-6)
+
+    # The lock is not serialized.
+    copied = pickle.loads(pickle.dumps(model))
+    numpy.testing.assert_allclose(
+        copied.predict(peptides, allele_encoding_pair=allele_encodings[1]),
+        expected[1],
+        rtol=1e-6)
+
+
+def test_merge():
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    models = [
+        make_untrained_network(allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+        for _ in range(20)
+    ]
+    individual_predictions = numpy.column_stack([
+        model.predict(
+            peptides, allele_encoding_pair=allele_encoding).flatten()
+        for model in models
+    ])
+
+    merged = Class2NeuralNetwork.merge(models, merge_method="concatenate")
+    assert len(merged.network().outputs) == 1
+    merged_predictions = merged.predict(
+        peptides, allele_encoding_pair=allele_encoding)
+    assert merged_predictions.shape == (len(peptides), 20)
+    numpy.testing.assert_allclose(
+        merged_predictions, individual_predictions, rtol=1e-6)
+
+    # The original networks are unchanged.
+    numpy.testing.assert_allclose(
+        models[3].predict(
+            peptides, allele_encoding_pair=allele_encoding).flatten(),
+        individual_predictions[:, 3],
+        rtol=1e-6)
+
+    averaged = Class2NeuralNetwork.merge(models[:3], merge_method="average")
+    numpy.testing.assert_allclose(
+        averaged.predict(
+            peptides, allele_encoding_pair=allele_encoding).flatten(),
+        individual_predictions[:, :3].mean(1),
+        rtol=1e-5)
+
+
+def test_inference_precision():
+    from mhc2flurry.reduced_precision import dequantize_int8, quantize_int8
+
+    kernel = numpy.random.normal(size=(5, 8, 3)).astype("float32")
+    (quantized, scales) = quantize_int8(kernel)
+    assert quantized.dtype == numpy.int8
+    assert scales.shape == (3,)
+    numpy.testing.assert_allclose(
+        dequantize_int8(quantized, scales), kernel, atol=scales.max() / 2)
+
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=500)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    expected = model.predict(peptides, allele_encoding_pair=allele_encoding)
+    for precision in ["float32", "float16", "bfloat16"]:
+        for simulate_int8_weights in [False, True]:
+            reduced = model.with_inference_precision(
+                precision, simulate_int8_weights=simulate_int8_weights)
+            predictions = reduced.predict(
+                peptides, allele_encoding_pair=allele_encoding)
+            if precision == "float32" and not simulate_int8_weights:
+                numpy.testing.assert_allclose(
+                    predictions, expected, rtol=1e-6)
+            else:
+                numpy.testing.assert_allclose(
+                    predictions, expected, atol=0.02)
+                assert not numpy.array_equal(predictions, expected)
+
+    # The original model is unchanged.
+    numpy.testing.assert_array_equal(
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        expected)
+
+
+def test_autotune_predict_batch_size(tmp_path, monkeypatch):
+    from mhc2flurry.batch_size_tuning import BatchSizeTuner
+
+    cache_path = str(tmp_path / "batch_sizes.json")
+    tuner = BatchSizeTuner(
+        cache_path=cache_path, candidate_batch_sizes=[16, 64, 256])
+    monkeypatch.setattr(Class2NeuralNetwork, "BATCH_SIZE_TUNER", tuner)
+
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    model = make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+    expected = model.predict(
+        peptides, allele_encoding_pair=allele_encoding, batch_size=4096)
+    assert model.predict_batch_size(autotune=False) == 4096
+
+    batch_size = model.autotune_predict_batch_size()
+    assert batch_size in (16, 64, 256)
+    assert model.predict_batch_size() == batch_size
+    numpy.testing.assert_allclose(
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        expected,
+        rtol=1e-6)
+
+    # Another process (here, tuner) reads the result from disk.
+    other_tuner = BatchSizeTuner(
+        cache_path=cache_path, candidate_batch_sizes=[16, 64, 256])
+    assert other_tuner.lookup(model.architecture_hash()) == batch_size
+
+    # Results for a different memory ceiling are not used. With a ceiling
+    # too small for any candidate, the smallest is used.
+    small_tuner = BatchSizeTuner(
+        cache_path=cache_path,
+        candidate_batch_sizes=[16, 64, 256],
+        memory_ceiling_bytes=1)
+    assert small_tuner.lookup(model.architecture_hash()) is None
+    monkeypatch.setattr(Class2NeuralNetwork, "BATCH_SIZE_TUNER", small_tuner)
+    assert model.predict_batch_size(autotune=True) == 16
+
+
+def test_peptide_padding_mask():
+    peptides = (
+        random_peptides(100, length=12) +
+        random_peptides(100, length=17) +
+        random_peptides(100, length=25))
+    alleles = numpy.random.choice(
+        ["HLA-DRB1*01:01", "HLA-DRB1*03:01", "HLA-DRB1*04:01"],
+        size=len(peptides))
+    allele_encoding = make_allele_encoding_pair(
+        alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+    hyperparameters = dict(
+        SMALL_NETWORK_HYPERPARAMETERS,
+        peptide_input_format="index",
+        peptide_padding_mask=True)
+    hyperparameters['peptide_encoding'] = dict(
+        hyperparameters['peptide_encoding'], max_length=30)
+    model = make_untrained_network(allele_encoding, **hyperparameters)
+
+    untrimmed = model.predict(
+        peptides, allele_encoding_pair=allele_encoding, length_buckets=False)
+    numpy.testing.assert_allclose(
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        untrimmed,
+        rtol=1e-6)
+    numpy.testing.assert_allclose(
+        model.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            compiled=True,
+            batch_size=64),
+        untrimmed,
+        rtol=1e-5)
+
+    # The same weights give the same predictions with more padding.
+    more_padding = dict(hyperparameters)
+    more_padding['peptide_encoding'] = dict(
+        hyperparameters['peptide_encoding'], max_length=50)
+    more_padding_model = Class2NeuralNetwork.from_config(
+        dict(model.get_config(), hyperparameters=more_padding),
+        weights=model.get_weights())
+    numpy.testing.assert_allclose(
+        more_padding_model.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            length_buckets=False),
+        untrimmed,
+        rtol=1e-5)
+
+    pairs = make_allele_encoding_pair(
+        ["HLA-DRB1*01:01", "HLA-DRB1*04:01"], ALPHA_SEQUENCES, BETA_SEQUENCES)
+    matrix = model.predict_matrix(peptides[:50], pairs)
+    for (i, allele) in enumerate(["HLA-DRB1*01:01", "HLA-DRB1*04:01"]):
+        numpy.testing.assert_allclose(
+            matrix[:, i],
+            model.predict(
+                peptides[:50],
+                allele_encoding_pair=make_allele_encoding_pair(
+                    [allele] * 50, ALPHA_SEQUENCES, BETA_SEQUENCES)).flatten(),
+            rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        model.with_peptide_input_format("vector")
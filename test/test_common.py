@@ -1,4 +1,18 @@
-from mhc2flurry.common import make_allele_pairs
+import json
+import os
+import tempfile
+
+import pytest
+
+from mhc2flurry import common
+from mhc2flurry.common import (
+    expand_genotypes,
+    make_allele_pairs,
+    normalize_allele_name,
+    normalize_allele_names,
+    save_allele_name_cache,
+    load_allele_name_cache,
+)
 
 
 def test_allele_pairs():
@@ -29,3 +43,86 @@ def test_allele_pairs():
         'HLA-DQA1*02:01-DQB1*02:02',
         'HLA-DQA1*02:01-DQB1*05:02',
     ]
+
+
+def test_normalize_allele_names():
+    names = ["DRB1*01:01", "HLA-DRB1*01:01:02", "DRB1*01:01", "HLA-DRB1"]
+    assert list(normalize_allele_names(names, raise_on_error=False)) == [
+        "HLA-DRB1*01:01", "HLA-DRB1*01:01", "HLA-DRB1*01:01", None]
+    assert list(normalize_allele_names(names[:3])) == ["HLA-DRB1*01:01"] * 3
+    with pytest.raises(ValueError, match="HLA-DRB1"):
+        normalize_allele_names(names)
+    with pytest.raises(ValueError):
+        normalize_allele_names(["DRB1*01:01", None])
+    assert normalize_allele_name("DRB1*01:01") == "HLA-DRB1*01:01"
+    with pytest.raises(ValueError):
+        normalize_allele_name("HLA-DRB1", raise_on_error=True)
+
+
+def test_allele_name_cache_persistence(monkeypatch):
+    normalize_allele_name("DQA1*01:02-DQB1*01:02")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "allele_names.json")
+        save_allele_name_cache(filename)
+        with open(filename) as fd:
+            saved = json.load(fd)
+        assert saved["DQA1*01:02-DQB1*01:02"] == "HLA-DQA1*01:02-DQB1*01:02"
+
+        common._NORMALIZED_ALLELE_NAMES.clear()
+        load_allele_name_cache(filename)
+        assert common._NORMALIZED_ALLELE_NAMES[
+            "DQA1*01:02-DQB1*01:02"] == "HLA-DQA1*01:02-DQB1*01:02"
+
+    # Loaded names are not parsed again.
+    monkeypatch.setattr(common, "_normalize_allele_name", None)
+    assert normalize_allele_name(
+        "DQA1*01:02-DQB1*01:02") == "HLA-DQA1*01:02-DQB1*01:02"
+
+
+def test_allele_name_cache_loaded_once(monkeypatch, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    filename = str(tmp_path / "allele_names.json")
+    with open(filename, "w") as fd:
+        json.dump({"DRB1*01:01": "HLA-DRB1*01:01"}, fd)
+    monkeypatch.setattr(common, "ALLELE_NAME_CACHE_PATH", filename)
+    monkeypatch.setattr(common, "_ALLELE_NAME_CACHE_LOADED", False)
+    monkeypatch.setattr(common.atexit, "register", lambda *args: None)
+    common._NORMALIZED_ALLELE_NAMES.clear()
+
+    loads = []
+    original_load = json.load
+
+    def counting_load(fd):
+        loads.append(fd.name)
+        return original_load(fd)
+
+    monkeypatch.setattr(common.json, "load", counting_load)
+    names = ["DRB1*01:01", "DRB1*03:01", "DRB1*04:01", "DRB1*07:01"] * 4
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(normalize_allele_name, names))
+    assert results[:4] == [
+        "HLA-DRB1*01:01", "HLA-DRB1*03:01", "HLA-DRB1*04:01", "HLA-DRB1*07:01"]
+    assert loads == [filename]
+    assert common._ALLELE_NAME_CACHE_LOADED
+    assert len(common._NORMALIZED_ALLELE_NAMES) == 4
+
+
+def test_expand_genotypes():
+    genotypes = [
+        ["HLA-DRB1*07:01", "HLA-DRB1*16:01", "HLA-DQA1*01:02", "HLA-DQB1*02:02"],
+        ["HLA-DRB1*07:01", "HLA-DRB1*07:01"],
+        [],
+        ["HLA-DRB1*16:01", "HLA-DPA1*01:03", "HLA-DPB1*02:01"],
+    ]
+    (pairs, matrix) = expand_genotypes(genotypes)
+    assert pairs == [
+        'HLA-DRA*01:01-DRB1*07:01',
+        'HLA-DRA*01:01-DRB1*16:01',
+        'HLA-DQA1*01:02-DQB1*02:02',
+        'HLA-DPA1*01:03-DPB1*02:01',
+    ]
+    assert matrix.shape == (4, 4)
+    for (genotype, row) in zip(genotypes, matrix.toarray()):
+        assert sorted(pairs[j] for j in row.nonzero()[0]) == sorted(
+            set(make_allele_pairs(genotype)))
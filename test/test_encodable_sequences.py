@@ -0,0 +1,223 @@
+import math
+
+import numpy
+import pandas
+import pytest
+
+from mhc2flurry import amino_acid
+from mhc2flurry.encodable_sequences import EncodableSequences, EncodingError
+from mhc2flurry.common import random_peptides
+
+
+def decode(index_encoded):
+    return "".join(amino_acid.AMINO_ACIDS[i] for i in index_encoded)
+
+
+def reference_index_encoding(
+        sequence,
+        alignment_method,
+        max_length,
+        left_edge=4,
+        right_edge=4,
+        allow_unsupported_amino_acids=False):
+    """
+    Straightforward per-character implementation of the alignment methods,
+    used to check the vectorized implementation.
+    """
+    if allow_unsupported_amino_acids:
+        sequence = "".join(
+            c if c in amino_acid.AMINO_ACID_INDEX else "X" for c in sequence)
+    sequence = sequence.upper()
+    length = len(sequence)
+    if alignment_method == "pad_middle":
+        num_null = max_length - length
+        num_null_left = int(math.ceil(num_null / 2))
+        middle = sequence[left_edge:length - right_edge]
+        middle_length = max_length - left_edge - right_edge
+        result = (
+            sequence[:left_edge] +
+            "X" * num_null_left +
+            middle +
+            "X" * (middle_length - num_null_left - len(middle)) +
+            sequence[length - right_edge:])
+    elif alignment_method == "left_pad_right_pad":
+        padding = "X" * (max_length - length)
+        result = sequence + padding + padding + sequence
+    elif alignment_method == "left_pad_centered_right_pad":
+        padding = "X" * (max_length - length)
+        center_left = (max_length - length) // 2
+        center = (
+            "X" * center_left + sequence +
+            "X" * (max_length - length - center_left))
+        result = sequence + padding + center + padding + sequence
+    elif alignment_method == "right_pad":
+        result = sequence[:max_length].ljust(max_length, "X")
+    elif alignment_method == "left_pad":
+        result = sequence[-max_length:].rjust(max_length, "X")
+    else:
+        raise ValueError(alignment_method)
+    return [amino_acid.AMINO_ACID_INDEX[c] for c in result]
+
+
+def test_alignment_method_examples():
+    examples = {
+        "pad_middle": "AAAAXXXCXXXDDDD",
+        "left_pad_centered_right_pad": (
+            "AAAACDDDDXXXXXX" "XXXAAAACDDDDXXX" "XXXXXXAAAACDDDD"),
+        "left_pad_right_pad": "AAAACDDDDXXXXXXXXXXXXAAAACDDDD",
+        "right_pad": "AAAACDDDDXXXXXX",
+        "left_pad": "XXXXXXAAAACDDDD",
+    }
+    for (alignment_method, expected) in examples.items():
+        result = EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+            ["AAAACDDDD"], alignment_method=alignment_method, max_length=15)
+        assert result.dtype == numpy.int32
+        assert decode(result[0]) == expected, alignment_method
+
+
+def test_index_encoding_matches_reference():
+    numpy.random.seed(0)
+    peptides = []
+    for length in range(8, 16):
+        peptides.extend(random_peptides(20, length=length))
+    peptides[::5] = [p.lower() for p in peptides[::5]]
+    numpy.random.shuffle(peptides)
+
+    for alignment_method in [
+            "pad_middle",
+            "left_pad_right_pad",
+            "left_pad_centered_right_pad",
+            "right_pad",
+            "left_pad"]:
+        expected = numpy.array([
+            reference_index_encoding(p, alignment_method, max_length=15)
+            for p in peptides
+        ])
+        for sequences in [
+                peptides,
+                numpy.array(peptides),
+                numpy.array(peptides, dtype=object),
+                numpy.array(peptides).astype(numpy.bytes_)]:
+            result = (
+                EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+                    sequences,
+                    alignment_method=alignment_method,
+                    max_length=15))
+            numpy.testing.assert_array_equal(result, expected)
+
+
+def test_trim():
+    peptides = ["ACDEFGHIKL", "ACDEF", "ACDEFGHIKLMNPQRSTVWY"]
+    for alignment_method in ["right_pad", "left_pad"]:
+        expected = numpy.array([
+            reference_index_encoding(p, alignment_method, max_length=12)
+            for p in peptides
+        ])
+        result = EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+            peptides,
+            alignment_method=alignment_method,
+            max_length=12,
+            trim=True)
+        numpy.testing.assert_array_equal(result, expected)
+
+        with pytest.raises(EncodingError):
+            EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+                peptides, alignment_method=alignment_method, max_length=12)
+
+
+def test_unsupported_amino_acids():
+    peptides = ["ACDEFGHIKL", "ACDBZGHIKL", "ACDÅFGHIKL"]
+    result = EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+        peptides,
+        alignment_method="right_pad",
+        max_length=12,
+        allow_unsupported_amino_acids=True)
+    assert [decode(row) for row in result] == [
+        "ACDEFGHIKLXX", "ACDXXGHIKLXX", "ACDXFGHIKLXX"]
+
+    with pytest.raises(KeyError, match="B"):
+        EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+            peptides, alignment_method="right_pad", max_length=12)
+
+    # The unsupported residue is reported for trimmed and bytes sequences.
+    for alignment_method in ["right_pad", "left_pad"]:
+        for sequences in [["ACDEFGHIK1"], numpy.array([b"ACDEFGHIK1"])]:
+            with pytest.raises(KeyError, match="1"):
+                EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+                    sequences,
+                    alignment_method=alignment_method,
+                    max_length=12 if alignment_method == "right_pad" else 4,
+                    trim=True)
+
+
+def test_vector_encoding_dtype():
+    peptides = EncodableSequences.create(["ACDEFGHIKL", "ACDEFGHI"])
+    default = peptides.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62", max_length=12)
+    assert default.dtype == amino_acid.BLOSUM62_MATRIX.values.dtype
+    result = peptides.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62", max_length=12, dtype="float32")
+    assert result.dtype == numpy.float32
+    numpy.testing.assert_array_equal(result, default)
+
+    # Cache is keyed by dtype.
+    assert peptides.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62", max_length=12, dtype="float32") is result
+    assert peptides.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62", max_length=12).dtype == default.dtype
+
+
+def test_unique():
+    peptides = ["SIINFEKLAA", "ACDEFGHIKL", "SIINFEKLAA", "SYFPEITHI", "ACDEFGHIKL"]
+    encodable = EncodableSequences.create(peptides)
+    (unique, inverse) = encodable.unique()
+    assert list(unique.sequences) == ["SIINFEKLAA", "ACDEFGHIKL", "SYFPEITHI"]
+    assert list(unique.sequences[inverse]) == peptides
+    assert encodable.unique()[0] is unique
+
+    expected = numpy.array([
+        reference_index_encoding(p, "pad_middle", max_length=15)
+        for p in peptides
+    ])
+    numpy.testing.assert_array_equal(
+        encodable.variable_length_to_fixed_length_categorical(), expected)
+    numpy.testing.assert_array_equal(
+        encodable.variable_length_to_fixed_length_vector_encoding("one-hot"),
+        numpy.eye(21, dtype=int)[expected])
+
+
+def test_construction_from_arrays():
+    peptides = ["SIINFEKL", "ACDEFGHIKL", "SYFPEITHI"]
+    for sequences in [
+            peptides,
+            numpy.array(peptides),
+            numpy.array(peptides).astype(numpy.bytes_),
+            pandas.Series(peptides).values,
+            EncodableSequences.from_bytes(
+                "".join(peptides).encode(), [0, 8, 18, 27]).sequences]:
+        encodable = EncodableSequences.create(sequences)
+        assert list(encodable.sequences) == peptides
+        assert encodable.sequences.dtype.kind == "U"
+        assert (encodable.min_length, encodable.max_length) == (8, 10)
+        assert encodable.fixed_sequence_length is None
+
+    encodable = EncodableSequences.create(numpy.array(["SIINFEKL"] * 3))
+    assert encodable.fixed_sequence_length == 8
+
+    for offsets in [[], [0]]:
+        assert len(EncodableSequences.from_bytes(b"", offsets)) == 0
+
+    with pytest.raises(ValueError):
+        EncodableSequences.create(["SIINFEKL", 5])
+
+
+def test_construction_from_arrow():
+    pyarrow = pytest.importorskip("pyarrow")
+    peptides = ["SIINFEKL", "ACDEFGHIKL", "SYFPEITHI", "AAAAAAAA"]
+    for array in [
+            pyarrow.array(peptides),
+            pyarrow.array(peptides, type=pyarrow.large_string()),
+            pyarrow.array(peptides)[1:],
+            pyarrow.chunked_array([peptides[:2], peptides[2:]])]:
+        encodable = EncodableSequences.create(array)
+        assert list(encodable.sequences) == peptides[-len(array):]
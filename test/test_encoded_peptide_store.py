@@ -0,0 +1,77 @@
+import pickle
+import tempfile
+from os.path import join
+
+import numpy
+
+from mhc2flurry.encodable_sequences import EncodableSequences
+from mhc2flurry.common import random_peptides
+
+
+def test_store_round_trip():
+    numpy.random.seed(0)
+    peptides = random_peptides(50, length=12) + random_peptides(50, length=18)
+    encodable = EncodableSequences.create(peptides)
+    encodings = [
+        {"max_length": 20},
+        {
+            "alignment_method": "left_pad_centered_right_pad",
+            "max_length": 20,
+        },
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = join(tmpdir, "store")
+        stored = encodable.save_store(path, index_encodings=encodings)
+        assert stored._sequences is None
+        assert len(stored) == len(peptides)
+        assert (stored.min_length, stored.max_length) == (12, 18)
+        assert stored.fixed_sequence_length is None
+
+        for kwargs in encodings + [{"alignment_method": "right_pad", "max_length": 20}]:
+            numpy.testing.assert_array_equal(
+                stored.variable_length_to_fixed_length_categorical(**kwargs),
+                encodable.variable_length_to_fixed_length_categorical(
+                    **kwargs))
+            numpy.testing.assert_array_equal(
+                stored.variable_length_to_fixed_length_vector_encoding(
+                    "BLOSUM62", **kwargs),
+                encodable.variable_length_to_fixed_length_vector_encoding(
+                    "BLOSUM62", **kwargs))
+
+        # Stored encodings are returned without copying for 1-byte dtypes.
+        int8_encoding = stored.variable_length_to_fixed_length_categorical(
+            max_length=20, dtype="int8")
+        assert isinstance(int8_encoding.base, numpy.memmap)
+        assert int8_encoding.dtype == numpy.int8
+
+        unpickled = pickle.loads(pickle.dumps(stored))
+        assert unpickled._sequences is None
+        assert list(unpickled.sequences) == peptides
+        assert list(stored.sequences) == peptides
+
+
+def test_store_subset():
+    numpy.random.seed(0)
+    peptides = random_peptides(50, length=12) + random_peptides(50, length=18)
+    encodable = EncodableSequences.create(peptides)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stored = encodable.save_store(
+            join(tmpdir, "store"), index_encodings=[{"max_length": 20}])
+        mask = numpy.arange(len(peptides)) % 3 == 0
+        subset = stored.subset(mask).subset(slice(5, None))
+        expected = numpy.array(peptides)[mask][5:]
+        assert len(subset) == len(expected)
+        numpy.testing.assert_array_equal(
+            subset.lengths, [len(p) for p in expected])
+        numpy.testing.assert_array_equal(
+            subset.variable_length_to_fixed_length_categorical(
+                max_length=20),
+            EncodableSequences.create(
+                expected).variable_length_to_fixed_length_categorical(
+                    max_length=20))
+        assert subset._sequences is None
+        assert subset.store.content_hash != stored.store.content_hash
+
+        unpickled = pickle.loads(pickle.dumps(subset))
+        assert list(unpickled.sequences) == list(expected)
+        assert list(subset.sequences) == list(expected)
@@ -0,0 +1,87 @@
+import numpy
+import pytest
+
+from mhc2flurry.encodable_sequences import EncodableSequences
+from mhc2flurry.encoding_cache import EncodingCache, content_hash
+
+
+def test_lru_eviction_and_counters():
+    cache = EncodingCache(max_bytes=250)
+    cache.put("a", numpy.zeros(100, dtype="uint8"))
+    cache.put("b", numpy.zeros(100, dtype="uint8"))
+    assert cache.get("a") is not None  # "b" is now least recently used
+    cache.put("c", numpy.zeros(100, dtype="uint8"))
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.get("b") is None
+
+    # Too large to cache at all.
+    cache.put("d", numpy.zeros(1000, dtype="uint8"))
+    assert "d" not in cache
+
+    info = cache.info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+    assert info["evictions"] == 1
+    assert info["entries"] == 2
+    assert info["current_bytes"] == 200
+
+    cache.set_max_bytes(100)
+    assert len(cache) == 1
+    assert "c" in cache
+
+
+def test_computed_values_are_read_only():
+    cache = EncodingCache(max_bytes=1000)
+    value = cache.get_or_compute("a", lambda: numpy.arange(10))
+    with pytest.raises(ValueError):
+        value[0] = 1
+    assert cache.get_or_compute("a", lambda: 1 / 0) is value
+
+
+def test_encodings_shared_across_instances():
+    peptides = ["SIINFEKLAAAA", "ACDEFGHIKLMN", "SYFPEITHI"]
+    assert content_hash(numpy.array(peptides)) != content_hash(
+        numpy.array(peptides[:2]))
+
+    cache = EncodingCache()
+    first = EncodableSequences.create(peptides)
+    second = EncodableSequences.create(list(peptides))
+    first.encoding_cache = second.encoding_cache = cache
+    result = first.variable_length_to_fixed_length_vector_encoding("BLOSUM62")
+    assert second.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62") is result
+    assert cache.info()["hits"] == 1
+
+
+def test_content_hash_of_object_array():
+    peptides = ["SIINFEKLAAAA", "ACDEFGHIKLMN", "SYFPEITHI"]
+    assert content_hash(numpy.array(peptides, dtype=object)) == content_hash(
+        numpy.array(peptides))
+
+
+def test_content_hash_ignores_string_width():
+    peptides = ["SIINFEKLAAAA", "ACDEFGHIKLMN", "SYFPEITHI"]
+    expected = content_hash(numpy.array(peptides))
+    for array in [
+            numpy.array(peptides, dtype="U15"),
+            numpy.array(peptides, dtype="U30"),
+            numpy.array(peptides, dtype=object).astype(numpy.str_),
+            numpy.array(peptides).astype(numpy.bytes_)]:
+        assert content_hash(array) == expected
+    assert content_hash(numpy.array(peptides[2:], dtype="U15")) == (
+        content_hash(numpy.array(peptides[2:])))
+    assert content_hash(numpy.array(["SIINFEKL"])) != content_hash(
+        numpy.array(["SIINFEK"]))
+    assert content_hash(numpy.array([], dtype="U5")) == content_hash(
+        numpy.array([], dtype="U1"))
+
+    # Instances holding the same peptides at different widths share
+    # encodings.
+    cache = EncodingCache()
+    first = EncodableSequences.create(numpy.array(peptides))
+    second = EncodableSequences.create(numpy.array(peptides, dtype="U20"))
+    first.encoding_cache = second.encoding_cache = cache
+    result = first.variable_length_to_fixed_length_vector_encoding("BLOSUM62")
+    assert second.variable_length_to_fixed_length_vector_encoding(
+        "BLOSUM62") is result
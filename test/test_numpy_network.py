@@ -0,0 +1,182 @@
+import logging
+logging.getLogger('tensorflow').disabled = True
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy
+numpy.random.seed(0)
+
+import pytest
+
+from mhc2flurry.class2_neural_network import Class2NeuralNetwork
+from mhc2flurry.common import random_peptides
+
+from mhc2flurry.testing_utils import cleanup, startup
+
+from test_class2_neural_network import (
+    ALPHA_SEQUENCES,
+    BETA_SEQUENCES,
+    SMALL_NETWORK_HYPERPARAMETERS,
+    make_allele_encoding_pair,
+    make_prediction_inputs,
+    make_untrained_network,
+)
+teardown = cleanup
+setup = startup
+
+
+def perturb_weights(model):
+    """
+    Return a copy of a model with random noise added to its weights, so that
+    e.g. batch normalization statistics are not trivial.
+    """
+    return Class2NeuralNetwork.from_config(
+        model.get_config(),
+        weights=[
+            w + numpy.random.normal(scale=0.1, size=w.shape).astype(w.dtype)
+            for w in model.get_weights()
+        ])
+
+
+@pytest.mark.parametrize("hyperparameters", [
+    {},
+    {'peptide_input_format': "index"},
+    {'batch_normalization': True, 'dropout_probability': 0.5},
+])
+def test_pan_allele_parity(hyperparameters):
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=500)
+    model = perturb_weights(make_untrained_network(
+        allele_encoding,
+        **dict(SMALL_NETWORK_HYPERPARAMETERS, **hyperparameters)))
+
+    for output_index in [0, 1]:
+        expected = model.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            output_index=output_index)
+        numpy.testing.assert_allclose(
+            model.predict(
+                peptides,
+                allele_encoding_pair=allele_encoding,
+                output_index=output_index,
+                backend="numpy",
+                batch_size=64),
+            expected,
+            rtol=1e-5,
+            atol=1e-6)
+
+    # A model loaded from weights (without a Keras network) predicts without
+    # building one.
+    reloaded = Class2NeuralNetwork.from_config(
+        model.get_config(), weights=model.get_weights())
+    numpy.testing.assert_allclose(
+        reloaded.predict(
+            peptides, allele_encoding_pair=allele_encoding, backend="numpy"),
+        model.predict(peptides, allele_encoding_pair=allele_encoding),
+        rtol=1e-5,
+        atol=1e-6)
+    assert reloaded._network is None
+
+
+def test_allele_specific_and_merged_parity():
+    peptides = random_peptides(300, length=15)
+    model = Class2NeuralNetwork(**SMALL_NETWORK_HYPERPARAMETERS)
+    model._network = model.make_network(
+        **model.network_hyperparameter_defaults.subselect(
+            model.hyperparameters))
+    model = perturb_weights(model)
+    numpy.testing.assert_allclose(
+        model.predict(peptides, backend="numpy"),
+        model.predict(peptides),
+        rtol=1e-5,
+        atol=1e-6)
+
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    models = [
+        make_untrained_network(allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+        for _ in range(3)
+    ]
+    for model in models:
+        # Merged networks share the allele representations of their members.
+        model.set_allele_representations(
+            model.allele_encoding_to_network_input(
+                allele_encoding.alpha_allele_encoding)[1],
+            model.allele_encoding_to_network_input(
+                allele_encoding.beta_allele_encoding)[1])
+    merged = Class2NeuralNetwork.merge(models, merge_method="concatenate")
+    numpy.testing.assert_allclose(
+        merged.predict(
+            peptides, allele_encoding_pair=allele_encoding, backend="numpy"),
+        merged.predict(peptides, allele_encoding_pair=allele_encoding),
+        rtol=1e-5,
+        atol=1e-6)
+
+    with pytest.raises(ValueError):
+        merged.predict(
+            peptides,
+            allele_encoding_pair=allele_encoding,
+            backend="numpy",
+            compiled=True)
+
+
+def test_concurrent_numpy_predict():
+    from concurrent.futures import ThreadPoolExecutor
+
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=500)
+    model = perturb_weights(make_untrained_network(
+        allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS))
+    # Without a Keras network, calls share one cached NumpyNetwork.
+    reloaded = Class2NeuralNetwork.from_config(
+        model.get_config(), weights=model.get_weights())
+
+    # Two sets of alleles, with different allele representation tables.
+    allele_encodings = [
+        allele_encoding,
+        make_allele_encoding_pair(
+            ["HLA-DRB1*03:01"] * len(peptides),
+            ALPHA_SEQUENCES,
+            {"HLA-DRB1*03:01": BETA_SEQUENCES["HLA-DRB1*03:01"]}),
+    ]
+    expected = [
+        model.predict(peptides, allele_encoding_pair=encoding)
+        for encoding in allele_encodings
+    ]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda i: reloaded.predict(
+                peptides,
+                allele_encoding_pair=allele_encodings[i % 2],
+                backend="numpy",
+                batch_size=16),
+            range(16)))
+    for (i, predictions) in enumerate(results):
+        numpy.testing.assert_allclose(
+            predictions, expected[i % 2], rtol=1e-5, atol=1e-6)
+    assert reloaded._network is None
+
+
+def test_numpy_backend_does_not_import_tensorflow():
+    code = "\n".join([
+        "import sys",
+        "import numpy",
+        "from mhc2flurry.class2_neural_network import Class2NeuralNetwork",
+        "from mhc2flurry.common import random_peptides",
+        "model = Class2NeuralNetwork.from_config(*numpy.load(",
+        "    sys.argv[1], allow_pickle=True)['model'])",
+        "model.predict(random_peptides(10, length=15), backend='numpy')",
+        "assert 'tensorflow' not in sys.modules",
+    ])
+    model = Class2NeuralNetwork(**SMALL_NETWORK_HYPERPARAMETERS)
+    model._network = model.make_network(
+        **model.network_hyperparameter_defaults.subselect(
+            model.hyperparameters))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "model.npz")
+        model_array = numpy.empty(2, dtype=object)
+        model_array[:] = [model.get_config(), model.get_weights()]
+        numpy.savez(filename, model=model_array)
+        subprocess.check_call([sys.executable, "-c", code, filename])
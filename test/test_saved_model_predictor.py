@@ -0,0 +1,74 @@
+import tempfile
+
+import numpy
+import pytest
+
+from mhc2flurry.allele_encoding import AlleleEncoding
+from mhc2flurry.regression_target import to_ic50
+from mhc2flurry.saved_model_predictor import SavedModelPredictor
+
+from mhc2flurry.testing_utils import cleanup, startup
+
+from test_class2_neural_network import (
+    make_prediction_inputs,
+    make_untrained_network,
+    SMALL_NETWORK_HYPERPARAMETERS,
+    ALPHA_SEQUENCES,
+    BETA_SEQUENCES,
+)
+
+teardown = cleanup
+setup = startup
+
+
+@pytest.mark.parametrize("num_models", [1, 3])
+def test_export_and_predict(num_models):
+    (peptides, allele_encoding) = make_prediction_inputs(num_peptides=300)
+    models = [
+        make_untrained_network(allele_encoding, **SMALL_NETWORK_HYPERPARAMETERS)
+        for _ in range(num_models)
+    ]
+    individual_predictions = numpy.column_stack([
+        to_ic50(model.predict(
+            peptides, allele_encoding_pair=allele_encoding).flatten())
+        for model in models
+    ])
+
+    representations = [
+        model.network().get_layer("beta_allele_representation").get_weights()
+        for model in models
+    ]
+
+    universe = AlleleEncoding(
+        allele_to_sequence=dict(ALPHA_SEQUENCES, **BETA_SEQUENCES))
+    with tempfile.TemporaryDirectory() as path:
+        SavedModelPredictor.export(models, universe, path)
+        predictor = SavedModelPredictor(path)
+        assert predictor.num_models == num_models
+        (predictions, bundle_individual_predictions) = predictor.predict(
+            peptides,
+            alpha_alleles=allele_encoding.alpha_allele_encoding.alleles,
+            beta_alleles=allele_encoding.beta_allele_encoding.alleles,
+            batch_size=128,
+            include_individual_model_predictions=True)
+
+    numpy.testing.assert_allclose(
+        bundle_individual_predictions, individual_predictions, rtol=1e-4)
+    numpy.testing.assert_allclose(
+        predictions,
+        numpy.exp(numpy.log(individual_predictions).mean(1)),
+        rtol=1e-4)
+
+    # The exported models are unchanged.
+    for (model, model_representations) in zip(models, representations):
+        for (before, after) in zip(
+                model_representations,
+                model.network().get_layer(
+                    "beta_allele_representation").get_weights()):
+            numpy.testing.assert_array_equal(before, after)
+
+    with pytest.raises(ValueError):
+        predictor.predict(
+            peptides[:1],
+            alpha_alleles=["HLA-DRA*01:01"],
+            beta_alleles=["HLA-DRB1*15:01"])
@@ -0,0 +1,321 @@
+"""
+Profile peptide encoding and prediction speed.
+
+When run by the test runner, small problem sizes are used. Run this file
+directly to benchmark at scale, e.g.:
+
+    $ python test/test_speed.py --num-peptides 1000000 10000000 50000000
+
+or to compare prediction latency of the Keras and compiled paths:
+
+    $ python test/test_speed.py --num-peptides --request-sizes 1 10 100 100000
+
+or to compare cold start times of an ensemble restored from model configs and
+weights (as in `Class2AffinityPredictor.load`) and from a SavedModel bundle:
+
+    $ python test/test_speed.py --num-peptides --cold-start-num-models 20
+
+or to compare prediction throughput at each inference precision (see
+`Class2NeuralNetwork.with_inference_precision`):
+
+    $ python test/test_speed.py --num-peptides --precision-num-peptides 100000
+"""
+import argparse
+import sys
+import tempfile
+import time
+import cProfile
+import pstats
+
+import numpy
+numpy.random.seed(0)
+
+from mhc2flurry import amino_acid
+from mhc2flurry.allele_encoding import AlleleEncoding
+from mhc2flurry.class2_neural_network import Class2NeuralNetwork
+from mhc2flurry.common import random_peptides
+from mhc2flurry.encodable_sequences import EncodableSequences
+from mhc2flurry.saved_model_predictor import SavedModelPredictor
+
+from test_class2_neural_network import (
+    make_allele_encoding_pair,
+    make_untrained_network,
+    ALPHA_SEQUENCES,
+    BETA_SEQUENCES,
+)
+
+DEFAULT_NUM_PEPTIDES = 100000
+
+
+def random_peptide_array(num, min_length=12, max_length=25):
+    """
+    Generate random peptides as a numpy bytes array. This is much faster than
+    `common.random_peptides` and makes it feasible to benchmark tens of
+    millions of peptides.
+    """
+    letters = numpy.frombuffer(
+        "".join(amino_acid.COMMON_AMINO_ACIDS).encode(), dtype=numpy.uint8)
+    matrix = letters[
+        numpy.random.randint(0, len(letters), size=(num, max_length))
+    ]
+    lengths = numpy.random.randint(min_length, max_length + 1, size=num)
+    matrix[numpy.arange(max_length) >= lengths[:, None]] = 0
+    return matrix.view("S%d" % max_length).ravel()
+
+
+def benchmark_index_encoding(
+        profile=False,
+        num=DEFAULT_NUM_PEPTIDES,
+        alignment_methods=(
+            "pad_middle",
+            "left_pad_right_pad",
+            "left_pad_centered_right_pad",
+            "right_pad",
+            "left_pad")):
+    peptides = random_peptide_array(num)
+    max_length = 25
+    result = {}
+    for alignment_method in alignment_methods:
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        EncodableSequences.sequences_to_fixed_length_index_encoded_array(
+            peptides,
+            alignment_method=alignment_method,
+            left_edge=4,
+            right_edge=4,
+            max_length=max_length)
+        elapsed = time.time() - start
+        print("Index encoded %d peptides with %s in %0.2f sec (%0.0f / sec)" % (
+            num, alignment_method, elapsed, num / elapsed))
+        if profile:
+            profiler.disable()
+            result[alignment_method] = pstats.Stats(profiler)
+    return result
+
+
+def test_speed_index_encoding():
+    benchmark_index_encoding(num=DEFAULT_NUM_PEPTIDES)
+
+
+def benchmark_predict_latency(
+        request_sizes=(1, 10, 100, 1000, 10000, 100000),
+        num_requests=20):
+    """
+    Compare the latency of Class2NeuralNetwork.predict through
+    keras.Model.predict and through the compiled path, for requests of the
+    given numbers of peptides.
+
+    Returns
+    -------
+    pandas.DataFrame with p50 and p99 latencies (sec) for each request size
+    and path
+    """
+    import pandas
+
+    alleles = sorted(BETA_SEQUENCES)
+    model = make_untrained_network(
+        make_allele_encoding_pair(alleles, ALPHA_SEQUENCES, BETA_SEQUENCES))
+    rows = []
+    for request_size in request_sizes:
+        peptides = EncodableSequences.create(
+            random_peptides(request_size, length=15))
+        allele_encoding = make_allele_encoding_pair(
+            numpy.random.choice(alleles, size=request_size),
+            ALPHA_SEQUENCES,
+            BETA_SEQUENCES)
+        for compiled in [False, True]:
+            # Warm up: trace functions and fill encoding caches.
+            model.predict(
+                peptides, allele_encoding_pair=allele_encoding, compiled=compiled)
+            latencies = []
+            for _ in range(num_requests):
+                start = time.time()
+                model.predict(
+                    peptides,
+                    allele_encoding_pair=allele_encoding,
+                    compiled=compiled)
+                latencies.append(time.time() - start)
+            rows.append((
+                request_size,
+                "compiled" if compiled else "keras",
+                numpy.percentile(latencies, 50),
+                numpy.percentile(latencies, 99)))
+            print("Predicted %d peptides (%s): p50 %0.4f sec, p99 %0.4f sec" % (
+                rows[-1]))
+    return pandas.DataFrame(
+        rows, columns=["request_size", "path", "p50", "p99"])
+
+
+def test_speed_predict_latency():
+    benchmark_predict_latency(request_sizes=(1, 100), num_requests=3)
+
+
+def benchmark_cold_start(num_models=20):
+    """
+    Compare the time to the first prediction of an ensemble restored from
+    model configs and weights, with the allele representations set and the
+    models merged as in `Class2AffinityPredictor.load`, and restored from a
+    SavedModel bundle.
+
+    Returns
+    -------
+    dict of string -> float
+        Seconds for each method
+    """
+    alleles = sorted(BETA_SEQUENCES)
+    allele_encoding = make_allele_encoding_pair(
+        alleles, ALPHA_SEQUENCES, BETA_SEQUENCES)
+    models = [
+        make_untrained_network(allele_encoding) for _ in range(num_models)
+    ]
+    universe = AlleleEncoding(
+        allele_to_sequence=dict(ALPHA_SEQUENCES, **BETA_SEQUENCES))
+    peptides = random_peptides(10, length=15)
+    alpha_alleles = ["HLA-DRA*01:01"] * len(peptides)
+    beta_alleles = [alleles[0]] * len(peptides)
+
+    result = {}
+    with tempfile.TemporaryDirectory() as path:
+        SavedModelPredictor.export(models, universe, path)
+        configs_and_weights = [
+            (model.get_config(), model.get_weights()) for model in models
+        ]
+        Class2NeuralNetwork.clear_model_cache()
+
+        start = time.time()
+        restored = [
+            Class2NeuralNetwork.from_config(config, weights=weights)
+            for (config, weights) in configs_and_weights
+        ]
+        for model in restored:
+            (_, representations) = model.allele_encoding_to_network_input(
+                universe)
+            model.set_allele_representations(
+                representations, representations)
+        merged = Class2NeuralNetwork.merge(
+            restored, merge_method="concatenate")
+        merged.predict(
+            peptides,
+            allele_encoding_pair=make_allele_encoding_pair(
+                [alleles[0]] * len(peptides),
+                ALPHA_SEQUENCES,
+                BETA_SEQUENCES))
+        result["configs and weights"] = time.time() - start
+
+        start = time.time()
+        SavedModelPredictor(path).predict(
+            peptides, alpha_alleles=alpha_alleles, beta_alleles=beta_alleles)
+        result["SavedModel"] = time.time() - start
+
+    for (name, elapsed) in result.items():
+        print("Cold start of %d models from %s: %0.2f sec" % (
+            num_models, name, elapsed))
+    return result
+
+
+def test_speed_cold_start():
+    benchmark_cold_start(num_models=2)
+
+
+def benchmark_inference_precision(num_peptides=100000, num_repeats=3):
+    """
+    Compare the prediction throughput of a model at each inference precision,
+    with and without simulated int8 weights.
+
+    Returns
+    -------
+    pandas.DataFrame with rows per second and speedup over float32 for each
+    setting
+    """
+    import pandas
+
+    alleles = sorted(BETA_SEQUENCES)
+    allele_encoding = make_allele_encoding_pair(
+        numpy.random.choice(alleles, size=num_peptides),
+        ALPHA_SEQUENCES,
+        BETA_SEQUENCES)
+    peptides = EncodableSequences.create(
+        random_peptides(num_peptides, length=15))
+    model = make_untrained_network(allele_encoding)
+    rows = []
+    for precision in ["float32", "float16", "bfloat16"]:
+        for simulate_int8_weights in [False, True]:
+            reduced = model.with_inference_precision(
+                precision, simulate_int8_weights=simulate_int8_weights)
+            # Warm up: build the network and fill encoding caches.
+            reduced.predict(peptides, allele_encoding_pair=allele_encoding)
+            timings = []
+            for _ in range(num_repeats):
+                start = time.time()
+                reduced.predict(
+                    peptides, allele_encoding_pair=allele_encoding)
+                timings.append(time.time() - start)
+            rows.append((
+                precision,
+                simulate_int8_weights,
+                num_peptides / max(min(timings), 1e-9)))
+    result = pandas.DataFrame(
+        rows,
+        columns=["precision", "simulate_int8_weights", "rows_per_second"])
+    result["speedup"] = (
+        result.rows_per_second / result.rows_per_second.iloc[0])
+    print(result.to_string(index=False))
+    return result
+
+
+def test_speed_inference_precision():
+    benchmark_inference_precision(num_peptides=1000, num_repeats=1)
+
+
+parser = argparse.ArgumentParser(usage=__doc__)
+parser.add_argument(
+    "--num-peptides",
+    type=int,
+    nargs="*",
+    default=[1000000, 10000000, 50000000],
+    help="Number of peptides to encode. Default: %(default)s")
+parser.add_argument(
+    "--request-sizes",
+    type=int,
+    nargs="*",
+    default=[],
+    help="Request sizes (number of peptides) for which to benchmark "
+    "prediction latency")
+parser.add_argument(
+    "--cold-start-num-models",
+    type=int,
+    help="Number of models for which to benchmark cold start")
+parser.add_argument(
+    "--precision-num-peptides",
+    type=int,
+    help="Number of peptides for which to benchmark prediction throughput "
+    "at each inference precision")
+parser.add_argument(
+    "--num-requests",
+    type=int,
+    default=20,
+    help="Number of requests per request size. Default: %(default)s")
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    default=False,
+    help="Print profiling output")
+
+if __name__ == '__main__':
+    args = parser.parse_args(sys.argv[1:])
+    for num in args.num_peptides:
+        result = benchmark_index_encoding(profile=args.profile, num=num)
+        if args.profile:
+            for (name, stats) in result.items():
+                print("***", name)
+                stats.sort_stats("cumtime").reverse_order().print_stats()
+    if args.cold_start_num_models:
+        benchmark_cold_start(num_models=args.cold_start_num_models)
+    if args.precision_num_peptides:
+        benchmark_inference_precision(num_peptides=args.precision_num_peptides)
+    if args.request_sizes:
+        print(benchmark_predict_latency(
+            request_sizes=args.request_sizes,
+            num_requests=args.num_requests))